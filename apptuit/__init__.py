@@ -22,7 +22,7 @@ __version__ = '2.4.2'
 
 from apptuit import pyformance, timeseries
 from .apptuit_client import Apptuit, DataPoint, ApptuitException, ApptuitSendException, \
-    TimeSeriesName, TimeSeries
+    TimeSeriesName, TimeSeries, SeriesTable
 
 __all__ = ['Apptuit', 'DataPoint', 'ApptuitException', 'TimeSeriesName', 'TimeSeries',
-           'pyformance', 'timeseries', 'ApptuitSendException', '__version__']
+           'SeriesTable', 'pyformance', 'timeseries', 'ApptuitSendException', '__version__']
@@ -17,20 +17,24 @@
 """
 Client module for Apptuit APIs
 """
+import codecs
 import json
 import os
 import random
 import sys
+import threading
 import time
 import warnings
+import weakref
 import zlib
 from collections import defaultdict
 
 import requests
 
 from apptuit import APPTUIT_PY_TOKEN, APPTUIT_PY_TAGS, DEPRECATED_APPTUIT_PY_TOKEN, __version__
+from apptuit import timeseries
 from apptuit.utils import _contains_valid_chars, _get_tags_from_environment, \
-    _validate_tags, sanitize_name_prometheus, sanitize_name_apptuit
+    _parse_duration, _validate_tags, sanitize_name_prometheus, sanitize_name_apptuit
 
 try:
     from urllib import quote
@@ -38,9 +42,9 @@ except ImportError:
     from urllib.parse import quote
 
 try:
-    from functools import lru_cache
+    from sys import intern
 except ImportError:
-    from backports.functools_lru_cache import lru_cache
+    pass  # intern is a builtin on Python 2
 
 MAX_TAGS_LIMIT = 25
 SANITIZERS = {
@@ -48,6 +52,10 @@ SANITIZERS = {
     "prometheus": sanitize_name_prometheus
 }
 BASE_SLEEP_TIME_SECS = 2
+QUERY_STREAM_CHUNK_SIZE = 64 * 1024
+SERIES_OVERFLOW_POLICIES = ("drop", "fold")
+OVERFLOW_TAG = "cardinality_overflow"
+_SHARED_TAGS = weakref.WeakValueDictionary()
 
 def _get_user_agent():
     py_version = sys.version.split()[0]
@@ -62,12 +70,73 @@ def _generate_query_string(query_string, start, end):
     return ret
 
 
-def _parse_response(resp, start, end=None):
+class _SharedTags(dict):
+    """
+    Immutable tags dictionary of a query result series, a single instance is shared
+    by all the series having the same set of tags
+    """
+    __slots__ = ('__weakref__',)
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("tags of a query result are shared between series and cannot be "
+                        "modified, make a copy using tags.copy()")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+    def __hash__(self):
+        return hash(frozenset(self.items()))
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+
+def _intern_string(value):
+    if isinstance(value, str):
+        return intern(value)
+    return value
+
+
+def _share_tags(tags):
+    """
+    Get the shared immutable instance for the given tags. The tag keys and values are
+    interned, so thousands of series with the same tags hold a single copy of them.
+    """
+    if not tags:
+        return tags
+    key = tuple(sorted((_intern_string(tagk), _intern_string(tagv))
+                       for tagk, tagv in tags.items()))
+    shared_tags = _SHARED_TAGS.get(key)
+    if shared_tags is None:
+        shared_tags = _SharedTags(key)
+        _SHARED_TAGS[key] = shared_tags
+    return shared_tags
+
+
+def _parse_series(result, start, end=None, series_table=None):
+    dps = result["dps"]
+    index = []
+    values = []
+    for point in dps:
+        if point[0] < start:
+            continue
+        if end is not None and point[0] > end:
+            continue
+        index.append(point[0])
+        values.append(point[1])
+    series = TimeSeries(_intern_string(result["metric"]), _share_tags(result["tags"]),
+                        index, values)
+    if series_table is not None:
+        series.name = series_table.intern(series.name)
+    return series
+
+
+def _parse_response(resp, start, end=None, series_table=None):
     json_resp = json.loads(resp)
     outputs = json_resp["outputs"]
     if not outputs:  # Pythonic way of checking if list is empty
         return None
     qresult = QueryResult(start, end)
+    qresult.output_ids = [output["id"] for output in outputs]
     for output in outputs:
         results = output["result"]
         if not results:
@@ -76,21 +145,214 @@ def _parse_response(resp, start, end=None):
         output_id = output["id"]
         qresult[output_id] = Output()
         for result in results:
-            dps = result["dps"]
-            index = []
-            values = []
-            for point in dps:
-                if point[0] < start:
-                    continue
-                if end is not None and point[0] > end:
-                    continue
-                index.append(point[0])
-                values.append(point[1])
-            series = TimeSeries(result["metric"], result["tags"], index, values)
-            qresult[output_id].series.append(series)
+            qresult[output_id].series.append(_parse_series(result, start, end, series_table))
     return qresult
 
 
+class _StreamingResponseParser(object):
+    """
+    Incremental parser for the response of the query API. It walks the top level
+    structure of the response as the chunks arrive and decodes one series at a time,
+    so only the series currently being parsed is held in memory.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._json_decoder = json.JSONDecoder()
+        self._buffer = u""
+        self._pos = 0
+        self._eof = False
+
+    def _read(self):
+        """
+        Append the next chunk of the response to the buffer
+        Returns: False if the end of the response has been reached
+        """
+        if self._eof:
+            return False
+        if self._pos:
+            self._buffer = self._buffer[self._pos:]
+            self._pos = 0
+        for chunk in self._chunks:
+            if isinstance(chunk, bytes):
+                chunk = self._text_decoder.decode(chunk)
+            if chunk:
+                self._buffer += chunk
+                return True
+        self._buffer += self._text_decoder.decode(b"", final=True)
+        self._eof = True
+        return False
+
+    def _peek(self):
+        """
+        Skip whitespace and return the next character, None at the end of the response
+        """
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in u" \t\n\r":
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._read():
+                return None
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char is None or char not in chars:
+            raise ValueError("Failed to parse the query response, expected one of '%s' "
+                             "but found %r" % (chars, char))
+        self._pos += 1
+        return char
+
+    def _value(self):
+        """
+        Decode the JSON value at the current position, reading more of the response
+        until it is complete
+        """
+        self._peek()
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self._buffer, self._pos)
+                # a number at the end of the buffer may continue in the next chunk
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+            except ValueError:
+                if self._eof:
+                    raise
+            # read at least as much as is pending to avoid re-parsing large values too often
+            target = 2 * (len(self._buffer) - self._pos) + 1
+            while len(self._buffer) - self._pos < target and self._read():
+                pass
+
+    def _members(self):
+        """
+        Iterate over the keys of the object at the current position, the consumer
+        must consume the value of each key before asking for the next one
+        """
+        self._expect(u"{")
+        if self._peek() == u"}":
+            self._pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(u":")
+            yield key
+            if self._expect(u",}") == u"}":
+                return
+
+    def _elements(self):
+        """
+        Iterate over the array at the current position, the consumer must consume
+        each element before asking for the next one
+        """
+        self._expect(u"[")
+        if self._peek() == u"]":
+            self._pos += 1
+            return
+        while True:
+            yield
+            if self._expect(u",]") == u"]":
+                return
+
+    def _output_results(self):
+        output_id = None
+        pending = []
+        for key in self._members():
+            if key == "id":
+                output_id = self._value()
+                for result in pending:
+                    yield output_id, result
+                pending = []
+            elif key == "result" and self._peek() == u"[":
+                for _ in self._elements():
+                    result = self._value()
+                    if output_id is None:
+                        # the id is yet to be read, hold on to the series until then
+                        pending.append(result)
+                    else:
+                        yield output_id, result
+            else:
+                self._value()
+        for result in pending:
+            yield output_id, result
+
+    def iter_results(self):
+        """
+        Yields the output id and the decoded result dict of every series in the response
+        """
+        for key in self._members():
+            if key != "outputs" or self._peek() != u"[":
+                self._value()
+                continue
+            for _ in self._elements():
+                for output_id, result in self._output_results():
+                    yield output_id, result
+
+
+def _series_to_arrow_table(pa, series_list, output_ids=None, tz=None):
+    """
+    Build a long format Arrow table out of a list of TimeSeries. The points of each
+    series become one chunk of the timestamp and value columns, the metric, output and
+    tag columns are dictionary arrays sharing a single dictionary per column so that
+    no per-row python objects are created for them.
+    """
+    label_columns = ["metric"]
+    if output_ids is not None:
+        label_columns.append("output")
+    tag_keys = sorted(set(tagk for series in series_list for tagk in (series.tags or {})))
+    dictionaries = dict((column, {}) for column in label_columns + tag_keys)
+
+    def _index(column, value):
+        dictionary = dictionaries[column]
+        if value not in dictionary:
+            dictionary[value] = len(dictionary)
+        return dictionary[value]
+
+    chunks = defaultdict(list)
+    for position, series in enumerate(series_list):
+        points = len(series.timestamps)
+        if points == 0:
+            continue
+        labels = {"metric": series.metric}
+        if output_ids is not None:
+            labels["output"] = output_ids[position]
+        if series.tags:
+            labels.update(series.tags)
+        chunks["timestamp"].append(pa.array(series.timestamps, type=pa.timestamp("s", tz=tz)))
+        chunks["value"].append(pa.array(series.values, type=pa.float64()))
+        for column in dictionaries:
+            if column in labels:
+                index = pa.scalar(_index(column, labels[column]), type=pa.int32())
+                chunks[column].append(pa.repeat(index, points))
+            else:
+                chunks[column].append(pa.nulls(points, type=pa.int32()))
+
+    columns = [pa.chunked_array(chunks["timestamp"], type=pa.timestamp("s", tz=tz)),
+               pa.chunked_array(chunks["value"], type=pa.float64())]
+    names = ["timestamp", "value"]
+    for column in label_columns + tag_keys:
+        values = sorted(dictionaries[column], key=dictionaries[column].get)
+        dictionary = pa.array(values, type=pa.string())
+        column_chunks = [pa.DictionaryArray.from_arrays(indices, dictionary)
+                         for indices in chunks[column]]
+        columns.append(pa.chunked_array(column_chunks,
+                                        type=pa.dictionary(pa.int32(), pa.string())))
+        names.append(column)
+    return pa.Table.from_arrays(columns, names=names)
+
+
+class _InFlightQuery(object):
+    """
+    A query being executed on behalf of all the callers asking for the same query
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
 class Apptuit(object):
     """
     Apptuit client - providing APIs to send and query data from Apptuit
@@ -98,7 +360,8 @@ class Apptuit(object):
 
     def __init__(self, token=None, api_endpoint="https://api.apptuit.ai",
                  global_tags=None, ignore_environ_tags=False,
-                 sanitize_mode="prometheus"):
+                 sanitize_mode="prometheus", coalesce_queries=False, series_table=None,
+                 max_series=None, series_overflow="drop"):
         """
         Create an apptuit client object
         Params:
@@ -112,7 +375,28 @@ class Apptuit(object):
             sanitize_mode: Is a string value which will enable sanitizer, sanitizer will
                     automatically change your metric names to be compatible with apptuit
                     or prometheus. Set it to None if not needed.
+            coalesce_queries: True/False - whether identical queries (same query string,
+                    start and end) made concurrently from multiple threads should share a
+                    single request to the query service. All the callers get the same
+                    QueryResult object, which must then be treated as read-only.
+            series_table: An optional SeriesTable. The names of the series returned by
+                    queries are interned in it, and the metric names and tags of the
+                    datapoints being sent are sanitized and validated only once per series.
+            max_series: Maximum number of distinct series sent by this client. The points of
+                    the series sent after the limit is reached are handled according to
+                    series_overflow, and counted in the overflow_points attribute.
+                    None (default) means no limit.
+            series_overflow: "drop" to drop the points of the series over max_series, or
+                    "fold" to sum them, per metric name and timestamp, into an overflow series
+                    tagged with cardinality_overflow=true. The points are summed whatever they
+                    measure, so "fold" is only meaningful for additive values such as counts
+                    and rates, not for gauges, averages or percentiles.
         """
+        if max_series is not None and max_series < 0:
+            raise ValueError("max_series should be a non-negative integer, got %r" % max_series)
+        if series_overflow not in SERIES_OVERFLOW_POLICIES:
+            raise ValueError("series_overflow should be one of %s, got %r"
+                             % (SERIES_OVERFLOW_POLICIES, series_overflow))
         self.sanitizer = None
         if sanitize_mode:
             self.sanitizer = SANITIZERS.get(sanitize_mode.lower(), None)
@@ -143,6 +427,81 @@ class Apptuit(object):
         self._global_tags = global_tags
         if not self._global_tags and not ignore_environ_tags:
             self._global_tags = _get_tags_from_environment()
+        self._in_flight_queries = {} if coalesce_queries else None
+        self._in_flight_lock = threading.Lock()
+        self.coalesced_queries = 0
+        self._series_table = series_table
+        self._series_payloads = {}
+        self.max_series = max_series
+        self.series_overflow = series_overflow
+        self.overflow_points = 0
+        self.last_payload_size = None
+        self._limited_series = set()
+        self._limited_series_lock = threading.Lock()
+
+    @property
+    def series_count(self):
+        """
+        Number of distinct series sent by this client, when max_series is set
+        """
+        return len(self._limited_series)
+
+    def _is_series_over_limit(self, name):
+        """
+        Check if a series is over the max_series limit, and count it as sent otherwise.
+        Must be called with the _limited_series_lock held.
+        """
+        limited_series = self._limited_series
+        if name in limited_series:
+            return False
+        if len(limited_series) >= self.max_series:
+            return True
+        limited_series.add(name)
+        return False
+
+    def _limit_datapoints(self, datapoints):
+        """
+        Drop or fold the datapoints of the series over the max_series limit
+        """
+        if self.max_series is None:
+            return datapoints
+        limited_datapoints = []
+        folded_values = {}
+        with self._limited_series_lock:
+            for point in datapoints:
+                if not self._is_series_over_limit(point.timeseries_name):
+                    limited_datapoints.append(point)
+                elif self.series_overflow == "fold":
+                    fold_key = (point.metric, point.timestamp)
+                    folded_values[fold_key] = folded_values.get(fold_key, 0.0) + point.value
+            self.overflow_points += len(datapoints) - len(limited_datapoints)
+        for (metric, timestamp), value in folded_values.items():
+            limited_datapoints.append(DataPoint(metric, {OVERFLOW_TAG: "true"}, timestamp, value))
+        return limited_datapoints
+
+    def _limit_timeseries(self, timeseries_list):
+        """
+        Drop or fold the timeseries over the max_series limit
+        """
+        if self.max_series is None:
+            return timeseries_list
+        limited_timeseries = []
+        folded_values = defaultdict(dict)
+        with self._limited_series_lock:
+            for series in timeseries_list:
+                if not self._is_series_over_limit(series.name):
+                    limited_timeseries.append(series)
+                    continue
+                self.overflow_points += len(series)
+                if self.series_overflow == "fold":
+                    metric_values = folded_values[series.metric]
+                    for timestamp, value in zip(series.timestamps, series.values):
+                        metric_values[timestamp] = metric_values.get(timestamp, 0.0) + value
+        for metric, metric_values in folded_values.items():
+            timestamps = sorted(metric_values)
+            limited_timeseries.append(TimeSeries(metric, {OVERFLOW_TAG: "true"}, timestamps,
+                                                 [metric_values[ts] for ts in timestamps]))
+        return limited_timeseries
 
     @property
     def put_apiurl(self):
@@ -163,36 +522,69 @@ class Apptuit(object):
             return self._global_tags
         return None
 
+    def _sanitize_datapoint_name(self, point):
+        """
+        Get the sanitized metric name and the validated tags, combined with
+        the global tags, to send for the given datapoint
+        """
+        if self.sanitizer:
+            sanitized_metric = self.sanitizer(point.metric)
+        else:
+            if not _contains_valid_chars(point.metric):
+                raise ValueError("Metric Name %s contains an invalid character, "
+                                 "allowed characters are unicode letter, "
+                                 "a-z, A-Z, 0-9, -, _, ., and /" % point.metric)
+            sanitized_metric = point.metric
+        tags = self._combine_tags_with_globaltags(point.tags)
+        if not tags:
+            raise ValueError("Missing tags for the metric "
+                             + point.metric +
+                             ". Either pass it as value of the tags"
+                             " parameter to DataPoint or"
+                             " set environment variable '"
+                             + APPTUIT_PY_TAGS +
+                             "' for global tags")
+        if len(tags) > MAX_TAGS_LIMIT:
+            raise ValueError("Too many tags for datapoint %s, maximum allowed number of tags "
+                             "is %d, found %d tags" % (point, MAX_TAGS_LIMIT, len(tags)))
+        if self.sanitizer:
+            sanitized_tags = {}
+            for key, val in tags.items():
+                sanitized_tags[self.sanitizer(key)] = val
+            tags = sanitized_tags
+        else:
+            _validate_tags(tags)
+        return sanitized_metric, tags
+
+    def forget_series(self, names):
+        """
+        Remove the given TimeSeriesNames from the series table and their sanitized
+        metric names and tags from the cache of the client, for the series which are
+        no longer sent
+        Params:
+            names: iterable of TimeSeriesName
+        """
+        series_table = self._series_table
+        if series_table is None:
+            return
+        for name in names:
+            series_id = series_table.remove(name)
+            if series_id is not None:
+                self._series_payloads.pop(series_id, None)
+
     def _create_payload_from_datapoints(self, datapoints):
         data = []
+        series_table = self._series_table
         for point in datapoints:
-            if self.sanitizer:
-                sanitized_metric = self.sanitizer(point.metric)
+            if series_table is None:
+                sanitized_metric, tags = self._sanitize_datapoint_name(point)
             else:
-                if not _contains_valid_chars(point.metric):
-                    raise ValueError("Metric Name %s contains an invalid character, "
-                                     "allowed characters are unicode letter, "
-                                     "a-z, A-Z, 0-9, -, _, ., and /" % point.metric)
-                sanitized_metric = point.metric
-            tags = self._combine_tags_with_globaltags(point.tags)
-            if not tags:
-                raise ValueError("Missing tags for the metric "
-                                 + point.metric +
-                                 ". Either pass it as value of the tags"
-                                 " parameter to DataPoint or"
-                                 " set environment variable '"
-                                 + APPTUIT_PY_TAGS +
-                                 "' for global tags")
-            if len(tags) > MAX_TAGS_LIMIT:
-                raise ValueError("Too many tags for datapoint %s, maximum allowed number of tags "
-                                 "is %d, found %d tags" % (point, MAX_TAGS_LIMIT, len(tags)))
-            if self.sanitizer:
-                sanitized_tags = {}
-                for key, val in tags.items():
-                    sanitized_tags[self.sanitizer(key)] = val
-                tags = sanitized_tags
-            else:
-                _validate_tags(tags)
+                series_id = series_table.series_id(point.timeseries_name)
+                series_payload = self._series_payloads.get(series_id)
+                if series_payload is None:
+                    series_payload = self._sanitize_datapoint_name(point)
+                    self._series_payloads[series_id] = series_payload
+                sanitized_metric, tags = series_payload
             row = dict()
             row["metric"] = sanitized_metric
             row["timestamp"] = point.timestamp
@@ -204,19 +596,19 @@ class Apptuit(object):
     def _create_payload_from_timeseries(self, timeseries_list):
         data = []
         points_count = 0
-        for timeseries in timeseries_list:
-            tags = self._combine_tags_with_globaltags(timeseries.tags)
+        for series in timeseries_list:
+            tags = self._combine_tags_with_globaltags(series.tags)
             if not tags:
                 raise ValueError("Missing tags for the metric '%s'. Either pass it as value "
                                  "of the tags parameter to TimeSeriesName, or set environment "
                                  "variable '%s' for global tags, or pass 'global_tags' parameter "
-                                 "to the apptuit_client" % (timeseries.metric, APPTUIT_PY_TAGS))
+                                 "to the apptuit_client" % (series.metric, APPTUIT_PY_TAGS))
 
             if len(tags) > MAX_TAGS_LIMIT:
                 raise ValueError("Too many tags for timeseries %s, maximum allowed number of tags "
-                                 "is %d, found %d tags" % (timeseries, MAX_TAGS_LIMIT, len(tags)))
-            for timestamp, value in zip(timeseries.timestamps, timeseries.values):
-                row = {"metric": timeseries.metric,
+                                 "is %d, found %d tags" % (series, MAX_TAGS_LIMIT, len(tags)))
+            for timestamp, value in zip(series.timestamps, series.values):
+                row = {"metric": series.metric,
                        "tags": tags,
                        "timestamp": timestamp,
                        "value": value}
@@ -236,6 +628,9 @@ class Apptuit(object):
             `https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/`
         It raises an ApptuitSendException in case the backend API responds with an error
         """
+        if not datapoints:
+            return
+        datapoints = self._limit_datapoints(datapoints)
         if not datapoints:
             return
         payload = self._create_payload_from_datapoints(datapoints)
@@ -277,6 +672,7 @@ class Apptuit(object):
         """
         if not timeseries_list:
             return
+        timeseries_list = self._limit_timeseries(timeseries_list)
         data, points_count = self._create_payload_from_timeseries(timeseries_list)
         if points_count != 0:
             self.__send(data, points_count, timeout)
@@ -288,6 +684,7 @@ class Apptuit(object):
     def __send(self, payload, points_count, timeout):
         body = json.dumps(payload)
         body = zlib.compress(body.encode("utf-8"))
+        self.last_payload_size = len(body)
         headers = dict()
         headers["Authorization"] = "Bearer " + self.token
         headers["Content-Type"] = "application/json"
@@ -330,6 +727,9 @@ class Apptuit(object):
                 algo to retry
                 `https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/`
             Returns a QueryResult object
+            If the client was created with coalesce_queries=True and the same query is
+            already being executed by another thread, this call waits for it and returns
+            its result (and the retry_count and timeout of that call apply).
             Individual queried items can be accessed by indexing the result object using either
             the integer index of the metric in the query or the metric name.
 
@@ -346,12 +746,143 @@ class Apptuit(object):
             cpu_df = res[0].to_df()
             load_df = res[1].to_df()
         """
+        if self._in_flight_queries is None:
+            return self.__query(query_str, start, end, retry_count, timeout)
+        key = (query_str, start, end)
+        with self._in_flight_lock:
+            in_flight = self._in_flight_queries.get(key)
+            is_leader = in_flight is None
+            if is_leader:
+                in_flight = _InFlightQuery()
+                self._in_flight_queries[key] = in_flight
+            else:
+                self.coalesced_queries += 1
+        if not is_leader:
+            in_flight.done.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return in_flight.result
+        try:
+            in_flight.result = self.__query(query_str, start, end, retry_count, timeout)
+            return in_flight.result
+        except Exception as err:
+            in_flight.error = err
+            raise
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight_queries[key]
+            in_flight.done.set()
+
+    def __query(self, query_str, start, end, retry_count, timeout):
+        url = self.__generate_request_url(query_str, start, end)
+        return self.__execute_with_retries(
+            lambda: self._execute_query(url, start, end, timeout), retry_count)
+
+    def iter_query(self, query_str, start, end=None, retry_count=0, timeout=180):
+        """
+            Execute the given query on Query service and iterate over the resulting
+            series as they are read from the HTTP response, without building the
+            whole QueryResult. Each series is parsed from the response only when the
+            previous one has been consumed, so arbitrarily large results can be
+            processed in constant memory.
+            Params:
+                query_str - The query string
+                start - the start timestamp (unix epoch in seconds)
+                end - the end timestamp (unix epoch in seconds)
+                timeout - timeout (in seconds) for the HTTP request
+                retry_count: Number of times to retry the request in case of errors,
+                the retries are done only before the response starts being read.
+            Yields (output_id, TimeSeries) tuples
+
+        Example:
+            apptuit = Apptuit(token=token)
+            for output_id, series in apptuit.iter_query("fetch('node.cpu')", start=start_time):
+                process(output_id, series)
+        """
         url = self.__generate_request_url(query_str, start, end)
+        hresp = self.__execute_with_retries(
+            lambda: self._send_query_request(url, timeout, stream=True), retry_count)
+        try:
+            parser = _StreamingResponseParser(
+                hresp.iter_content(chunk_size=QUERY_STREAM_CHUNK_SIZE))
+            for output_id, result in parser.iter_results():
+                yield output_id, _parse_series(result, start, end, self._series_table)
+        finally:
+            hresp.close()
+
+    def query_frames(self, query_str, start, end=None, chunk="6h", output=0, tz=None,
+                     retry_count=0, timeout=180, columns=None):
+        """
+            Execute the given query window by window over the time range and yield one
+            Pandas DataFrame per window, so that long time ranges can be exported without
+            holding all of the data in memory at once.
+            Params:
+                query_str - The query string
+                start - the start timestamp (unix epoch in seconds)
+                end - the end timestamp (unix epoch in seconds), defaults to now
+                chunk - length of each window, either in seconds or as a string
+                such as '30m', '6h' or '1d'
+                output - the output of the query to create the frames from, either its
+                id or its integer index in the outputs of the query, including the outputs
+                without data
+                tz - timezone of the index of the frames (same as Output.to_df())
+                retry_count, timeout - used for the query of each window (same as query())
+                columns - if set, the list of the columns of every frame, the series not
+                in it are dropped
+            Without columns, every frame has the columns of all the series seen in the
+            current and earlier windows, in the order they first appeared, so a frame can
+            have more columns than the previous ones. Series which have no data in a window
+            get NaN values, and a window without any data yields an empty frame.
+
+        Example:
+            apptuit = Apptuit(token=token)
+            for index, df in enumerate(apptuit.query_frames("fetch('node.cpu')", start=start,
+                                                            end=end, chunk="1d")):
+                df.to_csv("node.cpu.%d.csv" % index)
+        """
+        import pandas as pd
+        chunk_secs = _parse_duration(chunk)
+        if end is None:
+            end = int(time.time())
+        fixed_columns = columns is not None
+        columns = list(columns) if fixed_columns else []
+        output_id = None if isinstance(output, int) else output
+        window_start = start
+        while window_start <= end:
+            # the end of a query is inclusive, stop one second short of the next window
+            window_end = min(window_start + chunk_secs - 1, end)
+            result = self.query(query_str, window_start, window_end,
+                                retry_count=retry_count, timeout=timeout)
+            dataframe = None
+            if result is not None:
+                if output_id is None:
+                    # the empty outputs are not indexed by the result, resolve the index
+                    # from all the outputs of the query once for all the windows
+                    try:
+                        output_id = result.output_ids[output]
+                    except IndexError:
+                        pass
+                window_output = result[output_id] if output_id is not None else None
+                if window_output is not None and window_output.series:
+                    dataframe = window_output.to_df(tz=tz)
+            if dataframe is None:
+                index = pd.DatetimeIndex([]).tz_localize(tz)
+                dataframe = pd.DataFrame(index=index, columns=columns, dtype=float)
+            else:
+                if not fixed_columns:
+                    known_columns = set(columns)
+                    columns.extend(column for column in dataframe.columns
+                                   if column not in known_columns)
+                dataframe = dataframe.reindex(columns=columns)
+            yield dataframe
+            window_start = window_end + 1
+
+    def __execute_with_retries(self, execute_request, retry_count):
         try_number = 0
         while True:
             try:
                 try_number += 1
-                return self._execute_query(url, start, end, timeout)
+                return execute_request()
             except requests.exceptions.HTTPError as http_error:
                 if retry_count >= try_number:
                     if http_error.response is not None:
@@ -379,15 +910,23 @@ class Apptuit(object):
                     continue
                 raise request_error
 
-    def _execute_query(self, query_string, start, end, timeout):
+    def _send_query_request(self, url, timeout, **kwargs):
         headers = dict()
         headers["User-Agent"] = _get_user_agent()
         if self.token:
             headers["Authorization"] = "Bearer " + self.token
-        hresp = requests.get(query_string, headers=headers, timeout=timeout)
-        hresp.raise_for_status()
+        hresp = requests.get(url, headers=headers, timeout=timeout, **kwargs)
+        try:
+            hresp.raise_for_status()
+        except requests.exceptions.RequestException:
+            hresp.close()
+            raise
+        return hresp
+
+    def _execute_query(self, query_string, start, end, timeout):
+        hresp = self._send_query_request(query_string, timeout)
         body = hresp.content
-        return _parse_response(body, start, end)
+        return _parse_response(body, start, end, self._series_table)
 
     def __generate_request_url(self, query_string, start, end):
         query_string = self.endpoint + "/api/query" + \
@@ -445,8 +984,12 @@ class TimeSeries(object):
 
 class TimeSeriesName(object):
     """
-    Encapsulates a timeseries name representation by using the metric name and tags
+    Encapsulates a timeseries name representation by using the metric name and tags.
+    It is immutable and hashable: two names are equal when they have the same metric
+    name and tags. The tags are copied, so modifying the dict passed to create the
+    name does not change it.
     """
+    __slots__ = ('_metric', '_tags', '_key')
 
     def __init__(self, metric, tags):
         """
@@ -455,34 +998,61 @@ class TimeSeriesName(object):
             metric: name of the metric
             tags: tags for the metric (expected a dict type)
         """
-        self.metric = metric
-        self.tags = tags
-
-    @property
-    def tags(self):
-        return self._tags
-
-    @tags.setter
-    def tags(self, tags):
+        if not metric:
+            raise ValueError("metric name cannot be None or empty")
         if tags:
             for key in tags:
                 if not key:
                     raise ValueError("Tag key can't be '%s'" % key)
-
+        if isinstance(tags, dict) and not isinstance(tags, _SharedTags):
+            # the key is computed from the tags on the first hash, a dict still held by
+            # the caller could be modified after that
+            tags = dict(tags)
+        self._metric = metric
         self._tags = tags
+        self._key = None
+
+    @property
+    def tags(self):
+        return self._tags
 
     @property
     def metric(self):
         return self._metric
 
-    @metric.setter
-    def metric(self, metric):
-        if not metric:
-            raise ValueError("metric name cannot be None or empty")
-        self._metric = metric
+    @property
+    def key(self):
+        """
+        The canonical string of this name, the metric name followed by the JSON
+        encoding of the tags sorted by tag key. It is computed once and used
+        for hashing and comparing names.
+        """
+        if self._key is None:
+            if isinstance(self._tags, dict):
+                self._key = timeseries._encode_metric(self._metric, self._tags)
+            else:
+                self._key = self._metric + json.dumps(self._tags, sort_keys=True)
+        return self._key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __eq__(self, other):
+        if not isinstance(other, TimeSeriesName):
+            return NotImplemented
+        return self is other or self.key == other.key
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __repr__(self):
+        return "TimeSeriesName(%s)" % self.key
 
     def __str__(self):
-        return self.metric + json.dumps(self.tags, sort_keys=True)
+        return self.key
 
     @staticmethod
     def encode_metric(metric_name, metric_tags):
@@ -497,18 +1067,9 @@ class TimeSeriesName(object):
             s = reporter.encode_metric_name('node.cpu', {"type": "idle"})
             print(s) # 'node.cpu {"type": "idle"}'
         """
-        if not isinstance(metric_name, str):
-            raise ValueError("metric_name should be a string")
-        if metric_name == "":
-            raise ValueError("metric_name cannot be empty")
-        if not isinstance(metric_tags, dict):
-            raise ValueError("metric_tags must be a dictionary")
-
-        encoded_metric_name = metric_name + json.dumps(metric_tags, sort_keys=True)
-        return encoded_metric_name
+        return timeseries.encode_metric(metric_name, metric_tags)
 
     @staticmethod
-    @lru_cache(maxsize=2048)
     def decode_metric(encoded_metric_name):
         """
         Decode the metric name as encoded by encode_metric_name
@@ -518,20 +1079,68 @@ class TimeSeriesName(object):
         Returns:
             The metric name and the dictionary of tags
         """
-        if encoded_metric_name is None or encoded_metric_name == "":
-            raise ValueError("Invalid value for encoded_metric_name")
+        return timeseries.decode_metric(encoded_metric_name)
 
-        metric_tags = {}
-        metric_name = encoded_metric_name.strip()
-        brace_index = encoded_metric_name.find('{')
-        if brace_index > -1:
-            try:
-                metric_tags = json.loads(encoded_metric_name[brace_index:])
-                metric_name = encoded_metric_name[:brace_index].strip()
-            except Exception as err:
-                raise ValueError("Failed to parse the encoded_metric_name %s, invalid format"
-                                 % encoded_metric_name, err)
-        return metric_name, metric_tags
+
+class SeriesTable(object):
+    """
+    Intern table of TimeSeriesName objects. Interning a name returns the single
+    instance shared by all the names equal to it, and gives it an integer series id,
+    stable until the name is removed from the table and never given to another name,
+    which can be used for cheap lookups in place of the name.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._names = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, name):
+        return name in self._ids
+
+    def series_id(self, name):
+        """
+        Get the id of the given TimeSeriesName, adding it to the table if it is new
+        """
+        series_id = self._ids.get(name)
+        if series_id is None:
+            with self._lock:
+                series_id = self._ids.get(name)
+                if series_id is None:
+                    series_id = self._next_id
+                    self._next_id += 1
+                    self._names[series_id] = name
+                    self._ids[name] = series_id
+        return series_id
+
+    def remove(self, name):
+        """
+        Remove the given TimeSeriesName from the table
+        Returns:
+            The id the name had, None if it was not in the table
+        """
+        with self._lock:
+            series_id = self._ids.pop(name, None)
+            if series_id is not None:
+                del self._names[series_id]
+        return series_id
+
+    def intern(self, name):
+        """
+        Get the instance of the table equal to the given TimeSeriesName, adding it
+        to the table if it is new
+        """
+        return self._names[self.series_id(name)]
+
+    def name(self, series_id):
+        """
+        Get the TimeSeriesName with the given id
+        """
+        return self._names[series_id]
 
 
 class Output(object):
@@ -562,6 +1171,15 @@ class Output(object):
         self.__dataframe = dataframe
         return dataframe
 
+    def to_arrow(self, tz=None):
+        """
+            Create an Apache Arrow Table from this data, in long format: one row per point
+            with timestamp, value, metric and one column per tag key. The metric and tag
+            columns are dictionary encoded.
+        """
+        import pyarrow as pa
+        return _series_to_arrow_table(pa, self.series, tz=tz)
+
 
 class QueryResult(object):
     """
@@ -575,6 +1193,9 @@ class QueryResult(object):
         self.__outputs = defaultdict(Output)
         self.start = start
         self.end = end
+        # the ids of all the outputs of the query in order, including the outputs
+        # without any series, which are not indexed
+        self.output_ids = []
         self.__output_keys = {}
         self.__output_index = 0
 
@@ -594,6 +1215,31 @@ class QueryResult(object):
             output_id = self.__output_keys[key]
         return self.__outputs[output_id]
 
+    def to_arrow(self, tz=None):
+        """
+            Create an Apache Arrow Table from all the outputs of this result, in the same
+            long format as Output.to_arrow() with an additional dictionary encoded
+            `output` column holding the output id of each row.
+        """
+        import pyarrow as pa
+        series_list = []
+        output_ids = []
+        for index in range(self.__output_index):
+            output_id = self.__output_keys[index]
+            for series in self.__outputs[output_id].series:
+                series_list.append(series)
+                output_ids.append(output_id)
+        return _series_to_arrow_table(pa, series_list, output_ids, tz)
+
+    def to_parquet(self, path, tz=None, **kwargs):
+        """
+            Write all the outputs of this result to a Parquet file at `path`.
+            The layout is the one returned by to_arrow(), extra keyword arguments
+            are passed on to pyarrow.parquet.write_table.
+        """
+        import pyarrow.parquet as pq
+        pq.write_table(self.to_arrow(tz=tz), path, **kwargs)
+
 
 class DataPoint(object):
     """
@@ -610,6 +1256,25 @@ class DataPoint(object):
         """
         self.timestamp = timestamp
         self.timeseries_name = TimeSeriesName(metric, tags)
+        self._set_value(value)
+
+    @classmethod
+    def from_name(cls, timeseries_name, timestamp, value):
+        """
+        Create a datapoint of an existing TimeSeriesName, which avoids validating
+        the metric name and tags again for every point of the same series
+        Params:
+            timeseries_name: The TimeSeriesName of the series
+            timestamp: Number of seconds since Unix epoch
+            value: value of the metric at this timestamp (int or float)
+        """
+        point = cls.__new__(cls)
+        point.timestamp = timestamp
+        point.timeseries_name = timeseries_name
+        point._set_value(value)
+        return point
+
+    def _set_value(self, value):
         try:
             self.value = float(value)
         except TypeError:
@@ -18,7 +18,17 @@
     A Pyformance Reporter for Apptuit
 """
 from .apptuit_reporter import ApptuitReporter
+from .lag_monitor import LagMonitor
 from .process_metrics import ProcessMetrics
+from .shared_registry import SharedMetricsRegistry
+from .sketch_metrics import SketchMetricsRegistry
+from .stack_profiler import StackProfiler
+from .striped_metrics import StripedMetricsRegistry
 
 __all__ = ['ApptuitReporter',
-           'ProcessMetrics']
+           'LagMonitor',
+           'ProcessMetrics',
+           'SharedMetricsRegistry',
+           'SketchMetricsRegistry',
+           'StackProfiler',
+           'StripedMetricsRegistry']
@@ -20,21 +20,107 @@ Apptuit Pyformance Reporter
 import os
 import socket
 import sys
+import threading
 import time
+import warnings
+import weakref
+import zlib
+from fnmatch import fnmatchcase
+from operator import add, methodcaller
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 from pyformance import MetricsRegistry
 from pyformance.reporters.reporter import Reporter
 
-from apptuit.apptuit_client import Apptuit, DataPoint, ApptuitSendException, TimeSeriesName
+from apptuit.apptuit_client import Apptuit, DataPoint, ApptuitSendException, TimeSeriesName, \
+    SeriesTable, SERIES_OVERFLOW_POLICIES, OVERFLOW_TAG
+from .cgroup_metrics import CgroupMetrics
+from .gc_metrics import GCMetrics
+from .lag_monitor import LagMonitor
+from .linux_process_metrics import LinuxProcessMetrics
 from .process_metrics import ProcessMetrics
+from .shared_registry import SharedMetricsRegistry
+from .stack_profiler import StackProfiler
 from ..utils import _get_tags_from_environment, strtobool
 
 NUMBER_OF_TOTAL_POINTS = "apptuit.reporter.send.total"
 NUMBER_OF_SUCCESSFUL_POINTS = "apptuit.reporter.send.successful"
 NUMBER_OF_FAILED_POINTS = "apptuit.reporter.send.failed"
+NUMBER_OF_SUPPRESSED_POINTS = "apptuit.reporter.send.suppressed"
 API_CALL_TIMER = "apptuit.reporter.send.time"
+SEND_QUEUE_DEPTH = "apptuit.reporter.send.queue.depth"
+NUMBER_OF_DROPPED_REPORTS = "apptuit.reporter.send.queue.dropped"
+NUMBER_OF_SERIES = "apptuit.reporter.series.count"
+NUMBER_OF_OVERFLOW_POINTS = "apptuit.reporter.series.overflow"
+CURRENT_BATCH_SIZE = "apptuit.reporter.send.batch.size"
 DISABLE_HOST_TAG = "APPTUIT_DISABLE_HOST_TAG"
 BATCH_SIZE = 50000
+MIN_BATCH_SIZE = 100
+DEFAULT_TARGET_BATCH_BYTES = 1024 * 1024
+DEFAULT_TARGET_BATCH_LATENCY = 5
+_NOT_REPORTED = object()
+_monotonic = getattr(time, "monotonic", time.time)
+_SENDER_POLL_INTERVAL = 1
+# maximum number of seconds stop() waits for the queued reports to be sent
+_STOP_TIMEOUT = 10
+
+DEFAULT_FIELDS = {
+    "counter": ("count",),
+    "gauge": ("value",),
+    "meter": ("count", "15m_rate", "5m_rate", "1m_rate", "mean_rate"),
+    "histogram": ("avg", "count", "max", "min", "std_dev", "75_percentile",
+                  "95_percentile", "99_percentile", "999_percentile"),
+    "timer": ("avg", "sum", "count", "max", "min", "std_dev", "15m_rate", "5m_rate",
+              "1m_rate", "mean_rate", "50_percentile", "75_percentile", "95_percentile",
+              "99_percentile", "999_percentile")
+}
+_SUPPORTED_FIELDS = {
+    "counter": DEFAULT_FIELDS["counter"],
+    "gauge": DEFAULT_FIELDS["gauge"],
+    "meter": DEFAULT_FIELDS["meter"],
+    "histogram": DEFAULT_FIELDS["histogram"] + ("sum", "50_percentile"),
+    "timer": DEFAULT_FIELDS["timer"]
+}
+_REGISTRY_METRICS = (("counter", "_counters"), ("histogram", "_histograms"),
+                     ("meter", "_meters"), ("timer", "_timers"), ("gauge", "_gauges"))
+_METRIC_GETTERS = {
+    "count": methodcaller("get_count"),
+    "value": methodcaller("get_value"),
+    "avg": methodcaller("get_mean"),
+    "sum": methodcaller("get_sum"),
+    "max": methodcaller("get_max"),
+    "min": methodcaller("get_min"),
+    "std_dev": methodcaller("get_stddev"),
+    "15m_rate": methodcaller("get_fifteen_minute_rate"),
+    "5m_rate": methodcaller("get_five_minute_rate"),
+    "1m_rate": methodcaller("get_one_minute_rate"),
+    "mean_rate": methodcaller("get_mean_rate")
+}
+_SNAPSHOT_GETTERS = {
+    "50_percentile": methodcaller("get_median"),
+    "75_percentile": methodcaller("get_75th_percentile"),
+    "95_percentile": methodcaller("get_95th_percentile"),
+    "99_percentile": methodcaller("get_99th_percentile"),
+    "999_percentile": methodcaller("get_999th_percentile")
+}
+
+# how the values of a field are combined into the overflow series, the fields which
+# cannot be combined from the values of the folded metrics (averages, deviations,
+# percentiles and gauge values) are not reported in it
+_FOLDED_FIELDS = {
+    "count": add,
+    "sum": add,
+    "15m_rate": add,
+    "5m_rate": add,
+    "1m_rate": add,
+    "mean_rate": add,
+    "max": max,
+    "min": min
+}
 
 
 def default_error_handler(status_code, successful, failed, errors):
@@ -55,6 +141,91 @@ def default_error_handler(status_code, successful, failed, errors):
     sys.stderr.write(msg)
 
 
+class _BatchSizer(object):
+    """
+    Adapts the number of points sent per batch to the compressed bytes per point
+    and the latency observed on the previous batches, between MIN_BATCH_SIZE and
+    BATCH_SIZE points, or the size which was last accepted after a 413 error
+    """
+
+    def __init__(self, target_bytes, target_latency):
+        self.target_bytes = target_bytes
+        self.target_latency = target_latency
+        self.max_size = BATCH_SIZE
+        self.size = BATCH_SIZE
+
+    def update(self, points_count, payload_bytes, latency):
+        """
+        Adapt the batch size after a batch of points_count points was sent successfully
+        in payload_bytes compressed bytes (None if unknown) and latency seconds
+        """
+        limit = self.max_size
+        if self.target_bytes and payload_bytes:
+            limit = min(limit, self.target_bytes * points_count // payload_bytes)
+        if self.target_latency and latency > 0:
+            limit = min(limit, int(self.target_latency * points_count / latency))
+        # a partial batch only tells whether the targets are exceeded, the fixed
+        # cost of a request makes it a poor estimate of the size of a full batch
+        if points_count < self.size and limit >= points_count:
+            return
+        self.size = max(MIN_BATCH_SIZE, min(limit, 2 * self.size))
+
+    def back_off(self, status_code):
+        """
+        Halve the batch size after the server rejected a batch as too large (413)
+        or failed to handle it (5xx)
+        Returns:
+            True if the batch size was reduced
+        """
+        if status_code is None or (status_code != 413 and not 500 <= status_code <= 599):
+            return False
+        size = max(MIN_BATCH_SIZE, self.size // 2)
+        reduced = size < self.size
+        self.size = size
+        if status_code == 413:
+            self.max_size = size
+        return reduced
+
+
+class _SeriesPlan(object):
+    """
+    The names, tags and fields of the series reported for a registry key
+    """
+    __slots__ = ("metric_name", "metric_prefix", "tags", "names", "fields")
+
+    def __init__(self, metric_name, metric_prefix, tags):
+        self.metric_name = metric_name
+        self.metric_prefix = metric_prefix
+        self.tags = tags
+        self.names = {}
+        self.fields = {}
+
+
+class _Report(tuple):
+    """
+    The data points of a report, with the names of the series which were no longer
+    reported when it was collected, to remove from the caches once the previous
+    reports are sent
+    """
+
+    def __new__(cls, dps, evicted_series):
+        report = super(_Report, cls).__new__(cls, dps)
+        report.evicted_series = evicted_series
+        return report
+
+
+class _SeriesPlans(dict):
+    """
+    The series plans of a registry keyed by registry key, with the number of
+    series they hold and the names of the overflow series
+    """
+
+    def __init__(self):
+        super(_SeriesPlans, self).__init__()
+        self.series_count = 0
+        self.overflow_names = {}
+
+
 class ApptuitReporter(Reporter):
     """
         Pyformance based reporter for Apptuit. It provides high level
@@ -66,13 +237,20 @@ class ApptuitReporter(Reporter):
                  api_endpoint="https://api.apptuit.ai", prefix="", tags=None,
                  error_handler=default_error_handler, disable_host_tag=None,
                  collect_process_metrics=False, sanitize_mode="prometheus",
-                 retry_count=0):
+                 retry_count=0, report_changes_only=False, heartbeat_interval=30,
+                 fields=None, metric_fields=None, align_reports=False, max_jitter=0,
+                 send_queue_size=0, max_series=None, series_overflow="drop",
+                 target_batch_bytes=DEFAULT_TARGET_BATCH_BYTES,
+                 target_batch_latency=DEFAULT_TARGET_BATCH_LATENCY, collect_gc_metrics=False,
+                 lag_sampling_interval=None, event_loop=None, profiler_sampling_interval=None,
+                 collect_linux_process_metrics=False, collect_cgroup_metrics=False):
         """
         Parameters
         ----------
             registry: An instance of MetricsRegistry from pyformance. It is
                 used as a container for all the metrics. If None, a new instance will be
-                created internally
+                created internally. With a SharedMetricsRegistry, only the reporter of the
+                elected process sends the metrics, aggregated across all the processes
             reporting_interval: Reporting interval in seconds
             token: Apptuit API token
             prefix: Optional prefix for metric names, this will be prepended to all the
@@ -97,9 +275,78 @@ class ApptuitReporter(Reporter):
             retry_count: This will allow you to retry to send DP's in case of errors.
                 This uses Backoff-jitter algo to retry.
                 `https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/`
+            report_changes_only: If True, only the series whose values changed since they were
+                last sent successfully are reported, the unchanged points are counted in the
+                apptuit.reporter.send.suppressed meta metric. Disabled by default.
+            heartbeat_interval: When report_changes_only is enabled, all the series are reported
+                once every heartbeat_interval reports, even if their values did not change.
+            fields: A dictionary from metric type (counter, gauge, meter, histogram or timer)
+                to the list of fields to report for the metrics of that type, for example
+                {"timer": ["count", "99_percentile"]}. The types not in the dictionary report
+                the fields in DEFAULT_FIELDS. Only the selected fields are computed, and the
+                histogram and timer snapshots are not taken when no percentile is selected.
+            metric_fields: A list of (pattern, fields) pairs to select the fields of the
+                metrics whose names match a shell-style pattern, for example
+                [("db.*", ["count", "95_percentile"])]. The first matching pattern takes
+                precedence over `fields`, and fields not supported by the type of a metric
+                are skipped for it.
+            align_reports: If True, the reports are scheduled at the multiples of
+                reporting_interval since the epoch, and the points are timestamped with
+                the interval boundary instead of the time of the collection.
+            max_jitter: Maximum number of seconds to delay the aligned reports by, so that
+                hosts started together do not all send at the same time. The delay is
+                derived from the host tag, so it is the same on every report of a host.
+                The timestamps are still the interval boundaries.
+            send_queue_size: If greater than 0, the reporting thread only collects the
+                metrics, and the collected reports are sent by a separate sender thread, so
+                slow sends do not delay the collections. At most send_queue_size reports wait
+                to be sent, the oldest report is dropped when the queue is full. stop() waits
+                up to 10 seconds for the queued reports to be sent.
+            max_series: Maximum number of distinct series reported from the registry. The
+                values of the series over the limit are handled according to series_overflow,
+                and counted in the apptuit.reporter.series.overflow meta metric. The number of
+                series is reported in the apptuit.reporter.series.count meta metric.
+                None (default) means no limit.
+            series_overflow: "drop" to drop the values of the series over max_series, or "fold"
+                to combine them, per metric name, into an overflow series tagged with
+                cardinality_overflow=true. The fields of a metric are admitted or over the
+                limit together. The counts, sums and rates are summed, min and max are
+                combined, and the other fields are not folded.
+            target_batch_bytes: Target size in bytes of the compressed payload of a batch.
+                The points of a report are sent in batches of at most BATCH_SIZE points, sized
+                from the compressed bytes per point of the previous batches. None disables it.
+            target_batch_latency: Target number of seconds for sending a batch, the batches
+                are also sized from the latency of the previous batches. None disables it.
+                The batch size is halved when the server responds with a 413 or 5xx error,
+                and a batch rejected with a 413 is sent again in smaller batches, which are not
+                grown back past that size. The current batch size is reported in the
+                apptuit.reporter.send.batch.size meta metric.
+            collect_gc_metrics: If True, every collection of the garbage collector is timed
+                and the pauses, the number of collections and the collected and uncollectable
+                objects are reported per generation. It requires Python 3.3 or later.
+            lag_sampling_interval: If set, a LagMonitor samples the scheduling lag of a thread
+                every lag_sampling_interval seconds while the reporter is started, and reports
+                it as a histogram. None (default) disables it.
+            event_loop: An asyncio event loop whose lag, tasks and slow callbacks are also
+                sampled by the LagMonitor.
+            profiler_sampling_interval: If set, a StackProfiler samples the functions executed
+                by the threads every profiler_sampling_interval seconds while the reporter is
+                started, and the samples of the most sampled functions are reported on every
+                report. None (default) disables it.
+            collect_linux_process_metrics: If True, the process metrics also include the
+                current memory, open file descriptors, I/O and threads of the process read
+                from /proc/self. It requires collect_process_metrics and Linux.
+            collect_cgroup_metrics: If True, the CPU, memory and I/O usage and limits of the
+                cgroup v2 of the process are reported, without a worker_id tag. With a
+                SharedMetricsRegistry, only the elected process reports them, otherwise
+                enable it in a single process of the cgroup.
         """
         super(ApptuitReporter, self).__init__(registry=registry,
                                               reporting_interval=reporting_interval)
+        if report_changes_only and (not isinstance(heartbeat_interval, int) or
+                                    heartbeat_interval < 1):
+            raise ValueError("heartbeat_interval should be a positive integer, got %r"
+                             % heartbeat_interval)
         self.retry_count = retry_count
         self.endpoint = api_endpoint
         self.token = token
@@ -122,12 +369,109 @@ class ApptuitReporter(Reporter):
                 self.tags = {"host": socket.gethostname()}
         self.prefix = prefix if prefix is not None else ""
         self.client = Apptuit(token=token, api_endpoint=api_endpoint,
-                              ignore_environ_tags=True, sanitize_mode=sanitize_mode)
+                              ignore_environ_tags=True, sanitize_mode=sanitize_mode,
+                              series_table=SeriesTable())
+        self._series_plans = weakref.WeakKeyDictionary()
+        self._series_plans_state = None
+        self._series_plans_lock = threading.Lock()
+        # the names of the series of the pruned series plans, not yet removed from
+        # the caches of the client and the reported values
+        self._evicted_series = []
+        if not 0 <= max_jitter < reporting_interval:
+            raise ValueError("max_jitter should be between 0 and the reporting interval, "
+                             "got %r" % max_jitter)
+        if max_series is not None and max_series < 0:
+            raise ValueError("max_series should be a non-negative integer, got %r" % max_series)
+        if series_overflow not in SERIES_OVERFLOW_POLICIES:
+            raise ValueError("series_overflow should be one of %s, got %r"
+                             % (SERIES_OVERFLOW_POLICIES, series_overflow))
+        self.max_series = max_series
+        self.series_overflow = series_overflow
+        if target_batch_bytes is not None and target_batch_bytes <= 0:
+            raise ValueError("target_batch_bytes should be a positive number, got %r"
+                             % target_batch_bytes)
+        if target_batch_latency is not None and target_batch_latency <= 0:
+            raise ValueError("target_batch_latency should be a positive number, got %r"
+                             % target_batch_latency)
+        self._batch_sizer = _BatchSizer(target_batch_bytes, target_batch_latency)
+        self._send_queue = queue.Queue(send_queue_size) if send_queue_size > 0 else None
+        self._sender_thread = None
+        self.align_reports = align_reports
+        self.report_offset = self._get_report_offset(max_jitter)
+        self.fields = self._validate_fields(fields)
+        self.metric_fields = self._validate_metric_fields(metric_fields)
+        self.report_changes_only = report_changes_only
+        self.heartbeat_interval = heartbeat_interval
+        self._reports_since_heartbeat = 0
+        self._reported_values = {}
         self._meta_metrics_registry = MetricsRegistry()
         self.error_handler = error_handler
         self.process_metrics = None
         if collect_process_metrics:
-            self.process_metrics = ProcessMetrics(self.registry)
+            if collect_linux_process_metrics and not LinuxProcessMetrics.is_supported():
+                warnings.warn("collect_linux_process_metrics requires /proc, which is not "
+                              "available on this system")
+            self.process_metrics = ProcessMetrics(self.registry, collect_linux_process_metrics)
+        elif collect_linux_process_metrics:
+            raise ValueError("collect_linux_process_metrics requires collect_process_metrics")
+        self.lag_monitor = None
+        if lag_sampling_interval is not None:
+            self.lag_monitor = LagMonitor(self.registry, lag_sampling_interval, event_loop)
+        elif event_loop is not None:
+            raise ValueError("event_loop requires lag_sampling_interval")
+        self.stack_profiler = None
+        if profiler_sampling_interval is not None:
+            self.stack_profiler = StackProfiler(self.registry, profiler_sampling_interval)
+        self.gc_metrics = None
+        if collect_gc_metrics:
+            if GCMetrics.is_supported():
+                self.gc_metrics = GCMetrics(self.registry)
+            else:
+                warnings.warn("collect_gc_metrics requires gc.callbacks, which is not available "
+                              "in this version of Python")
+        self.cgroup_metrics = None
+        if collect_cgroup_metrics:
+            if CgroupMetrics.is_supported():
+                # a registry of its own, which is never shared nor aggregated
+                self.cgroup_metrics = CgroupMetrics(MetricsRegistry())
+            else:
+                warnings.warn("collect_cgroup_metrics requires the process to be in a "
+                              "cgroup v2 hierarchy")
+
+    def start(self):
+        started = super(ApptuitReporter, self).start()
+        if started and self._send_queue is not None:
+            self._sender_thread = threading.Thread(target=self._send_loop,
+                                                   name="apptuit reporter sender")
+            self._sender_thread.daemon = True
+            self._sender_thread.start()
+        if started and self.lag_monitor:
+            self.lag_monitor.start()
+        if started and self.stack_profiler:
+            self.stack_profiler.start()
+        return started
+
+    def stop(self):
+        super(ApptuitReporter, self).stop()
+        deadline = _monotonic() + _STOP_TIMEOUT
+        # the files of the collectors are closed once the collection in progress is done
+        if self._loop_thread.is_alive() and self._loop_thread is not threading.current_thread():
+            self._loop_thread.join(_STOP_TIMEOUT)
+        if self._sender_thread is not None:
+            # the sender thread sends the reports still in the queue before exiting,
+            # including the one being collected when the reporter is stopped
+            self._sender_thread.join(max(0, deadline - _monotonic()))
+            self._sender_thread = None
+        if self.lag_monitor:
+            self.lag_monitor.stop()
+        if self.stack_profiler:
+            self.stack_profiler.stop()
+        if self.gc_metrics:
+            self.gc_metrics.close()
+        if self.process_metrics:
+            self.process_metrics.close()
+        if self.cgroup_metrics:
+            self.cgroup_metrics.close()
 
     def _update_counter(self, key, value):
         """
@@ -144,45 +488,173 @@ class ApptuitReporter(Reporter):
             registry: pyformance Registry containing all metrics
             timestamp: timestamp of the data point
         """
+        self._send_report(self._collect_report(registry, timestamp))
+
+    def _collect_report(self, registry=None, timestamp=None):
+        """
+        Collect the data points to report
+        Params:
+            registry: pyformance Registry containing all metrics
+            timestamp: timestamp of the data point
+        Returns:
+            tuple of DataPoints, or None when another process reports the registry
+        """
         if self.process_metrics:
             self.process_metrics.collect_process_metrics()
-        dps = self._collect_data_points(registry or self.registry, timestamp)
-        meta_dps = self._collect_data_points(self._meta_metrics_registry)
-        if not dps:
+        if self.gc_metrics:
+            self.gc_metrics.collect_gc_metrics()
+        if self.stack_profiler:
+            self.stack_profiler.collect_profile_metrics()
+        registry = registry or self.registry
+        if isinstance(registry, SharedMetricsRegistry):
+            if not registry.elect_reporter():
+                return None
+            registry = registry.aggregate()
+        dps = self._collect_data_points(registry, timestamp)
+        if self.cgroup_metrics:
+            # the cgroup is shared by the processes, it is only read by the reporting one
+            self.cgroup_metrics.collect_cgroup_metrics()
+            dps.extend(self._collect_data_points(self.cgroup_metrics.registry, timestamp))
+        # the series are removed from the caches when this report is sent, after
+        # the reports queued before it which may still hold them
+        with self._series_plans_lock:
+            evicted_series, self._evicted_series = self._evicted_series, []
+        return _Report(dps, evicted_series)
+
+    def _enqueue_report(self, dps):
+        """
+        Queue a collected report for the sender thread, dropping the oldest
+        queued report if the queue is full
+        """
+        while True:
+            try:
+                self._send_queue.put_nowait(dps)
+                return
+            except queue.Full:
+                try:
+                    dropped = self._send_queue.get_nowait()
+                    # the series of the dropped report are removed with this report
+                    if getattr(dropped, "evicted_series", None):
+                        dps.evicted_series.extend(dropped.evicted_series)
+                    self._update_counter(NUMBER_OF_DROPPED_REPORTS, 1)
+                except queue.Empty:
+                    pass
+
+    def _send_loop(self):
+        while not (self._stopped.is_set() and self._send_queue.empty()):
+            try:
+                dps = self._send_queue.get(timeout=_SENDER_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            self._meta_metrics_registry.gauge(SEND_QUEUE_DEPTH).set_value(
+                self._send_queue.qsize())
+            try:
+                self._send_report(dps)
+            except Exception:
+                pass
+
+    def _send_report(self, dps):
+        """
+        Send the data points of a report in batches, the points of the meta metrics
+        are sent with the last batch, or alone when the report has no data points
+        Params:
+            dps: sequence of DataPoints, or None when another process reports the registry
+        """
+        evicted_series = getattr(dps, "evicted_series", None)
+        if evicted_series:
+            self.client.forget_series(evicted_series)
+            for name in evicted_series:
+                self._reported_values.pop(name, None)
+        if dps is None:
             return
+        heartbeat = True
+        if self.report_changes_only:
+            heartbeat = self._reports_since_heartbeat == 0
+            self._reports_since_heartbeat = \
+                (self._reports_since_heartbeat + 1) % self.heartbeat_interval
+            if heartbeat:
+                self._reported_values = {}
+            else:
+                dps = self._remove_unchanged(dps)
+        batch_sizer = self._batch_sizer
+        self._meta_metrics_registry.gauge(CURRENT_BATCH_SIZE).set_value(batch_sizer.size)
+        meta_dps = self._collect_data_points(self._meta_metrics_registry)
         dps_len = len(dps)
         success_count = 0
         failed_count = 0
         errors = []
-        for i in range(0, dps_len, BATCH_SIZE):
+        start_index = 0
+        end_index = None
+        while end_index != dps_len:
+            end_index = min(dps_len, start_index + batch_sizer.size)
+            batch = dps[start_index: end_index]
+            points_count = len(batch)
+            if end_index == dps_len:
+                batch = list(batch) + meta_dps
+            if not batch:
+                break
             try:
                 with self._meta_metrics_registry.timer(API_CALL_TIMER).time():
-                    end_index = min(dps_len, i + BATCH_SIZE)
-                    self.client.send(dps[i: end_index], retry_count=self.retry_count)
-                    points_sent_count = end_index - i
-                    self._update_counter(NUMBER_OF_TOTAL_POINTS, points_sent_count)
-                    self._update_counter(NUMBER_OF_SUCCESSFUL_POINTS, points_sent_count)
+                    send_start = _monotonic()
+                    self.client.send(batch, retry_count=self.retry_count)
+                    batch_sizer.update(len(batch), self.client.last_payload_size,
+                                       _monotonic() - send_start)
+                    if self.report_changes_only:
+                        self._update_reported_values(batch[:points_count])
+                    self._update_counter(NUMBER_OF_TOTAL_POINTS, points_count)
+                    self._update_counter(NUMBER_OF_SUCCESSFUL_POINTS, points_count)
                     self._update_counter(NUMBER_OF_FAILED_POINTS, 0)
-                    success_count += points_sent_count
+                    success_count += points_count
             except ApptuitSendException as exception:
-                self._update_counter(NUMBER_OF_SUCCESSFUL_POINTS, exception.success)
-                self._update_counter(NUMBER_OF_FAILED_POINTS, exception.failed)
-                success_count += exception.success
-                failed_count += exception.failed
+                if batch_sizer.back_off(exception.status_code) and exception.status_code == 413:
+                    end_index = None
+                    continue
+                # the meta points are well formed, the failures are counted on the data points
+                failed = min(exception.failed, points_count)
+                success = points_count - failed
+                self._update_counter(NUMBER_OF_SUCCESSFUL_POINTS, success)
+                self._update_counter(NUMBER_OF_FAILED_POINTS, failed)
+                success_count += success
+                failed_count += failed
                 errors += exception.errors
                 if self.error_handler:
                     self.error_handler(
                         exception.status_code,
-                        exception.success,
-                        exception.failed,
+                        success,
+                        failed,
                         exception.errors
                     )
-        self.client.send(meta_dps, retry_count=self.retry_count)
+            start_index = end_index
         if failed_count != 0:
             raise ApptuitSendException("Failed to send %d out of %d points" %
                                        (failed_count, dps_len), success=success_count,
                                        failed=failed_count, errors=errors)
 
+    def _remove_unchanged(self, dps):
+        """
+        Remove the points whose values are the same as the last values successfully
+        sent for their series, and count them as suppressed
+        Params:
+            dps: list of DataPoints
+        Returns:
+            list of the DataPoints that need to be sent
+        """
+        reported_values = self._reported_values
+        changed_dps = [dp for dp in dps
+                       if reported_values.get(dp.timeseries_name, _NOT_REPORTED) != dp.value]
+        self._update_counter(NUMBER_OF_SUPPRESSED_POINTS, len(dps) - len(changed_dps))
+        return changed_dps
+
+    def _update_reported_values(self, dps):
+        """
+        Remember the values of the points sent successfully
+        Params:
+            dps: list of DataPoints
+        """
+        reported_values = self._reported_values
+        for point in dps:
+            reported_values[point.timeseries_name] = point.value
+
     @staticmethod
     def _get_tags(key):
         """
@@ -195,6 +667,114 @@ class ApptuitReporter(Reporter):
         metric_name, metric_tags = TimeSeriesName.decode_metric(key)
         return metric_name, metric_tags
 
+    @staticmethod
+    def _validate_fields(fields):
+        """
+        Validate the fields selected per metric type and merge them with the default fields
+        """
+        selected_fields = dict(DEFAULT_FIELDS)
+        for metric_type, type_fields in (fields or {}).items():
+            if metric_type not in _SUPPORTED_FIELDS:
+                raise ValueError("Unknown metric type %r, expected one of %s"
+                                 % (metric_type, sorted(_SUPPORTED_FIELDS)))
+            unknown_fields = set(type_fields) - set(_SUPPORTED_FIELDS[metric_type])
+            if unknown_fields:
+                raise ValueError("Unknown fields %s for metric type %s"
+                                 % (sorted(unknown_fields), metric_type))
+            selected_fields[metric_type] = tuple(type_fields)
+        return selected_fields
+
+    @staticmethod
+    def _validate_metric_fields(metric_fields):
+        """
+        Validate the fields selected per metric name pattern
+        """
+        if isinstance(metric_fields, dict):
+            metric_fields = metric_fields.items()
+        known_fields = set(_METRIC_GETTERS).union(_SNAPSHOT_GETTERS)
+        patterns = []
+        for pattern, pattern_fields in metric_fields or ():
+            unknown_fields = set(pattern_fields) - known_fields
+            if unknown_fields:
+                raise ValueError("Unknown fields %s for metric pattern %s"
+                                 % (sorted(unknown_fields), pattern))
+            patterns.append((pattern, tuple(pattern_fields)))
+        return patterns
+
+    def _get_series_plans(self, registry):
+        """
+        Get the cached series plans of the metrics of a registry, keyed by registry key.
+        The cache is dropped when the prefix, the reporter tags or the fields change, and
+        the keys no longer in the registry are removed from it.
+        """
+        registry_metrics = [getattr(registry, attr) for _, attr in _REGISTRY_METRICS]
+        state = (self.prefix, dict(self.tags) if self.tags else None,
+                 dict(self.fields), list(self.metric_fields))
+        if state != self._series_plans_state:
+            for plans_registry, series_plans in list(self._series_plans.items()):
+                if plans_registry is not self._meta_metrics_registry:
+                    for series_plan in series_plans.values():
+                        self._evicted_series.extend(series_plan.names.values())
+            self._series_plans.clear()
+            self._series_plans_state = state
+        series_plans = self._series_plans.get(registry)
+        if series_plans is None:
+            series_plans = _SeriesPlans()
+            self._series_plans[registry] = series_plans
+        else:
+            # compare the keys rather than their counts, a key removed and replaced by
+            # another one since the previous report must release its series
+            for key in list(series_plans):
+                if not any(key in metrics for metrics in registry_metrics):
+                    names = series_plans.pop(key).names
+                    series_plans.series_count -= len(names)
+                    if registry is not self._meta_metrics_registry:
+                        self._evicted_series.extend(names.values())
+        return series_plans
+
+    def _get_overflow_name(self, series_plans, metric):
+        """
+        Get the name of the series the values over the max_series limit are folded into
+        """
+        name = series_plans.overflow_names.get(metric)
+        if name is None:
+            tags = dict(self.tags) if self.tags else {}
+            tags[OVERFLOW_TAG] = "true"
+            name = TimeSeriesName(metric, tags)
+            series_plans.overflow_names[metric] = name
+        return name
+
+    def _create_series_plan(self, key):
+        """
+        Decode a registry key into the prefix of the metric names to report its values
+        with and the reporter tags merged with the metric tags
+        """
+        metric_name, metric_tags = self._get_tags(key)
+        global_tags = self.tags if self.tags else {}
+        if metric_tags and global_tags:
+            tags = global_tags.copy()
+            tags.update(metric_tags)
+        elif metric_tags:
+            tags = metric_tags
+        else:
+            tags = global_tags
+        return _SeriesPlan(metric_name, self.prefix + metric_name + '.', tags)
+
+    def _get_fields(self, metric_type, metric_name):
+        """
+        Get the fields to report for a metric, as tuples of the field name,
+        the function computing it and whether it is computed from a snapshot
+        """
+        for pattern, pattern_fields in self.metric_fields:
+            if fnmatchcase(metric_name, pattern):
+                type_fields = [field for field in pattern_fields
+                               if field in _SUPPORTED_FIELDS[metric_type]]
+                break
+        else:
+            type_fields = self.fields[metric_type]
+        return [(field, _SNAPSHOT_GETTERS[field], True) if field in _SNAPSHOT_GETTERS
+                else (field, _METRIC_GETTERS[field], False) for field in type_fields]
+
     def _collect_data_points(self, registry, timestamp=None):
         """
         will collect all metrics from registry and convert them to DataPoints
@@ -205,32 +785,130 @@ class ApptuitReporter(Reporter):
             list of DataPoints
         """
         timestamp = timestamp or int(round(self.clock.time()))
-        metrics = registry.dump_metrics()
-        dps = []
-        global_tags = self.tags if self.tags else {}
-        for key in metrics.keys():
-            metric_name, metric_tags = self._get_tags(key)
-            if metric_tags and global_tags:
-                tags = global_tags.copy()
-                tags.update(metric_tags)
-            elif metric_tags:
-                tags = metric_tags
-            else:
-                tags = global_tags
-            for value_key in metrics[key].keys():
-                data_point = DataPoint(
-                    metric=self.prefix + metric_name + '.' + value_key,
-                    tags=tags, timestamp=timestamp, value=metrics[key][value_key])
-                dps.append(data_point)
-        return dps
+        # with send_queue_size, the sender thread collects the meta metrics while the
+        # reporting thread collects the registry, and both use the series plans
+        with self._series_plans_lock:
+            series_plans = self._get_series_plans(registry)
+            max_series = self.max_series
+            if registry is self._meta_metrics_registry or \
+                    (self.cgroup_metrics and registry is self.cgroup_metrics.registry):
+                max_series = None
+            overflow_count = 0
+            folded_values = {}
+            dps = []
+            for metric_type, attr in _REGISTRY_METRICS:
+                for key, metric in list(getattr(registry, attr).items()):
+                    series_plan = series_plans.get(key)
+                    if series_plan is None:
+                        series_plan = self._create_series_plan(key)
+                        series_plans[key] = series_plan
+                    fields = series_plan.fields.get(metric_type)
+                    if fields is None:
+                        fields = self._get_fields(metric_type, series_plan.metric_name)
+                        series_plan.fields[metric_type] = fields
+                    names = series_plan.names
+                    # all the fields of a metric are admitted under max_series, or none
+                    if not names and max_series is not None and \
+                            series_plans.series_count + len(fields) > max_series:
+                        overflow_count += len(fields)
+                        if self.series_overflow == "fold":
+                            self._fold_fields(series_plan, metric, fields, folded_values)
+                        continue
+                    snapshot = None
+                    for field, getter, from_snapshot in fields:
+                        if from_snapshot:
+                            if snapshot is None:
+                                snapshot = metric.get_snapshot()
+                            value = getter(snapshot)
+                        else:
+                            value = getter(metric)
+                        name = names.get(field)
+                        if name is None:
+                            name = TimeSeriesName(series_plan.metric_prefix + field,
+                                                  series_plan.tags)
+                            names[field] = name
+                            series_plans.series_count += 1
+                        dps.append(DataPoint.from_name(name, timestamp, value))
+            for overflow_metric, value in folded_values.items():
+                dps.append(DataPoint.from_name(
+                    self._get_overflow_name(series_plans, overflow_metric), timestamp, value))
+            if max_series is not None:
+                self._meta_metrics_registry.gauge(NUMBER_OF_SERIES).set_value(
+                    series_plans.series_count)
+                self._update_counter(NUMBER_OF_OVERFLOW_POINTS, overflow_count)
+            return dps
+
+    @staticmethod
+    def _fold_fields(series_plan, metric, fields, folded_values):
+        """
+        Combine the values of the fields of a metric over the max_series limit into
+        the values of the overflow series, by metric name
+        """
+        for field, getter, _ in fields:
+            fold = _FOLDED_FIELDS.get(field)
+            if fold is None:
+                continue
+            # the folded fields are never computed from a snapshot
+            value = getter(metric)
+            overflow_metric = series_plan.metric_prefix + field
+            folded_value = folded_values.get(overflow_metric)
+            folded_values[overflow_metric] = value if folded_value is None \
+                else fold(folded_value, value)
+
+    def _get_report_offset(self, max_jitter):
+        """
+        Get the delay of the aligned reports of this host, between 0 and max_jitter
+        """
+        if not max_jitter:
+            return 0
+        host = (self.tags or {}).get("host") or socket.gethostname()
+        millis = zlib.crc32(str(host).encode("utf-8")) & 0xffffffff
+        return (millis % int(max_jitter * 1000)) / 1000.0
+
+    def _get_next_aligned_report(self, last_timestamp=None):
+        """
+        Get the next interval boundary to report, and the number of seconds to wait
+        before reporting it
+        Params:
+            last_timestamp: The boundary reported last, which is never reported again
+        Returns:
+            timestamp of the boundary, seconds to wait
+        """
+        now = self.clock.time()
+        interval = self.reporting_interval
+        boundary = ((now - self.report_offset) // interval + 1) * interval
+        if last_timestamp is not None and boundary <= last_timestamp:
+            boundary = last_timestamp + interval
+        return int(boundary), boundary + self.report_offset - now
+
+    def _get_next_deadline(self, deadline, now):
+        """
+        Get the monotonic time of the next report after the one scheduled at
+        deadline. If the reports fell behind, the latest missed report is scheduled
+        immediately, and the following ones stay on the original schedule.
+        """
+        deadline += self.reporting_interval
+        if now > deadline:
+            deadline += (now - deadline) // self.reporting_interval * self.reporting_interval
+        return deadline
 
     def _loop(self):
+        deadline = _monotonic()
+        timestamp = None
         while not self._stopped.is_set():
-            start = time.time()
+            if self.align_reports:
+                timestamp, wait_time = self._get_next_aligned_report(timestamp)
+            else:
+                wait_time = deadline - _monotonic()
+            if wait_time > 0 and self._stopped.wait(wait_time):
+                break
             try:
-                self.report_now(self.registry)
+                if self._send_queue is None:
+                    self.report_now(self.registry, timestamp)
+                else:
+                    dps = self._collect_report(self.registry, timestamp)
+                    if dps is not None:
+                        self._enqueue_report(dps)
             except Exception:
                 pass
-            end = time.time()
-            wait_time = max(0, self.reporting_interval-(end-start))
-            time.sleep(wait_time)
+            deadline = self._get_next_deadline(deadline, _monotonic())
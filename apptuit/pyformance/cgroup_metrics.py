@@ -0,0 +1,225 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Container metrics read from the cgroup v2 files of the process.
+
+getrusage only reports the resources used by the process, not the limits of
+its container nor how much it is throttled by them. The cgroup of the process is
+found from /proc/self/cgroup and the cgroup2 mount point in /proc/self/mountinfo,
+the hybrid mode with cgroup v1 hierarchies is not supported.
+As for the /proc files, the cgroup files are opened once and read again from
+their start on every collection. The metrics report the whole cgroup, they are not
+tagged with a worker_id and should be collected by a single process of the cgroup.
+"""
+import os
+
+from apptuit.apptuit_client import TimeSeriesName
+from .linux_process_metrics import PROC_SELF_PATH, _READ_SIZE, _close, _open, _pread
+
+_CPU_FIELDS = ((b"user_usec", "python.cgroup.cpu.seconds", "user", 1e-6),
+               (b"system_usec", "python.cgroup.cpu.seconds", "system", 1e-6),
+               (b"throttled_usec", "python.cgroup.cpu.throttled.seconds", "total", 1e-6),
+               (b"nr_periods", "python.cgroup.cpu.periods", "total", 1),
+               (b"nr_throttled", "python.cgroup.cpu.periods", "throttled", 1))
+MEMORY_EVENTS = ("low", "high", "max", "oom", "oom_kill")
+_IO_FIELDS = ((b"rbytes", "python.cgroup.io.bytes", "read"),
+              (b"wbytes", "python.cgroup.io.bytes", "write"),
+              (b"rios", "python.cgroup.io.operations", "read"),
+              (b"wios", "python.cgroup.io.operations", "write"))
+
+
+def find_cgroup_path(proc_path=PROC_SELF_PATH):
+    """
+    The directory of the cgroup v2 of a process, None if the process is not in a
+    cgroup v2 hierarchy, or also in cgroup v1 hierarchies (the hybrid mode, in which
+    the controllers are usually in the cgroup v1 hierarchies)
+    Params:
+        proc_path: The /proc directory of the process
+    """
+    try:
+        with open(os.path.join(proc_path, "cgroup")) as cgroup_file:
+            cgroups = cgroup_file.read().splitlines()
+        with open(os.path.join(proc_path, "mountinfo")) as mountinfo_file:
+            mounts = mountinfo_file.read().splitlines()
+    except (IOError, OSError):
+        return None
+    cgroup = None
+    for line in cgroups:
+        # the cgroup v2 hierarchy has the id 0 and no controller list
+        if line.startswith("0::"):
+            cgroup = line[3:]
+        elif line:
+            return None
+    if cgroup is None:
+        return None
+    for line in mounts:
+        fields, _, filesystem = line.partition(" - ")
+        if filesystem.split(" ", 1)[0] == "cgroup2":
+            mount_point = fields.split(" ")[4]
+            path = os.path.normpath(os.path.join(mount_point, cgroup.lstrip("/")))
+            # without a cgroup namespace, the cgroup is relative to the root of the host
+            # hierarchy, of which only the cgroup of the container may be mounted
+            if os.path.isdir(path):
+                return path
+            return mount_point
+    return None
+
+
+def _parse_flat_keyed(data):
+    """
+    The values of a file of "key value" lines, by key
+    """
+    values = {}
+    for line in data.splitlines():
+        fields = line.split()
+        if len(fields) == 2:
+            values[fields[0]] = fields[1]
+    return values
+
+
+class CgroupMetrics(object):
+    """
+    Collects the CPU usage and throttling, the memory usage, limit and events and
+    the I/O of the cgroup v2 of the process
+    """
+
+    def __init__(self, registry, cgroup_path=None):
+        """
+        Parameters
+        ----------
+            registry: The MetricsRegistry of the metrics
+            cgroup_path: The directory of the cgroup, by default the cgroup v2 of
+                the process
+        """
+        if cgroup_path is None:
+            cgroup_path = find_cgroup_path()
+            if cgroup_path is None:
+                raise RuntimeError("The process is not in a cgroup v2 hierarchy")
+        self.registry = registry
+        self.cgroup_path = cgroup_path
+        self.cpu_metric_names = dict(
+            (field, self._encode_metric_name(metric_name, metric_type))
+            for field, metric_name, metric_type, _ in _CPU_FIELDS)
+        self.memory_metric_names = dict(
+            (memory_type, self._encode_metric_name("python.cgroup.memory.bytes", memory_type))
+            for memory_type in ("current", "limit"))
+        self.memory_event_metric_names = dict(
+            (event.encode(), self._encode_metric_name("python.cgroup.memory.events", event))
+            for event in MEMORY_EVENTS)
+        self.io_metric_names = dict(
+            (field, self._encode_metric_name(metric_name, io_type))
+            for field, metric_name, io_type in _IO_FIELDS)
+        # the values of the previous collection, by metric name, and the I/O values
+        # by device
+        self.previous_values = {}
+        self.previous_io_values = {}
+        self._fds = dict((name, _open(os.path.join(cgroup_path, name)))
+                         for name in ("cpu.stat", "memory.current", "memory.max",
+                                      "memory.events", "io.stat"))
+
+    @staticmethod
+    def _encode_metric_name(metric_name, metric_type):
+        # every series has a tag, the API rejects the series without tags
+        return TimeSeriesName.encode_metric(metric_name, {"type": metric_type})
+
+    @staticmethod
+    def is_supported(proc_path=PROC_SELF_PATH):
+        """
+        Whether the process is in a cgroup v2 hierarchy whose files can be read
+        """
+        cgroup_path = find_cgroup_path(proc_path)
+        return cgroup_path is not None and \
+            os.access(os.path.join(cgroup_path, "cpu.stat"), os.R_OK)
+
+    def close(self):
+        """
+        Close the files opened by the collector
+        """
+        for fd in self._fds.values():
+            _close(fd)
+        self._fds = dict.fromkeys(self._fds)
+
+    def _read(self, name):
+        fd = self._fds[name]
+        if fd is None:
+            return None
+        return _pread(fd, _READ_SIZE, 0)
+
+    def collect_cgroup_metrics(self):
+        """
+        Collect the metrics of the cgroup
+        """
+        data = self._read("cpu.stat")
+        if data is not None:
+            values = _parse_flat_keyed(data)
+            for field, _, _, scale in _CPU_FIELDS:
+                if field in values:
+                    self._inc_counter(self.cpu_metric_names[field], int(values[field]), scale)
+        data = self._read("memory.current")
+        if data is not None:
+            self._set_gauge(self.memory_metric_names["current"], int(data))
+        data = self._read("memory.max")
+        # the limit is "max" when the memory is not limited
+        if data is not None and data.strip().isdigit():
+            self._set_gauge(self.memory_metric_names["limit"], int(data))
+        data = self._read("memory.events")
+        if data is not None:
+            values = _parse_flat_keyed(data)
+            for event, metric_name in self.memory_event_metric_names.items():
+                if event in values:
+                    self._inc_counter(metric_name, int(values[event]))
+        data = self._read("io.stat")
+        if data is not None:
+            self._collect_io(data)
+
+    def _collect_io(self, data):
+        """
+        Add the I/O of the devices of the io.stat file since the previous collection.
+        The differences are computed per device, so a device which disappears does not
+        decrease the counters.
+        """
+        increments = dict.fromkeys(self.io_metric_names, 0)
+        io_values = {}
+        for line in data.splitlines():
+            # the device followed by key=value pairs
+            fields = line.split()
+            if not fields:
+                continue
+            device = fields[0]
+            previous_values = self.previous_io_values.get(device, {})
+            values = io_values[device] = {}
+            for pair in fields[1:]:
+                key, _, value = pair.partition(b"=")
+                if key in increments:
+                    value = int(value)
+                    values[key] = value
+                    increments[key] += max(0, value - previous_values.get(key, 0))
+        self.previous_io_values = io_values
+        for field, increment in increments.items():
+            self.registry.counter(self.io_metric_names[field]).inc(increment)
+
+    def _inc_counter(self, metric_name, value, scale=1):
+        """
+        Increment a counter by the difference between a total and its previous value,
+        multiplied by scale
+        """
+        previous_value = self.previous_values.get(metric_name, 0)
+        self.registry.counter(metric_name).inc((value - previous_value) * scale)
+        self.previous_values[metric_name] = value
+
+    def _set_gauge(self, metric_name, value):
+        self.registry.gauge(metric_name).set_value(value)
@@ -0,0 +1,125 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Garbage collector pause metrics.
+
+A callback registered in gc.callbacks times every collection. The callback only
+appends the pause to a queue and increments a few integers, the pauses are added
+to the histograms of the registry when the metrics are collected by the reporter,
+outside of the collections.
+"""
+import collections
+import gc
+import os
+import time
+
+from apptuit.apptuit_client import TimeSeriesName
+
+MAX_PENDING_PAUSES = 10000
+_perf_counter = getattr(time, "perf_counter", time.time)
+
+
+class GCMetrics(object):
+    """
+    Collects the number of collections, the collected and uncollectable objects
+    and the pause durations of the garbage collector, per generation
+    """
+
+    def __init__(self, registry, max_pending_pauses=MAX_PENDING_PAUSES, clock=_perf_counter):
+        """
+        Parameters
+        ----------
+            registry: The MetricsRegistry of the metrics
+            max_pending_pauses: Maximum number of pauses kept between two collections of
+                the metrics, the oldest pauses are not added to the histograms beyond it
+            clock: Monotonic clock timing the collections
+        """
+        if not self.is_supported():
+            raise RuntimeError("gc.callbacks is not available in this version of Python")
+        self.pid = os.getpid()
+        self.registry = registry
+        self.clock = clock
+        generations = range(len(gc.get_threshold()))
+        self.collection_metric_names = [
+            TimeSeriesName.encode_metric("python.gc.collections",
+                                         {"generation": str(generation), "worker_id": self.pid})
+            for generation in generations]
+        self.pause_metric_names = [
+            TimeSeriesName.encode_metric("python.gc.pause.seconds",
+                                         {"generation": str(generation), "worker_id": self.pid})
+            for generation in generations]
+        self.object_metric_names = [
+            [TimeSeriesName.encode_metric("python.gc.objects",
+                                          {"type": object_type, "generation": str(generation),
+                                           "worker_id": self.pid})
+             for object_type in ("collected", "uncollectable")]
+            for generation in generations]
+        self._pauses = collections.deque(maxlen=max_pending_pauses)
+        # totals since the callback was registered, only updated by the callback
+        self._collections = [0] * len(generations)
+        self._objects = [[0, 0] for _ in generations]
+        self._previous_collections = list(self._collections)
+        self._previous_objects = [list(objects) for objects in self._objects]
+        self._start_time = None
+        gc.callbacks.append(self._callback)
+
+    @staticmethod
+    def is_supported():
+        """
+        Whether the garbage collector supports callbacks (Python 3.3+)
+        """
+        return hasattr(gc, "callbacks")
+
+    def close(self):
+        """
+        Unregister the callback of the garbage collector
+        """
+        if self._callback in gc.callbacks:
+            gc.callbacks.remove(self._callback)
+
+    def _callback(self, phase, info):
+        if phase == "start":
+            self._start_time = self.clock()
+            return
+        if self._start_time is None:
+            return
+        generation = info["generation"]
+        self._pauses.append((generation, self.clock() - self._start_time))
+        self._start_time = None
+        self._collections[generation] += 1
+        objects = self._objects[generation]
+        objects[0] += info["collected"]
+        objects[1] += info["uncollectable"]
+
+    def collect_gc_metrics(self):
+        """
+        Add the collections since the previous call to the metrics of the registry
+        """
+        pauses = self._pauses
+        while pauses:
+            generation, pause = pauses.popleft()
+            self.registry.histogram(self.pause_metric_names[generation]).add(pause)
+        for generation, count in enumerate(list(self._collections)):
+            self.registry.counter(self.collection_metric_names[generation]).inc(
+                count - self._previous_collections[generation])
+            self._previous_collections[generation] = count
+            objects = list(self._objects[generation])
+            previous_objects = self._previous_objects[generation]
+            for index, value in enumerate(objects):
+                self.registry.counter(self.object_metric_names[generation][index]).inc(
+                    value - previous_objects[index])
+            self._previous_objects[generation] = objects
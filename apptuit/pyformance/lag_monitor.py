@@ -0,0 +1,137 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Scheduling lag monitor.
+
+A sampling thread waits for a fixed interval and measures how late it wakes up,
+which shows how long the threads wait for the GIL and the CPU. Given an asyncio
+event loop, it also schedules a callback on the loop at every sample and measures
+how late the callback runs, which shows how long the loop is blocked.
+"""
+import os
+import threading
+import time
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+from apptuit.apptuit_client import TimeSeriesName
+
+DEFAULT_SAMPLING_INTERVAL = 0.1
+DEFAULT_SLOW_CALLBACK_DURATION = 0.1
+_perf_counter = getattr(time, "perf_counter", time.time)
+
+
+def _all_tasks(loop):
+    if hasattr(asyncio, "all_tasks"):
+        return asyncio.all_tasks(loop)
+    return [task for task in asyncio.Task.all_tasks(loop) if not task.done()]
+
+
+class LagMonitor(object):
+    """
+    Measures the scheduling lag of a sampling thread and, optionally, the lag,
+    the number of tasks and the blocking callbacks of an asyncio event loop
+    """
+
+    def __init__(self, registry, sampling_interval=DEFAULT_SAMPLING_INTERVAL, loop=None,
+                 slow_callback_duration=DEFAULT_SLOW_CALLBACK_DURATION):
+        """
+        Parameters
+        ----------
+            registry: The MetricsRegistry of the metrics
+            sampling_interval: Number of seconds between two samples
+            loop: An optional asyncio event loop to monitor
+            slow_callback_duration: Lag of the event loop, in seconds, above which a
+                sample is counted as a slow callback, i.e. a callback which blocked
+                the loop for at least that long
+        """
+        if sampling_interval <= 0:
+            raise ValueError("sampling_interval should be a positive number of seconds, got %r"
+                             % sampling_interval)
+        self.pid = os.getpid()
+        self.registry = registry
+        self.sampling_interval = sampling_interval
+        self.loop = loop
+        self.slow_callback_duration = slow_callback_duration
+        self.thread_lag_metric_name = TimeSeriesName.encode_metric(
+            "python.scheduler.lag.seconds", {"worker_id": self.pid})
+        self.loop_lag_metric_name = TimeSeriesName.encode_metric(
+            "python.asyncio.loop.lag.seconds", {"worker_id": self.pid})
+        self.task_metric_name = TimeSeriesName.encode_metric(
+            "python.asyncio.tasks", {"worker_id": self.pid})
+        self.slow_callback_metric_name = TimeSeriesName.encode_metric(
+            "python.asyncio.slow.callbacks", {"worker_id": self.pid})
+        self._stopped = threading.Event()
+        self._thread = None
+        self._probe_pending = False
+
+    def start(self):
+        """
+        Start the sampling thread
+        """
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        if self.loop is not None:
+            self.registry.counter(self.slow_callback_metric_name)
+        self._thread = threading.Thread(target=self._sample_loop, name="apptuit lag monitor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the sampling thread
+        """
+        self._stopped.set()
+        thread, self._thread = self._thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _sample_loop(self):
+        interval = self.sampling_interval
+        thread_lag = self.registry.histogram(self.thread_lag_metric_name)
+        start = _perf_counter()
+        # waiting on the event rather than sleeping, so stop() does not wait for a sample
+        while not self._stopped.wait(interval):
+            thread_lag.add(max(0.0, _perf_counter() - start - interval))
+            if self.loop is not None:
+                self._probe_loop()
+            start = _perf_counter()
+
+    def _probe_loop(self):
+        """
+        Schedule a callback on the event loop, unless the previous one did not run yet
+        """
+        if self._probe_pending:
+            return
+        self._probe_pending = True
+        try:
+            self.loop.call_soon_threadsafe(self._loop_callback, _perf_counter())
+        except RuntimeError:
+            # the loop is closed
+            self._probe_pending = False
+
+    def _loop_callback(self, scheduled):
+        lag = _perf_counter() - scheduled
+        self._probe_pending = False
+        self.registry.histogram(self.loop_lag_metric_name).add(lag)
+        if lag >= self.slow_callback_duration:
+            self.registry.counter(self.slow_callback_metric_name).inc()
+        self.registry.gauge(self.task_metric_name).set_value(len(_all_tasks(self.loop)))
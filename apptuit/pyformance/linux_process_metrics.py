@@ -0,0 +1,306 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Process metrics read from the /proc filesystem of Linux.
+
+Unlike getrusage, /proc reports the current memory of the process rather than
+its peak. The files are opened once and read again from their start on every
+collection, so a collection costs one read per file (and per thread for the
+thread states) plus a listing of the fd and task directories. The stat files of
+at most max_task_fds threads are kept open, the others are opened and closed on
+every collection, so the threads do not use up the file descriptors of the process.
+"""
+import os
+import re
+import resource
+import threading
+
+from apptuit.apptuit_client import TimeSeriesName
+
+PROC_SELF_PATH = "/proc/self"
+THREAD_STATES = ("running", "sleeping", "disk_sleep", "stopped", "zombie", "other")
+_THREAD_STATE_CODES = {"R": "running", "S": "sleeping", "I": "sleeping", "D": "disk_sleep",
+                       "T": "stopped", "t": "stopped", "Z": "zombie"}
+_STATUS_MEMORY_FIELDS = (("VmSwap:", "swap"),)
+_IO_FIELDS = (("read_bytes:", "read"), ("write_bytes:", "write"))
+_READ_SIZE = 16384
+DEFAULT_MAX_THREAD_NAMES = 20
+DEFAULT_MAX_TASK_FDS = 64
+OTHER_THREADS_NAME = "other"
+_THREAD_NUMBER_PATTERN = re.compile(r"[-_]\d+")
+
+try:
+    _pread = os.pread
+except AttributeError:
+    def _pread(fd, size, offset):
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+
+def _open(path):
+    try:
+        return os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+
+
+def _close(fd):
+    if fd is not None:
+        os.close(fd)
+
+
+def _parse_stat(data):
+    """
+    The fields of a stat file following the command name, which can contain spaces
+    and parentheses: the field n of proc(5) is at index n - 3
+    """
+    return data[data.rindex(b")") + 2:].split()
+
+
+class LinuxProcessMetrics(object):
+    """
+    Collects the current memory, open file descriptors, I/O bytes, thread
+    states and CPU time per thread name of the process from /proc
+    """
+
+    def __init__(self, registry, proc_path=PROC_SELF_PATH,
+                 max_thread_names=DEFAULT_MAX_THREAD_NAMES, max_task_fds=DEFAULT_MAX_TASK_FDS):
+        """
+        Parameters
+        ----------
+            registry: The MetricsRegistry of the metrics
+            proc_path: The /proc directory of the process
+            max_thread_names: Maximum number of thread names the CPU time is reported for,
+                the CPU time of the threads with other names is reported under the name
+                "other". The numbers following a - or _ in the names of the threads are
+                removed, so the threads of a pool share a name. 0 disables the CPU time
+                per thread name.
+            max_task_fds: Maximum number of stat files of the threads kept open between
+                the collections
+        """
+        self.registry = registry
+        self.proc_path = proc_path
+        self.page_size = resource.getpagesize()
+        self.max_thread_names = max_thread_names
+        self.max_task_fds = max_task_fds
+        self.clock_ticks = float(os.sysconf("SC_CLK_TCK"))
+        self._task_fds = {}
+        self._stat_fd = None
+        self._status_fd = None
+        self._io_fd = None
+        self._reset()
+        self._open_files()
+
+    def _reset(self):
+        """
+        Set the metric names tagged with the pid of the current process, and forget
+        the values of the previous collection, which are those of the parent process
+        after a fork
+        """
+        self.pid = os.getpid()
+        self.memory_metric_names = dict(
+            (memory_type, TimeSeriesName.encode_metric(
+                "python.process.memory.bytes", {"type": memory_type, "worker_id": self.pid}))
+            for memory_type in ("resident", "virtual", "swap"))
+        self.fd_metric_name = TimeSeriesName.encode_metric("python.process.open.fds",
+                                                           {"worker_id": self.pid})
+        self.io_metric_names = dict(
+            (io_type, TimeSeriesName.encode_metric(
+                "python.process.io.bytes", {"type": io_type, "worker_id": self.pid}))
+            for _, io_type in _IO_FIELDS)
+        self.thread_metric_names = dict(
+            (state, TimeSeriesName.encode_metric(
+                "python.process.threads", {"state": state, "worker_id": self.pid}))
+            for state in THREAD_STATES)
+        self.thread_cpu_metric_names = {}
+        self._thread_names = {}
+        self.previous_io_values = {}
+        self.previous_thread_cpu_ticks = {}
+
+    @staticmethod
+    def is_supported(proc_path=PROC_SELF_PATH):
+        """
+        Whether the /proc files of the process can be read
+        """
+        return os.access(os.path.join(proc_path, "stat"), os.R_OK)
+
+    def _open_files(self):
+        self._opened_pid = os.getpid()
+        self._stat_fd = _open(os.path.join(self.proc_path, "stat"))
+        self._status_fd = _open(os.path.join(self.proc_path, "status"))
+        self._io_fd = _open(os.path.join(self.proc_path, "io"))
+
+    def close(self):
+        """
+        Close the files opened by the collector
+        """
+        for fd in [self._stat_fd, self._status_fd, self._io_fd] + list(self._task_fds.values()):
+            _close(fd)
+        self._stat_fd = self._status_fd = self._io_fd = None
+        self._task_fds = {}
+
+    def collect_process_metrics(self):
+        """
+        Collect the metrics of the process
+        """
+        if os.getpid() != self._opened_pid:
+            # /proc/self was resolved when the files were opened, in the parent process
+            self.close()
+            self._reset()
+            self._open_files()
+        if self._stat_fd is not None:
+            fields = _parse_stat(_pread(self._stat_fd, _READ_SIZE, 0))
+            self._set_gauge(self.memory_metric_names["virtual"], int(fields[20]))
+            self._set_gauge(self.memory_metric_names["resident"],
+                            int(fields[21]) * self.page_size)
+        if self._status_fd is not None:
+            self._collect_status(_pread(self._status_fd, _READ_SIZE, 0))
+        if self._io_fd is not None:
+            self._collect_io(_pread(self._io_fd, _READ_SIZE, 0))
+        self._collect_fds()
+        self._collect_thread_states()
+
+    def _collect_status(self, data):
+        for line in data.splitlines():
+            for field, memory_type in _STATUS_MEMORY_FIELDS:
+                if line.startswith(field.encode()):
+                    # the sizes are in kB
+                    self._set_gauge(self.memory_metric_names[memory_type],
+                                    int(line.split()[1]) * 1024)
+
+    def _collect_io(self, data):
+        for line in data.splitlines():
+            for field, io_type in _IO_FIELDS:
+                if line.startswith(field.encode()):
+                    value = int(line.split()[1])
+                    previous_value = self.previous_io_values.get(io_type, 0)
+                    self.registry.counter(self.io_metric_names[io_type]).inc(
+                        value - previous_value)
+                    self.previous_io_values[io_type] = value
+
+    def _collect_fds(self):
+        try:
+            fds = os.listdir(os.path.join(self.proc_path, "fd"))
+        except OSError:
+            return
+        own_fd_count = len(self._task_fds) + len(
+            [fd for fd in (self._stat_fd, self._status_fd, self._io_fd) if fd is not None])
+        if self.proc_path == PROC_SELF_PATH:
+            # the directory listed by os.listdir is open while it is read
+            own_fd_count += 1
+        self._set_gauge(self.fd_metric_name, len(fds) - own_fd_count)
+
+    def _collect_thread_states(self):
+        task_path = os.path.join(self.proc_path, "task")
+        try:
+            task_ids = os.listdir(task_path)
+        except OSError:
+            return
+        cached_task_fds = self._task_fds
+        task_fds = {}
+        counts = dict((state, 0) for state in THREAD_STATES)
+        cpu_ticks = {}
+        for task_id in task_ids:
+            task_fd = cached_task_fds.pop(task_id, None)
+            if task_fd is None:
+                task_fd = _open(os.path.join(task_path, task_id, "stat"))
+                if task_fd is None:
+                    continue
+            try:
+                data = _pread(task_fd, _READ_SIZE, 0)
+            except OSError:
+                # the thread exited since the task directory was listed
+                data = None
+            if data and len(task_fds) < self.max_task_fds:
+                task_fds[task_id] = task_fd
+            else:
+                _close(task_fd)
+            if not data:
+                continue
+            # the state is the field following the command name
+            state_index = data.rindex(b")") + 2
+            state = data[state_index:state_index + 1].decode()
+            counts[_THREAD_STATE_CODES.get(state, "other")] += 1
+            if self.max_thread_names:
+                fields = data[state_index:].split(None, 13)
+                cpu_ticks[task_id] = (int(fields[11]), int(fields[12]), data)
+        # the threads which exited since the previous collection
+        for task_fd in cached_task_fds.values():
+            _close(task_fd)
+        self._task_fds = task_fds
+        for state, count in counts.items():
+            self._set_gauge(self.thread_metric_names[state], count)
+        if self.max_thread_names:
+            self._collect_thread_cpu(cpu_ticks)
+
+    def _collect_thread_cpu(self, cpu_ticks):
+        """
+        Add the CPU time of the threads since the previous collection to the counters
+        of their names
+        Params:
+            cpu_ticks: dict from task id to the user and system CPU ticks and the
+                content of the stat file of the task
+        """
+        thread_names = dict((str(thread.native_id), thread.name)
+                            for thread in threading.enumerate()
+                            if getattr(thread, "native_id", None) is not None)
+        previous_cpu_ticks = self.previous_thread_cpu_ticks
+        cpu_seconds = {}
+        # the oldest threads take the names first when there are too many names
+        for task_id in sorted(cpu_ticks, key=int):
+            user_ticks, system_ticks, data = cpu_ticks[task_id]
+            previous_user_ticks, previous_system_ticks = previous_cpu_ticks.get(task_id, (0, 0))
+            name = thread_names.get(task_id)
+            if name is None:
+                # a thread which was not started by python, or python < 3.8
+                name = data[data.index(b"(") + 1:data.rindex(b")")].decode("utf-8", "replace")
+            name = self._get_thread_name(name)
+            seconds = cpu_seconds.setdefault(name, [0.0, 0.0])
+            seconds[0] += (user_ticks - previous_user_ticks) / self.clock_ticks
+            seconds[1] += (system_ticks - previous_system_ticks) / self.clock_ticks
+        self.previous_thread_cpu_ticks = dict((task_id, ticks[:2])
+                                              for task_id, ticks in cpu_ticks.items())
+        for name, seconds in cpu_seconds.items():
+            user_metric_name, system_metric_name = self.thread_cpu_metric_names[name]
+            self.registry.counter(user_metric_name).inc(seconds[0])
+            self.registry.counter(system_metric_name).inc(seconds[1])
+
+    def _get_thread_name(self, name):
+        """
+        The name the CPU time of a thread is reported under
+        """
+        reported_name = self._thread_names.get(name)
+        if reported_name is not None:
+            return reported_name
+        thread_name = name
+        name = _THREAD_NUMBER_PATTERN.sub("", name)
+        if name not in self.thread_cpu_metric_names:
+            if len(self.thread_cpu_metric_names) >= self.max_thread_names:
+                name = OTHER_THREADS_NAME
+            if name not in self.thread_cpu_metric_names:
+                self.thread_cpu_metric_names[name] = [
+                    TimeSeriesName.encode_metric("python.process.thread.cpu.seconds",
+                                                 {"thread": name, "type": cpu_type,
+                                                  "worker_id": self.pid})
+                    for cpu_type in ("user", "system")]
+        if len(self._thread_names) > 10 * self.max_thread_names:
+            self._thread_names.clear()
+        self._thread_names[thread_name] = name
+        return name
+
+    def _set_gauge(self, metric_name, value):
+        self.registry.gauge(metric_name).set_value(value)
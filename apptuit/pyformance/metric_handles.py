@@ -0,0 +1,55 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Metric objects of a registry resolved once, for the collectors which update
+the same metrics on every collection.
+"""
+
+_REGISTRY_DICTS = {"counter": "_counters", "gauge": "_gauges", "histogram": "_histograms"}
+
+
+class MetricHandles(object):
+    """
+    The metrics of a given type of a registry, by name. The metrics are looked up
+    in the registry once, and again only when the registry no longer holds them,
+    e.g. after registry.clear().
+    """
+
+    def __init__(self, registry, metric_type, names):
+        """
+        Parameters
+        ----------
+            registry: The MetricsRegistry of the metrics
+            metric_type: counter, gauge or histogram
+            names: The names of the metrics
+        """
+        self.registry = registry
+        self.metric_type = metric_type
+        self.names = list(names)
+        self._metrics = None
+
+    def get(self):
+        """
+        The list of the metrics, in the order of their names
+        """
+        metrics = self._metrics
+        if metrics is None or \
+                getattr(self.registry, _REGISTRY_DICTS[self.metric_type]).get(
+                    self.names[0]) is not metrics[0]:
+            get_metric = getattr(self.registry, self.metric_type)
+            metrics = self._metrics = [get_metric(name) for name in self.names]
+        return metrics
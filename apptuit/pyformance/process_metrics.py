@@ -21,8 +21,11 @@ import gc
 import os
 import resource
 import threading
+from operator import attrgetter
 
 from apptuit.apptuit_client import TimeSeriesName
+from .linux_process_metrics import LinuxProcessMetrics
+from .metric_handles import MetricHandles
 
 RESOURCE_STRUCT_RUSAGE = ["ru_utime", "ru_stime",
                           "ru_maxrss", "ru_ixrss",
@@ -35,48 +38,69 @@ RESOURCE_STRUCT_RUSAGE = ["ru_utime", "ru_stime",
                           ]
 
 
+_get_rusage_values = attrgetter(*RESOURCE_STRUCT_RUSAGE)
+# ru_maxrss, ru_ixrss, ru_idrss and ru_isrss are in kilobytes
+_RUSAGE_SCALES = [1, 1, 1024, 1024, 1024, 1024] + [1] * (len(RESOURCE_STRUCT_RUSAGE) - 6)
+
+
 class ProcessMetrics(object):
 
-    def __init__(self, registry):
+    def __init__(self, registry, collect_linux_metrics=False):
+        """
+        Parameters
+        ----------
+            registry: The MetricsRegistry of the metrics
+            collect_linux_metrics: If True and /proc is available, the metrics read from
+                /proc/self by LinuxProcessMetrics are also collected
+        """
         self.pid = os.getpid()
         self.registry = registry
         self.resource_metric_names = self._get_resource_metic_names()
         self.thread_metrics_names = self._get_thread_metic_names()
         self.gc_metric_names = self._get_gc_metric_names()
+        self.resource_counters = MetricHandles(registry, "counter", self.resource_metric_names)
+        self.thread_gauges = MetricHandles(registry, "gauge", self.thread_metrics_names)
+        self.gc_counters = MetricHandles(registry, "counter", self.gc_metric_names)
+        # the values of the previous collection, the counters are incremented by the differences
         self.previous_resource_metrics = [0] * len(self.resource_metric_names)
         self.previous_gc_metrics = [0] * len(self.gc_metric_names)
+        self.linux_process_metrics = None
+        if collect_linux_metrics and LinuxProcessMetrics.is_supported():
+            self.linux_process_metrics = LinuxProcessMetrics(registry)
+
+    def close(self):
+        """
+        Close the files opened to collect the metrics
+        """
+        if self.linux_process_metrics:
+            self.linux_process_metrics.close()
 
     def collect_process_metrics(self):
         """
         To collect all the process metrics.
         """
-        rm = resource.getrusage(resource.RUSAGE_SELF)
-        resource_metrics = {}
-        for res_name in RESOURCE_STRUCT_RUSAGE:
-            resource_metrics[res_name] = getattr(rm, res_name)
-        for res_name in RESOURCE_STRUCT_RUSAGE[2:6]:
-            resource_metrics[res_name] = resource_metrics[res_name] * 1024
-        resource_metrics = [cur_val - pre_val
-                            for cur_val, pre_val in
-                            zip([resource_metrics[key]
-                                 for key in resource_metrics], self.previous_resource_metrics)]
-        self._collect_counter_from_list(self.resource_metric_names, resource_metrics)
+        resource_metrics = [value * scale for value, scale in
+                            zip(_get_rusage_values(resource.getrusage(resource.RUSAGE_SELF)),
+                                _RUSAGE_SCALES)]
+        self._collect_counter_from_list(self.resource_counters, resource_metrics,
+                                        self.previous_resource_metrics)
+        self.previous_resource_metrics = resource_metrics
+        daemon_count = dummy_count = 0
         th_values = threading.enumerate()
-        thread_metrics = [
-            [t.daemon is True for t in th_values].count(True),
-            [t.daemon is False for t in th_values].count(True),
-            [isinstance(t, threading._DummyThread) for t in th_values].count(True)
-        ]
-        self._collect_gauge_from_list(self.thread_metrics_names, thread_metrics)
+        for thread in th_values:
+            if thread.daemon:
+                daemon_count += 1
+            if isinstance(thread, threading._DummyThread):
+                dummy_count += 1
+        thread_metrics = [daemon_count, len(th_values) - daemon_count, dummy_count]
+        self._collect_gauge_from_list(self.thread_gauges, thread_metrics)
         if gc.isenabled():
-            collection = list(gc.get_count())
-            threshold = list(gc.get_threshold())
-            gc_metrics = collection + threshold
-            gc_metrics = [cur_val - pre_val
-                          for cur_val, pre_val in zip(gc_metrics, self.previous_gc_metrics)]
-            self._collect_counter_from_list(self.gc_metric_names, gc_metrics)
+            gc_metrics = list(gc.get_count() + gc.get_threshold())
+            self._collect_counter_from_list(self.gc_counters, gc_metrics,
+                                            self.previous_gc_metrics)
             self.previous_gc_metrics = gc_metrics
-        self.previous_resource_metrics = resource_metrics
+        if self.linux_process_metrics:
+            self.linux_process_metrics.collect_process_metrics()
 
     def _get_gc_metric_names(self):
         """
@@ -133,10 +157,10 @@ class ProcessMetrics(object):
             TimeSeriesName.encode_metric("python.memory.usage.bytes",
                                          {"type": "unshared_stack_size",
                                           "worker_id": self.pid, }),
-            TimeSeriesName.encode_metric("python.page.faults",
-                                         {"type": "major", "worker_id": self.pid, }),
             TimeSeriesName.encode_metric("python.page.faults",
                                          {"type": "minor", "worker_id": self.pid, }),
+            TimeSeriesName.encode_metric("python.page.faults",
+                                         {"type": "major", "worker_id": self.pid, }),
             TimeSeriesName.encode_metric("python.process.swaps",
                                          {"worker_id": self.pid, }),
             TimeSeriesName.encode_metric("python.block.operations",
@@ -156,22 +180,25 @@ class ProcessMetrics(object):
         ]
         return resource_metric_names
 
-    def _collect_counter_from_list(self, metric_names, metric_values):
+    @staticmethod
+    def _collect_counter_from_list(counters, metric_values, previous_values):
         """
-        To increment list of counters `metric_names` with values `metric_values`.
-        :param metric_names: A list of counter names.
-        :param metric_values: A list of corresponding value to increment.
+        To increment a list of counters by the differences between their values and
+        the values of the previous collection.
+        :param counters: The MetricHandles of the counters.
+        :param metric_values: A list of the current values of the counters.
+        :param previous_values: A list of the values of the previous collection.
         """
-        for ind, metric_value in enumerate(metric_values):
-            metric_counter = self.registry.counter(metric_names[ind])
-            metric_counter.inc(metric_value)
+        for counter, metric_value, previous_value in zip(counters.get(), metric_values,
+                                                         previous_values):
+            counter.inc(metric_value - previous_value)
 
-    def _collect_gauge_from_list(self, metric_names, metric_values):
+    @staticmethod
+    def _collect_gauge_from_list(gauges, metric_values):
         """
-        To increment list of gauge `metric_names` with values `metric_values`.
-        :param metric_names: A list of gauge names.
+        To set a list of gauges to `metric_values`.
+        :param gauges: The MetricHandles of the gauges.
         :param metric_values: A list of corresponding value to set.
         """
-        for ind, metric in enumerate(metric_values):
-            metric_counter = self.registry.gauge(metric_names[ind])
-            metric_counter.set_value(metric)
+        for gauge, metric_value in zip(gauges.get(), metric_values):
+            gauge.set_value(metric_value)
@@ -0,0 +1,737 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Shared memory registry, to aggregate the metrics of the worker processes of
+prefork servers (gunicorn, uwsgi) and report them from a single process.
+
+Every process writes the values of its metrics to its own memory mapped file,
+named after its pid, in a directory shared by all the processes. The files are
+only written by their process, so updating a metric only takes a thread lock, and
+the registries of a directory created in the same process share its file.
+The reporting process reads all the files and aggregates their values. It also
+merges the counters and histograms of the processes which exited into a single
+file and removes their files, so the directory does not grow as workers are
+replaced.
+"""
+import errno
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from bisect import bisect_left
+from math import sqrt
+
+from pyformance import MetricsRegistry
+from pyformance.meters import Gauge
+from pyformance.meters.timer import TimerContext
+from pyformance.stats.snapshot import Snapshot
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SHARED_METRICS_DIR = "APPTUIT_SHARED_METRICS_DIR"
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+GAUGE_MODES = ("last", "sum", "min", "max")
+
+_INITIAL_FILE_SIZE = 64 * 1024
+_FILE_SUFFIX = ".db"
+_LOCK_FILE_NAME = "reporter.lock"
+_MERGED_FILE_NAME = "merged" + _FILE_SUFFIX
+_HEADER = struct.Struct("<Q")
+_ENTRY_HEADER = struct.Struct("<II")
+_VALUE = struct.Struct("<d")
+# count, sum, sum of squares, min, max, followed by the bucket counts
+_HISTOGRAM_STATS = 5
+# the metric files of this process by directory and pid, shared by the registries
+# of a directory, which would otherwise overwrite the entries of each other
+_metrics_files = {}
+_metrics_files_lock = threading.Lock()
+
+
+def _padded_length(length):
+    return (length + 7) & ~7
+
+
+def _iter_entries(buf, used):
+    """
+    Iterate over the entries of a metrics file
+    Params:
+        buf: contents of the file
+        used: number of bytes used by the entries, from the file header
+    Returns:
+        iterator of tuples of the key of the entry, the offset of its values
+        and the number of values
+    """
+    offset = _HEADER.size
+    while offset < used:
+        key_length, values_count = _ENTRY_HEADER.unpack_from(buf, offset)
+        key_offset = offset + _ENTRY_HEADER.size
+        values_offset = key_offset + _padded_length(key_length)
+        yield bytes(buf[key_offset:key_offset + key_length]), values_offset, values_count
+        offset = values_offset + _VALUE.size * values_count
+
+
+def _read_entries(path):
+    """
+    Read the entries of a metrics file
+    Returns:
+        list of tuples of the key of the entry and its values
+    """
+    with open(path, "rb") as metrics_file:
+        buf = metrics_file.read()
+    if len(buf) < _HEADER.size:
+        return []
+    used = min(_HEADER.unpack_from(buf, 0)[0], len(buf))
+    return [(key, struct.unpack_from("<%dd" % values_count, buf, values_offset))
+            for key, values_offset, values_count in _iter_entries(buf, used)]
+
+
+def _write_entries(path, entries):
+    """
+    Write the entries of a metrics file, replacing the file atomically
+    Params:
+        entries: iterable of tuples of the key of the entry and its values
+    """
+    chunks = [None]
+    used = _HEADER.size
+    for key, values in entries:
+        chunk = b"".join((_ENTRY_HEADER.pack(len(key), len(values)), key,
+                          b"\0" * (_padded_length(len(key)) - len(key)),
+                          struct.pack("<%dd" % len(values), *values)))
+        chunks.append(chunk)
+        used += len(chunk)
+    chunks[0] = _HEADER.pack(used)
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as metrics_file:
+        metrics_file.write(b"".join(chunks))
+    os.rename(temporary_path, path)
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+
+class _MetricsFile(object):
+    """
+    The memory mapped file holding the metric values of the current process
+    """
+
+    def __init__(self, path):
+        self.pid = os.getpid()
+        self.path = path
+        self.lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self._fd).st_size
+        if size < _INITIAL_FILE_SIZE:
+            os.ftruncate(self._fd, _INITIAL_FILE_SIZE)
+            size = _INITIAL_FILE_SIZE
+        self.mmap = mmap.mmap(self._fd, size)
+        self._used = _HEADER.unpack_from(self.mmap, 0)[0] or _HEADER.size
+        self._offsets = dict((key, values_offset) for key, values_offset, _
+                             in _iter_entries(self.mmap, self._used))
+
+    def get_offset(self, key, initial_values):
+        """
+        Get the offset of the values of a key, adding an entry with the
+        initial values if the key is not in the file yet. The file header is
+        updated after the entry is written, so readers never see partial entries.
+        Must be called with the lock held.
+        """
+        values_offset = self._offsets.get(key)
+        if values_offset is not None:
+            return values_offset
+        entry_offset = self._used
+        values_offset = entry_offset + _ENTRY_HEADER.size + _padded_length(len(key))
+        end = values_offset + _VALUE.size * len(initial_values)
+        if end > len(self.mmap):
+            self._grow(end)
+        _ENTRY_HEADER.pack_into(self.mmap, entry_offset, len(key), len(initial_values))
+        key_offset = entry_offset + _ENTRY_HEADER.size
+        self.mmap[key_offset:key_offset + len(key)] = key
+        struct.pack_into("<%dd" % len(initial_values), self.mmap, values_offset,
+                         *initial_values)
+        self._used = end
+        _HEADER.pack_into(self.mmap, 0, end)
+        self._offsets[key] = values_offset
+        return values_offset
+
+    def _grow(self, min_size):
+        size = len(self.mmap)
+        while size < min_size:
+            size *= 2
+        os.ftruncate(self._fd, size)
+        # The previous mapping is left to the garbage collector, as other threads
+        # may still be writing through it. Both map the same pages of the file.
+        self.mmap = mmap.mmap(self._fd, size)
+
+
+def _get_metrics_file(path):
+    """
+    Get the metric file of the current process in a directory, opening it on the
+    first call in the process, or when the file was removed since
+    """
+    pid = os.getpid()
+    file_key = (os.path.realpath(path), pid)
+    with _metrics_files_lock:
+        metrics_file = _metrics_files.get(file_key)
+        if metrics_file is None or not os.path.exists(metrics_file.path):
+            # the files of the parent process, inherited through a fork
+            for inherited_key in [key for key in _metrics_files if key[1] != pid]:
+                del _metrics_files[inherited_key]
+            metrics_file = _MetricsFile(os.path.join(path, "%d%s" % (pid, _FILE_SUFFIX)))
+            _metrics_files[file_key] = metrics_file
+    return metrics_file
+
+
+class _SharedMetric(object):
+    """
+    Base class of the metrics whose values are kept in the file of the process
+    """
+
+    def __init__(self, registry, key):
+        self.lock = threading.Lock()
+        self._registry = registry
+        self._key = key
+        self._file = None
+        self._offset = None
+
+    def _initial_values(self):
+        raise NotImplementedError()
+
+    def _get_buffer(self):
+        """
+        Get the memory map and the offset of the values of the metric, in the
+        file of the current process, which changes when the process forks.
+        """
+        metrics_file = self._registry._get_file()
+        if metrics_file is not self._file:
+            self._offset = self._registry._get_offset(metrics_file, self._key,
+                                                      self._initial_values())
+            self._file = metrics_file
+        return metrics_file.mmap, self._offset
+
+
+class SharedCounter(_SharedMetric):
+    """
+    A counter whose count is aggregated across processes by summing it
+    """
+
+    def _initial_values(self):
+        return (0.0,)
+
+    def inc(self, val=1):
+        "increment counter by val (default is 1)"
+        with self.lock:
+            buf, offset = self._get_buffer()
+            _VALUE.pack_into(buf, offset, _VALUE.unpack_from(buf, offset)[0] + val)
+
+    def dec(self, val=1):
+        "decrement counter by val (default is 1)"
+        self.inc(-val)
+
+    def get_count(self):
+        "return the count of the current process"
+        buf, offset = self._get_buffer()
+        return _VALUE.unpack_from(buf, offset)[0]
+
+    def clear(self):
+        "reset the count of the current process to 0"
+        with self.lock:
+            buf, offset = self._get_buffer()
+            _VALUE.pack_into(buf, offset, 0.0)
+
+
+class SharedMeter(SharedCounter):
+    """
+    A meter counting the events across processes. Only the count is shared,
+    so it is reported as a counter, without rates.
+    """
+
+    def mark(self, value=1):
+        "mark the occurrence of value events"
+        self.inc(value)
+
+
+class SharedGauge(_SharedMetric, Gauge):
+    """
+    A gauge whose value is aggregated across the live processes
+    according to the gauge mode of the registry
+    """
+
+    def __init__(self, registry, key, default=float("nan")):
+        super(SharedGauge, self).__init__(registry, key)
+        self._default = default
+
+    def _initial_values(self):
+        return (self._default, 0.0)
+
+    def set_value(self, value):
+        "set the value of the gauge in the current process"
+        with self.lock:
+            buf, offset = self._get_buffer()
+            struct.pack_into("<2d", buf, offset, value, time.time())
+
+    def get_value(self):
+        "return the value of the gauge in the current process"
+        buf, offset = self._get_buffer()
+        return _VALUE.unpack_from(buf, offset)[0]
+
+
+class BucketSnapshot(Snapshot):
+    """
+    Snapshot of the bucket counts of a shared histogram. The percentiles are
+    interpolated linearly within the bucket they fall in.
+    """
+
+    def __init__(self, buckets, counts, minimum, maximum):
+        super(BucketSnapshot, self).__init__(())
+        self.buckets = buckets
+        self.counts = counts
+        self.minimum = minimum
+        self.maximum = maximum
+        self.size = int(sum(counts))
+
+    def get_size(self):
+        return self.size
+
+    def get_percentile(self, percentile):
+        if percentile < 0 or percentile > 1:
+            raise ValueError("{0} is not in [0..1]".format(percentile))
+        if self.size == 0:
+            return 0.0
+        rank = percentile * self.size
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if not count or cumulative + count < rank:
+                cumulative += count
+                continue
+            lower = self.buckets[index - 1] if index > 0 else self.minimum
+            upper = self.buckets[index] if index < len(self.buckets) else self.maximum
+            lower = max(lower, self.minimum)
+            upper = min(upper, self.maximum)
+            return lower + (upper - lower) * (rank - cumulative) / count
+        return self.maximum
+
+
+class _HistogramStats(object):
+    """
+    Statistics of a histogram from its count, sum, sum of squares,
+    min, max and bucket counts
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+
+    def _get_stats(self):
+        raise NotImplementedError()
+
+    def get_count(self):
+        return self._get_stats()[0]
+
+    def get_sum(self):
+        return self._get_stats()[1]
+
+    def get_min(self):
+        stats = self._get_stats()
+        return stats[3] if stats[0] else 0
+
+    def get_max(self):
+        stats = self._get_stats()
+        return stats[4] if stats[0] else 0
+
+    def get_mean(self):
+        stats = self._get_stats()
+        return stats[1] / stats[0] if stats[0] else 0
+
+    def get_var(self):
+        stats = self._get_stats()
+        count = stats[0]
+        if count <= 1:
+            return 0
+        return max(0.0, (stats[2] - stats[1] * stats[1] / count) / (count - 1))
+
+    def get_stddev(self):
+        return sqrt(self.get_var())
+
+    def get_snapshot(self):
+        stats = self._get_stats()
+        return BucketSnapshot(self.buckets, stats[_HISTOGRAM_STATS:], stats[3], stats[4])
+
+
+class SharedHistogram(_SharedMetric, _HistogramStats):
+    """
+    A histogram counting the values per bucket, which can be summed across processes
+    """
+
+    def __init__(self, registry, key, buckets):
+        _SharedMetric.__init__(self, registry, key)
+        _HistogramStats.__init__(self, buckets)
+        self._values_format = struct.Struct("<%dd" % (_HISTOGRAM_STATS + len(buckets) + 1))
+
+    def _initial_values(self):
+        return (0.0, 0.0, 0.0, float("inf"), float("-inf")) + (0.0,) * (len(self.buckets) + 1)
+
+    def _get_stats(self):
+        buf, offset = self._get_buffer()
+        return self._values_format.unpack_from(buf, offset)
+
+    def add(self, value):
+        "add a value to the histogram"
+        bucket_offset = _VALUE.size * (_HISTOGRAM_STATS + bisect_left(self.buckets, value))
+        with self.lock:
+            buf, offset = self._get_buffer()
+            count, total, squares, minimum, maximum = struct.unpack_from("<5d", buf, offset)
+            struct.pack_into("<5d", buf, offset, count + 1, total + value,
+                             squares + value * value, min(minimum, value), max(maximum, value))
+            bucket_offset += offset
+            _VALUE.pack_into(buf, bucket_offset, _VALUE.unpack_from(buf, bucket_offset)[0] + 1)
+
+    def clear(self):
+        "reset the histogram of the current process"
+        with self.lock:
+            buf, offset = self._get_buffer()
+            self._values_format.pack_into(buf, offset, *self._initial_values())
+
+
+class SharedTimer(SharedHistogram):
+    """
+    A timer keeping the durations in a shared histogram. It is reported
+    as a histogram of the durations, without rates.
+    """
+    threshold = None
+
+    def __init__(self, registry, key, buckets, clock=time):
+        super(SharedTimer, self).__init__(registry, key, buckets)
+        self.clock = clock
+
+    def _update(self, seconds):
+        if seconds >= 0:
+            self.add(seconds)
+
+    def time(self, *args, **kwargs):
+        """
+        Returns a timer context instance which can be used from a with-statement.
+        Without with-statement you have to call the stop method on the context
+        """
+        return TimerContext(self, self.clock, *args, **kwargs)
+
+
+class _AggregatedCounter(object):
+    def __init__(self, count):
+        self.count = count
+
+    def get_count(self):
+        return self.count
+
+
+class _AggregatedGauge(Gauge):
+    def __init__(self, value):
+        super(_AggregatedGauge, self).__init__()
+        self.value = value
+
+    def get_value(self):
+        return self.value
+
+
+class _AggregatedHistogram(_HistogramStats):
+    def __init__(self, buckets, stats):
+        super(_AggregatedHistogram, self).__init__(buckets)
+        self.stats = stats
+
+    def _get_stats(self):
+        return self.stats
+
+
+class _AggregatedRegistry(object):
+    """
+    Registry holding the metrics aggregated across processes, in the layout of
+    a pyformance MetricsRegistry. Shared timers are held as histograms and shared
+    meters as counters.
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._meters = {}
+        self._timers = {}
+
+
+class SharedMetricsRegistry(MetricsRegistry):
+    """
+    A MetricsRegistry whose counters, gauges, histograms, meters and timers are
+    kept in shared memory, so that the metrics of all the processes using the same
+    directory can be aggregated and reported by a single elected process.
+    """
+
+    def __init__(self, path=None, buckets=DEFAULT_BUCKETS, gauge_mode="last", clock=time):
+        """
+        Parameters
+        ----------
+            path: Directory holding the metric files of the processes. If None,
+                it is read from the APPTUIT_SHARED_METRICS_DIR environment variable.
+                The directory should be emptied when the server starts, as the
+                counts of the previous processes are aggregated with the current ones.
+            buckets: Sorted upper bounds of the buckets of the histograms and timers
+            gauge_mode: How the values of a gauge are aggregated across the live processes,
+                one of "last" (the most recently set value), "sum", "min" or "max"
+            clock: Clock of the timers
+        """
+        super(SharedMetricsRegistry, self).__init__(clock=clock)
+        path = path or os.environ.get(SHARED_METRICS_DIR)
+        if not path:
+            raise ValueError("Directory of the shared metrics not set, pass a path "
+                             "or set the %s environment variable" % SHARED_METRICS_DIR)
+        if gauge_mode not in GAUGE_MODES:
+            raise ValueError("gauge_mode should be one of %s, got %r" % (GAUGE_MODES, gauge_mode))
+        if not buckets or list(buckets) != sorted(buckets):
+            raise ValueError("buckets should be a non-empty sorted sequence")
+        try:
+            os.makedirs(path)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        self.path = path
+        self.buckets = tuple(float(bucket) for bucket in buckets)
+        self.gauge_mode = gauge_mode
+        self._lock = threading.Lock()
+        self._file = None
+        self._reporter_lock_file = None
+        self._reporter_pid = None
+        self._decoded_keys = {}
+        self._aggregated = _AggregatedRegistry()
+
+    def _get_file(self):
+        metrics_file = self._file
+        if metrics_file is None or metrics_file.pid != os.getpid():
+            with self._lock:
+                if self._file is None or self._file.pid != os.getpid():
+                    self._file = _get_metrics_file(self.path)
+                metrics_file = self._file
+        return metrics_file
+
+    def _get_offset(self, metrics_file, key, initial_values):
+        with metrics_file.lock:
+            return metrics_file.get_offset(key, initial_values)
+
+    def _encode_key(self, metric_type, key, option=None):
+        return json.dumps([metric_type, key, option], separators=(",", ":")).encode("utf-8")
+
+    def _decode_key(self, encoded_key):
+        decoded_key = self._decoded_keys.get(encoded_key)
+        if decoded_key is None:
+            decoded_key = tuple(json.loads(encoded_key.decode("utf-8")))
+            self._decoded_keys[encoded_key] = decoded_key
+        return decoded_key
+
+    def counter(self, key):
+        if key not in self._counters:
+            self._counters[key] = SharedCounter(self, self._encode_key("counter", key))
+        return self._counters[key]
+
+    def meter(self, key):
+        if key not in self._meters:
+            self._meters[key] = SharedMeter(self, self._encode_key("meter", key))
+        return self._meters[key]
+
+    def gauge(self, key, gauge=None, default=float("nan")):
+        if key not in self._gauges:
+            if gauge is not None:
+                raise TypeError("Gauges of a SharedMetricsRegistry are set with set_value, "
+                                "custom and callback gauges are not supported")
+            self._gauges[key] = SharedGauge(self, self._encode_key("gauge", key), default)
+        return self._gauges[key]
+
+    def histogram(self, key):
+        if key not in self._histograms:
+            self._histograms[key] = SharedHistogram(
+                self, self._encode_key("histogram", key, self.buckets), self.buckets)
+        return self._histograms[key]
+
+    def timer(self, key):
+        if key not in self._timers:
+            self._timers[key] = SharedTimer(
+                self, self._encode_key("timer", key, self.buckets), self.buckets, self._clock)
+        return self._timers[key]
+
+    def _get_meter_metrics(self, key):
+        if key in self._meters:
+            return {"count": self._meters[key].get_count()}
+        return {}
+
+    def _get_timer_metrics(self, key):
+        if key in self._timers:
+            timer = self._timers[key]
+            snapshot = timer.get_snapshot()
+            return {"avg": timer.get_mean(),
+                    "sum": timer.get_sum(),
+                    "count": timer.get_count(),
+                    "max": timer.get_max(),
+                    "min": timer.get_min(),
+                    "std_dev": timer.get_stddev(),
+                    "50_percentile": snapshot.get_median(),
+                    "75_percentile": snapshot.get_75th_percentile(),
+                    "95_percentile": snapshot.get_95th_percentile(),
+                    "99_percentile": snapshot.get_99th_percentile(),
+                    "999_percentile": snapshot.get_999th_percentile()}
+        return {}
+
+    def elect_reporter(self):
+        """
+        Try to become the process reporting the aggregated metrics, by taking an
+        exclusive lock on a file in the shared directory. The lock is held until the
+        process exits, after which another process can take over.
+        Returns:
+            True if the current process is the reporter
+        """
+        if fcntl is None:
+            return True
+        pid = os.getpid()
+        with self._lock:
+            if self._reporter_pid == pid:
+                return True
+            if self._reporter_lock_file is not None:
+                # The lock file was opened by the parent process, the lock is shared
+                # with it after a fork, so this process needs to open its own.
+                os.close(self._reporter_lock_file)
+            self._reporter_lock_file = os.open(os.path.join(self.path, _LOCK_FILE_NAME),
+                                               os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(self._reporter_lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                return False
+            self._reporter_pid = pid
+            return True
+
+    def aggregate(self):
+        """
+        Aggregate the metrics of all the processes of the shared directory. When
+        called from the elected reporter, the files of the processes which exited
+        are merged into a single file and removed.
+        Returns:
+            registry holding the aggregated metrics, it is the same object
+            on every call and can be passed to a reporter
+        """
+        counters = {}
+        gauges = {}
+        histograms = {}
+        # only the process holding the reporter lock changes the files of the others
+        merge_exited = self._reporter_pid is not None and self._reporter_pid == os.getpid()
+        exited_files = []
+        for file_name in os.listdir(self.path):
+            if not file_name.endswith(_FILE_SUFFIX):
+                continue
+            pid = None
+            if file_name != _MERGED_FILE_NAME:
+                try:
+                    pid = int(file_name[:-len(_FILE_SUFFIX)])
+                except ValueError:
+                    continue
+            try:
+                entries = _read_entries(os.path.join(self.path, file_name))
+            except (IOError, OSError):
+                continue
+            # the merged file only holds the counters and histograms of exited processes
+            alive = False if pid is None else None
+            if merge_exited and pid is not None:
+                alive = _is_alive(pid)
+                if not alive:
+                    exited_files.append((file_name, entries))
+            for encoded_key, values in entries:
+                metric_type, key, option = self._decode_key(encoded_key)
+                if metric_type in ("counter", "meter"):
+                    counters[key] = counters.get(key, 0.0) + values[0]
+                elif metric_type == "gauge":
+                    if alive is None:
+                        alive = _is_alive(pid)
+                    if alive:
+                        gauges.setdefault(key, []).append(values)
+                elif len(values) == _HISTOGRAM_STATS + len(option) + 1:
+                    previous = histograms.get(key)
+                    if previous is not None and previous[0] == option:
+                        values = self._merge_histogram_stats(previous[1], values)
+                    histograms[key] = (option, values)
+        if exited_files:
+            self._merge_exited_files(exited_files)
+        aggregated = self._aggregated
+        aggregated._counters = dict((key, _AggregatedCounter(count))
+                                    for key, count in counters.items())
+        aggregated._gauges = dict((key, _AggregatedGauge(self._aggregate_gauge(values)))
+                                  for key, values in gauges.items())
+        aggregated._histograms = dict((key, _AggregatedHistogram(tuple(buckets), stats))
+                                      for key, (buckets, stats) in histograms.items())
+        return aggregated
+
+    def _merge_exited_files(self, exited_files):
+        """
+        Add the counters and histograms of the files of exited processes to the merged
+        file and remove the files, the gauges of the exited processes are dropped
+        Params:
+            exited_files: list of tuples of the file name and the entries of the files
+        """
+        merged_path = os.path.join(self.path, _MERGED_FILE_NAME)
+        try:
+            merged = dict(_read_entries(merged_path))
+        except (IOError, OSError):
+            merged = {}
+        for _, entries in exited_files:
+            for encoded_key, values in entries:
+                metric_type, _, option = self._decode_key(encoded_key)
+                previous = merged.get(encoded_key)
+                if metric_type == "gauge":
+                    continue
+                if previous is None:
+                    merged[encoded_key] = values
+                elif metric_type in ("counter", "meter"):
+                    merged[encoded_key] = (previous[0] + values[0],)
+                elif len(previous) == len(values) == _HISTOGRAM_STATS + len(option) + 1:
+                    merged[encoded_key] = self._merge_histogram_stats(previous, values)
+        # the merged file is replaced before the exited files are removed, so a failure
+        # in between can count their values twice, but never loses them
+        _write_entries(merged_path, merged.items())
+        for file_name, _ in exited_files:
+            try:
+                os.remove(os.path.join(self.path, file_name))
+            except OSError:
+                pass
+
+    @staticmethod
+    def _merge_histogram_stats(stats, other_stats):
+        merged = [stats[0] + other_stats[0], stats[1] + other_stats[1],
+                  stats[2] + other_stats[2], min(stats[3], other_stats[3]),
+                  max(stats[4], other_stats[4])]
+        merged.extend(count + other_count for count, other_count
+                      in zip(stats[_HISTOGRAM_STATS:], other_stats[_HISTOGRAM_STATS:]))
+        return merged
+
+    def _aggregate_gauge(self, values):
+        if self.gauge_mode == "last":
+            return max(values, key=lambda value: value[1])[0]
+        if self.gauge_mode == "sum":
+            return sum(value[0] for value in values)
+        if self.gauge_mode == "min":
+            return min(value[0] for value in values)
+        return max(value[0] for value in values)
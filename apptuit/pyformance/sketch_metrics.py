@@ -0,0 +1,307 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Sketch based histograms and timers.
+
+The pyformance histograms keep a reservoir of samples per metric and sort it to
+compute the percentiles. The sketch histograms count the values in logarithmic
+buckets instead (DDSketch, https://arxiv.org/abs/1908.10693): every percentile is
+within a relative accuracy of the exact one, with a bounded memory, and sketches
+can be merged.
+"""
+import math
+import threading
+import time
+
+from pyformance import MetricsRegistry
+from pyformance.meters import Histogram, Timer
+from pyformance.stats.snapshot import Snapshot
+
+DEFAULT_RELATIVE_ACCURACY = 0.01
+DEFAULT_MAX_BINS = 2048
+
+
+def _validate_parameters(relative_accuracy, max_bins, window=None):
+    if not 0 < relative_accuracy < 1:
+        raise ValueError("relative_accuracy should be between 0 and 1, got %r"
+                         % relative_accuracy)
+    if max_bins < 1:
+        raise ValueError("max_bins should be a positive integer, got %r" % max_bins)
+    if window is not None and window <= 0:
+        raise ValueError("window should be a positive number of seconds, got %r" % window)
+
+
+class _Store(object):
+    """
+    Counts of the values of a sketch by bucket key. When there are more than
+    max_bins buckets, the lowest buckets are collapsed into one.
+    """
+
+    def __init__(self, max_bins):
+        self.max_bins = max_bins
+        self.bins = {}
+        self.min_key = None
+
+    def add(self, key, count=1):
+        if self.min_key is not None and key < self.min_key:
+            key = self.min_key
+        bins = self.bins
+        bins[key] = bins.get(key, 0) + count
+        if len(bins) > self.max_bins:
+            self._collapse()
+
+    def _collapse(self):
+        keys = sorted(self.bins)
+        excess = len(keys) - self.max_bins
+        self.min_key = keys[excess]
+        self.bins[self.min_key] += sum(self.bins.pop(key) for key in keys[:excess])
+
+    def copy(self):
+        store = _Store(self.max_bins)
+        store.bins = self.bins.copy()
+        store.min_key = self.min_key
+        return store
+
+
+class DDSketch(object):
+    """
+    A quantile sketch with relative accuracy guarantees: the quantiles it returns
+    are within relative_accuracy of the exact quantiles of the values added to it
+    (as long as fewer than max_bins buckets are needed to hold the values).
+    """
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY, max_bins=DEFAULT_MAX_BINS):
+        """
+        Parameters
+        ----------
+            relative_accuracy: Relative accuracy of the quantiles, between 0 and 1
+            max_bins: Maximum number of buckets for the positive values and for
+                the negative values, which bounds the memory used by the sketch
+        """
+        _validate_parameters(relative_accuracy, max_bins)
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._multiplier = 1 / math.log(self.gamma)
+        self.clear()
+
+    def clear(self):
+        self.positive = _Store(self.max_bins)
+        self.negative = _Store(self.max_bins)
+        self.zero_count = 0
+        self.count = 0
+
+    def _key(self, value):
+        return int(math.ceil(math.log(value) * self._multiplier))
+
+    def _value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def add(self, value):
+        """
+        Add a value to the sketch
+        """
+        if value > 0:
+            self.positive.add(self._key(value))
+        elif value < 0:
+            self.negative.add(self._key(-value))
+        else:
+            self.zero_count += 1
+        self.count += 1
+
+    def merge(self, other):
+        """
+        Add the values of another sketch, with the same relative accuracy, to this one
+        """
+        if other.gamma != self.gamma:
+            raise ValueError("Cannot merge sketches with different relative accuracies")
+        for key, count in other.positive.bins.items():
+            self.positive.add(key, count)
+        for key, count in other.negative.bins.items():
+            self.negative.add(key, count)
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def copy(self):
+        sketch = DDSketch.__new__(DDSketch)
+        sketch.__dict__.update(self.__dict__)
+        sketch.positive = self.positive.copy()
+        sketch.negative = self.negative.copy()
+        return sketch
+
+    def get_quantile(self, quantile):
+        """
+        Get an estimate of a quantile of the values, 0 if the sketch is empty
+        """
+        if quantile < 0 or quantile > 1:
+            raise ValueError("{0} is not in [0..1]".format(quantile))
+        if self.count == 0:
+            return 0.0
+        rank = quantile * (self.count - 1)
+        running_count = 0
+        for key in sorted(self.negative.bins, reverse=True):
+            running_count += self.negative.bins[key]
+            if running_count > rank:
+                return -self._value(key)
+        running_count += self.zero_count
+        if running_count > rank:
+            return 0.0
+        keys = sorted(self.positive.bins)
+        for key in keys:
+            running_count += self.positive.bins[key]
+            if running_count > rank:
+                return self._value(key)
+        return self._value(keys[-1])
+
+
+class SketchSnapshot(Snapshot):
+    """
+    Snapshot of the percentiles of a sketch
+    """
+
+    def __init__(self, sketch):
+        super(SketchSnapshot, self).__init__(())
+        self.sketch = sketch
+
+    def get_size(self):
+        return self.sketch.count
+
+    def get_percentile(self, percentile):
+        return self.sketch.get_quantile(percentile)
+
+
+class SketchSample(object):
+    """
+    A pyformance sample keeping the values in a DDSketch. With a window, the
+    snapshots hold the values of the last completed window of that many seconds,
+    otherwise they hold all the values added since the sample was cleared.
+    """
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY, max_bins=DEFAULT_MAX_BINS,
+                 window=None, clock=time):
+        _validate_parameters(relative_accuracy, max_bins, window)
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.window = window
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.sketch = DDSketch(self.relative_accuracy, self.max_bins)
+            self.previous_sketch = DDSketch(self.relative_accuracy, self.max_bins)
+            self.window_end = self._get_window_end() if self.window else None
+
+    def _get_window_end(self):
+        return (self.clock.time() // self.window + 1) * self.window
+
+    def _rotate_if_necessary(self):
+        if self.window is None or self.clock.time() < self.window_end:
+            return
+        if self.clock.time() < self.window_end + self.window:
+            self.previous_sketch = self.sketch
+        else:
+            self.previous_sketch = DDSketch(self.relative_accuracy, self.max_bins)
+        self.sketch = DDSketch(self.relative_accuracy, self.max_bins)
+        self.window_end = self._get_window_end()
+
+    def get_size(self):
+        return self.get_snapshot().get_size()
+
+    def update(self, value):
+        with self.lock:
+            self._rotate_if_necessary()
+            self.sketch.add(value)
+
+    def get_snapshot(self):
+        with self.lock:
+            self._rotate_if_necessary()
+            if self.window is None:
+                return SketchSnapshot(self.sketch.copy())
+            return SketchSnapshot(self.previous_sketch)
+
+
+class SketchHistogram(Histogram):
+    """
+    A histogram whose percentiles are computed from a DDSketch
+    """
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY, max_bins=DEFAULT_MAX_BINS,
+                 window=None, clock=time):
+        """
+        Parameters
+        ----------
+            relative_accuracy: Relative accuracy of the percentiles
+            max_bins: Maximum number of buckets of the sketch
+            window: If set, the percentiles are the ones of the values added in the last
+                completed window of that many seconds, usually the reporting interval.
+                The count, sum, min, max, mean and standard deviation are still the ones
+                of all the values, as for the pyformance histograms.
+            clock: Clock of the windows
+        """
+        super(SketchHistogram, self).__init__(
+            clock=clock, sample=SketchSample(relative_accuracy, max_bins, window, clock))
+
+
+class SketchTimer(Timer):
+    """
+    A timer whose percentiles are computed from a DDSketch
+    """
+
+    def __init__(self, threshold=None, relative_accuracy=DEFAULT_RELATIVE_ACCURACY,
+                 max_bins=DEFAULT_MAX_BINS, window=None, clock=time, sink=None):
+        super(SketchTimer, self).__init__(
+            threshold=threshold, clock=clock, sink=sink,
+            sample=SketchSample(relative_accuracy, max_bins, window, clock))
+
+
+class SketchMetricsRegistry(MetricsRegistry):
+    """
+    A MetricsRegistry whose histograms and timers are sketch based, it can be
+    used in place of a MetricsRegistry with the ApptuitReporter
+    """
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY, max_bins=DEFAULT_MAX_BINS,
+                 window=None, clock=time):
+        """
+        Parameters
+        ----------
+            relative_accuracy: Relative accuracy of the percentiles of the histograms and timers
+            max_bins: Maximum number of buckets of their sketches
+            window: If set, their percentiles are the ones of the last completed window of
+                that many seconds, usually the reporting interval
+            clock: Clock of the metrics
+        """
+        super(SketchMetricsRegistry, self).__init__(clock=clock)
+        _validate_parameters(relative_accuracy, max_bins, window)
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.window = window
+
+    def histogram(self, key):
+        if key not in self._histograms:
+            self._histograms[key] = SketchHistogram(self.relative_accuracy, self.max_bins,
+                                                    self.window, self._clock)
+        return self._histograms[key]
+
+    def timer(self, key):
+        if key not in self._timers:
+            self._timers[key] = SketchTimer(relative_accuracy=self.relative_accuracy,
+                                            max_bins=self.max_bins, window=self.window,
+                                            clock=self._clock, sink=self.create_sink())
+        return self._timers[key]
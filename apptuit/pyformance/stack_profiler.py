@@ -0,0 +1,164 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Sampling stack profiler.
+
+A sampling thread takes the current frame of every thread with sys._current_frames()
+at a fixed interval and counts the samples of the function (and optionally the line)
+each thread is executing. The samples are only counted in a dictionary by the
+sampling thread, the most sampled functions are added to the counters of the registry
+when the metrics are collected by the reporter.
+"""
+import os
+import sys
+import threading
+
+from apptuit.apptuit_client import TimeSeriesName
+
+DEFAULT_SAMPLING_INTERVAL = 0.01
+DEFAULT_TOP_FUNCTIONS = 10
+DEFAULT_MAX_FUNCTIONS = 100
+OTHER_FUNCTIONS_NAME = "other"
+
+
+class StackProfiler(object):
+    """
+    Samples the functions executed by the threads of the process and reports the
+    number of samples of the most sampled functions
+    """
+
+    def __init__(self, registry, sampling_interval=DEFAULT_SAMPLING_INTERVAL,
+                 top_functions=DEFAULT_TOP_FUNCTIONS, max_functions=DEFAULT_MAX_FUNCTIONS,
+                 by_line=False):
+        """
+        Parameters
+        ----------
+            registry: The MetricsRegistry of the metrics
+            sampling_interval: Number of seconds between two samples
+            top_functions: Number of the most sampled functions reported on every
+                collection, the samples of the other functions are reported under the
+                function "other"
+            max_functions: Maximum number of functions (or lines) the samples are ever
+                reported for, the samples of the functions first sampled after it is reached
+                are reported under the function "other", so it bounds the number of series
+            by_line: If True, the samples are counted per line of the functions
+        """
+        if sampling_interval <= 0:
+            raise ValueError("sampling_interval should be a positive number of seconds, got %r"
+                             % sampling_interval)
+        if top_functions < 1 or max_functions < 1:
+            raise ValueError("top_functions and max_functions should be at least 1")
+        self.pid = os.getpid()
+        self.registry = registry
+        self.sampling_interval = sampling_interval
+        self.top_functions = top_functions
+        self.max_functions = max_functions
+        self.by_line = by_line
+        self.other_metric_name = self._encode_metric_name(OTHER_FUNCTIONS_NAME, None)
+        self.function_metric_names = {}
+        self._samples = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _encode_metric_name(self, function, line):
+        tags = {"function": function, "worker_id": self.pid}
+        if self.by_line:
+            tags["line"] = str(line) if line is not None else OTHER_FUNCTIONS_NAME
+        return TimeSeriesName.encode_metric("python.profiler.samples", tags)
+
+    def start(self):
+        """
+        Start the sampling thread
+        """
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._sample_loop, name="apptuit stack profiler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the sampling thread
+        """
+        self._stopped.set()
+        thread, self._thread = self._thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _sample_loop(self):
+        interval = self.sampling_interval
+        ident = threading.current_thread().ident
+        while not self._stopped.wait(interval):
+            self.sample(ident)
+
+    def sample(self, ignored_thread_ident=None):
+        """
+        Count the functions executed by the threads
+        Params:
+            ignored_thread_ident: The identifier of a thread not to sample, e.g. the
+                sampling thread
+        """
+        by_line = self.by_line
+        keys = []
+        for thread_ident, frame in sys._current_frames().items():
+            if thread_ident == ignored_thread_ident:
+                continue
+            code = frame.f_code
+            keys.append((frame.f_globals.get("__name__"), code.co_name,
+                         frame.f_lineno if by_line else None))
+        with self._lock:
+            samples = self._samples
+            for key in keys:
+                samples[key] = samples.get(key, 0) + 1
+
+    def collect_profile_metrics(self):
+        """
+        Add the samples since the previous call of the most sampled functions to the
+        counters of the registry
+        """
+        with self._lock:
+            samples, self._samples = self._samples, {}
+        if not samples:
+            return
+        ranked = sorted(samples.items(), key=lambda item: item[1], reverse=True)
+        other_count = sum(count for _, count in ranked[self.top_functions:])
+        for key, count in ranked[:self.top_functions]:
+            metric_name = self._get_metric_name(key)
+            if metric_name is self.other_metric_name:
+                other_count += count
+            else:
+                self.registry.counter(metric_name).inc(count)
+        if other_count:
+            self.registry.counter(self.other_metric_name).inc(other_count)
+
+    def _get_metric_name(self, key):
+        """
+        The name of the counter of the samples of a function, or the name of the
+        "other" counter when max_functions is reached
+        """
+        metric_name = self.function_metric_names.get(key)
+        if metric_name is None:
+            if len(self.function_metric_names) >= self.max_functions:
+                return self.other_metric_name
+            module, function, line = key
+            if module:
+                function = "%s.%s" % (module, function)
+            metric_name = self.function_metric_names[key] = \
+                self._encode_metric_name(function, line)
+        return metric_name
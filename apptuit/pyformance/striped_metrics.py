@@ -0,0 +1,178 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Striped counters and meters, for metrics updated from many threads.
+
+The pyformance counters and meters take a lock on every update. The striped
+metrics instead add the updates to a cell owned by the updating thread, without
+any lock, and the cells are only summed when the metric is read by the reporter.
+"""
+import threading
+import time
+
+from pyformance import MetricsRegistry
+from pyformance.meters import Counter, Meter
+
+
+class _ThreadCells(object):
+    """
+    The per thread cells of a striped metric. Each cell is only updated by its
+    thread, the cells of the threads which exited are folded into a single total.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self._lock = threading.Lock()
+        self._cells = []
+        self._folded = 0
+
+    def new_cell(self):
+        """
+        Create the cell of the current thread
+        """
+        cell = [0, threading.current_thread()]
+        with self._lock:
+            self._cells.append(cell)
+        self.local.cell = cell
+        return cell
+
+    def total(self):
+        """
+        Sum of the values of all the cells
+        """
+        with self._lock:
+            live_cells = []
+            total = self._folded
+            for cell in self._cells:
+                if cell[1].is_alive():
+                    live_cells.append(cell)
+                else:
+                    self._folded += cell[0]
+                total += cell[0]
+            self._cells = live_cells
+        return total
+
+
+class StripedCounter(Counter):
+    """
+    A counter which can be incremented concurrently without taking a lock
+    """
+
+    def __init__(self):
+        self._cells = _ThreadCells()
+        self._offset = 0
+        super(StripedCounter, self).__init__()
+
+    def inc(self, val=1):
+        "increment counter by val (default is 1)"
+        try:
+            cell = self._cells.local.cell
+        except AttributeError:
+            cell = self._cells.new_cell()
+        cell[0] += val
+
+    def dec(self, val=1):
+        "decrement counter by val (default is 1)"
+        self.inc(-val)
+
+    def get_count(self):
+        "return current value of counter"
+        return self._cells.total() - self._offset
+
+    def clear(self):
+        "reset counter to 0"
+        with self.lock:
+            self._offset = self._cells.total()
+
+
+class StripedMeter(Meter):
+    """
+    A meter which can be marked concurrently without taking a lock. The marks
+    are added to the count and the moving averages when the meter is read.
+    """
+
+    def __init__(self, clock=time):
+        self._cells = _ThreadCells()
+        self._merged = 0
+        super(StripedMeter, self).__init__(clock=clock)
+
+    def mark(self, value=1):
+        try:
+            cell = self._cells.local.cell
+        except AttributeError:
+            cell = self._cells.new_cell()
+        cell[0] += value
+
+    def _merge(self):
+        """
+        Add the marks since the previous merge to the count and moving averages
+        """
+        with self.lock:
+            total = self._cells.total()
+            value = total - self._merged
+            if value:
+                self._merged = total
+                self.counter += value
+                self.m1rate.add(value)
+                self.m5rate.add(value)
+                self.m15rate.add(value)
+
+    def clear(self):
+        super(StripedMeter, self).clear()
+        with self.lock:
+            self._merged = self._cells.total()
+
+    def tick(self):
+        self._merge()
+        super(StripedMeter, self).tick()
+
+    def get_count(self):
+        self._merge()
+        return super(StripedMeter, self).get_count()
+
+    def get_mean_rate(self):
+        self._merge()
+        return super(StripedMeter, self).get_mean_rate()
+
+    def get_one_minute_rate(self):
+        self._merge()
+        return super(StripedMeter, self).get_one_minute_rate()
+
+    def get_five_minute_rate(self):
+        self._merge()
+        return super(StripedMeter, self).get_five_minute_rate()
+
+    def get_fifteen_minute_rate(self):
+        self._merge()
+        return super(StripedMeter, self).get_fifteen_minute_rate()
+
+
+class StripedMetricsRegistry(MetricsRegistry):
+    """
+    A MetricsRegistry whose counters and meters are striped, it can be used
+    in place of a MetricsRegistry with the ApptuitReporter
+    """
+
+    def counter(self, key):
+        if key not in self._counters:
+            self._counters[key] = StripedCounter()
+        return self._counters[key]
+
+    def meter(self, key):
+        if key not in self._meters:
+            self._meters[key] = StripedMeter(clock=self._clock)
+        return self._meters[key]
@@ -19,12 +19,105 @@
 """
 
 import json
+from collections import namedtuple
+from json.encoder import encode_basestring_ascii
 
 try:
     from functools import lru_cache
 except ImportError:
     from backports.functools_lru_cache import lru_cache
 
+DEFAULT_ENCODE_CACHE_SIZE = 2048
+DEFAULT_DECODE_CACHE_SIZE = 2048
+_TAGS_DECODER = json.JSONDecoder()
+_CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+def _encode_metric(metric_name, metric_tags):
+    """
+    Produce exactly the same encoding as metric_name + json.dumps(metric_tags, sort_keys=True)
+    without going through the JSON encoder for the usual case of string tag keys
+    """
+    parts = []
+    for tag_key in sorted(metric_tags):
+        if not isinstance(tag_key, str):
+            return metric_name + json.dumps(metric_tags, sort_keys=True)
+        tag_value = metric_tags[tag_key]
+        if isinstance(tag_value, str):
+            encoded_value = encode_basestring_ascii(tag_value)
+        else:
+            encoded_value = json.dumps(tag_value, sort_keys=True)
+        parts.append(encode_basestring_ascii(tag_key) + ": " + encoded_value)
+    return metric_name + "{" + ", ".join(parts) + "}"
+
+
+def _encode_cached_metric(metric_name, tag_items):
+    return _encode_metric(metric_name, dict(tag_items))
+
+
+def _decode_metric(encoded_metric_name):
+    if encoded_metric_name is None or encoded_metric_name == "":
+        raise ValueError("Invalid value for encoded_metric_name")
+
+    metric_tags = {}
+    metric_name = encoded_metric_name.strip()
+    brace_index = encoded_metric_name.find('{')
+    if brace_index > -1:
+        try:
+            metric_tags = _TAGS_DECODER.decode(encoded_metric_name[brace_index:])
+            metric_name = encoded_metric_name[:brace_index].strip()
+        except Exception as err:
+            raise ValueError("Failed to parse the encoded_metric_name %s, invalid format"
+                             % encoded_metric_name, err)
+    return metric_name, metric_tags
+
+
+def _cached(func, cache_size):
+    if cache_size == 0:
+        return func
+    return lru_cache(maxsize=cache_size)(func)
+
+
+_encode_cache = _cached(_encode_cached_metric, DEFAULT_ENCODE_CACHE_SIZE)
+_decode_cache = _cached(_decode_metric, DEFAULT_DECODE_CACHE_SIZE)
+
+
+def set_cache_sizes(encode_cache_size=None, decode_cache_size=None):
+    """
+    Set the number of metric names cached by encode_metric and decode_metric. These
+    should be larger than the number of distinct metrics in the registry, otherwise
+    every report evicts and re-parses the names. The entries of a resized cache are dropped.
+    Params:
+        encode_cache_size: size of the encode_metric cache, 0 disables caching,
+            None leaves the current size
+        decode_cache_size: size of the decode_metric cache, 0 disables caching,
+            None leaves the current size
+    """
+    global _encode_cache, _decode_cache
+    for cache_size in (encode_cache_size, decode_cache_size):
+        if cache_size is not None and (not isinstance(cache_size, int) or cache_size < 0):
+            raise ValueError("cache size must be a non-negative integer, got %r" % cache_size)
+    if encode_cache_size is not None:
+        _encode_cache = _cached(_encode_cached_metric, encode_cache_size)
+    if decode_cache_size is not None:
+        _decode_cache = _cached(_decode_metric, decode_cache_size)
+
+
+def _cache_info(cache):
+    if hasattr(cache, "cache_info"):
+        return cache.cache_info()
+    return _CacheInfo(0, 0, 0, 0)
+
+
+def cache_info():
+    """
+    Get the statistics of the encode_metric and decode_metric caches
+    Returns:
+        A dictionary with the cache statistics (hits, misses, maxsize, currsize)
+        of each cache under the keys 'encode' and 'decode'
+    """
+    return {"encode": _cache_info(_encode_cache), "decode": _cache_info(_decode_cache)}
+
 
 def encode_metric(metric_name, metric_tags):
     """
@@ -45,11 +138,15 @@ def encode_metric(metric_name, metric_tags):
     if not isinstance(metric_tags, dict):
         raise ValueError("metric_tags must be a dictionary")
 
-    encoded_metric_name = metric_name + json.dumps(metric_tags, sort_keys=True)
-    return encoded_metric_name
+    if _encode_cache is _encode_cached_metric:
+        return _encode_metric(metric_name, metric_tags)
+    for tag_value in metric_tags.values():
+        # 1, 1.0 and True are equal as cache keys but are encoded differently
+        if not isinstance(tag_value, str):
+            return _encode_metric(metric_name, metric_tags)
+    return _encode_cache(metric_name, frozenset(metric_tags.items()))
 
 
-@lru_cache(maxsize=2048)
 def decode_metric(encoded_metric_name):
     """
     Decode the metric name as encoded by encode_metric_name
@@ -59,17 +156,4 @@ def decode_metric(encoded_metric_name):
     Returns:
         The metric name and the dictionary of tags
     """
-    if encoded_metric_name is None or encoded_metric_name == "":
-        raise ValueError("Invalid value for encoded_metric_name")
-
-    metric_tags = {}
-    metric_name = encoded_metric_name.strip()
-    brace_index = encoded_metric_name.find('{')
-    if brace_index > -1:
-        try:
-            metric_tags = json.loads(encoded_metric_name[brace_index:])
-            metric_name = encoded_metric_name[:brace_index].strip()
-        except Exception as err:
-            raise ValueError("Failed to parse the encoded_metric_name %s, invalid format"
-                             % encoded_metric_name, err)
-    return metric_name, metric_tags
+    return _decode_cache(encoded_metric_name)
@@ -33,6 +33,8 @@ VALID_REGEX = re.compile(r"[-\w_/.]+$", re.U)
 PROMETHEUS_VALID_CHARSET = set(ascii_letters + digits + "_")
 APPTUIT_SANITIZE_REGEX = re.compile(r'([^-\w_./])', re.U)
 REPLACE_WITH_SINGLE_UNDERSCORE_REGEX = re.compile('_+')
+DURATION_REGEX = re.compile(r"^\s*(\d+)\s*([smhdw]?)\s*$")
+DURATION_UNIT_SECS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
 
 
 @lru_cache(maxsize=2048)
@@ -105,6 +107,25 @@ def _get_tags_from_environment():
     return tags
 
 
+def _parse_duration(duration):
+    """
+    Convert a duration to seconds
+    :param duration: number of seconds or a string such as '90s', '30m', '6h', '1d' or '1w'
+    :return: the duration in seconds
+    """
+    if isinstance(duration, (int, float)) and not isinstance(duration, bool):
+        secs = int(duration)
+    else:
+        match = DURATION_REGEX.match(str(duration))
+        if not match:
+            raise ValueError("Invalid duration '%s', expected number of seconds or a "
+                             "value such as '30m', '6h' or '1d'" % duration)
+        secs = int(match.group(1)) * DURATION_UNIT_SECS[match.group(2)]
+    if secs <= 0:
+        raise ValueError("Duration must be positive, got '%s'" % duration)
+    return secs
+
+
 def strtobool(val):
     """Convert a string representation of truth to true (1) or false (0).
 
@@ -0,0 +1,58 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Overhead of the garbage collector pause metrics on an allocation heavy workload,
+which triggers many young generation collections.
+Run from the repository root: PYTHONPATH=. python benchmarks/bench_gc_metrics.py
+"""
+import gc
+import timeit
+
+from pyformance import MetricsRegistry
+
+from apptuit.pyformance.gc_metrics import GCMetrics
+
+ALLOCATIONS = 200000
+REPEAT = 5
+
+
+def allocate():
+    for _ in range(ALLOCATIONS):
+        cycle = {}
+        cycle["self"] = cycle
+
+
+def report(name):
+    collections = sum(stats["collections"] for stats in gc.get_stats())
+    # timeit disables the garbage collector by default
+    secs = min(timeit.repeat(allocate, setup="import gc; gc.enable()", number=1, repeat=REPEAT))
+    collections = (sum(stats["collections"] for stats in gc.get_stats()) - collections) // REPEAT
+    print("%-28s %8.1f ms per run, %d collections per run" % (name, secs * 1e3, collections))
+
+
+def main():
+    report("without GCMetrics")
+    registry = MetricsRegistry()
+    gc_metrics = GCMetrics(registry)
+    report("with GCMetrics")
+    drain = timeit.timeit(gc_metrics.collect_gc_metrics, number=1)
+    gc_metrics.close()
+    print("collect_gc_metrics of the pending pauses: %.1f ms" % (drain * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Micro-benchmark of timeseries.encode_metric and timeseries.decode_metric against
+the json.dumps / json.loads based implementation they replace.
+Run from the repository root: PYTHONPATH=. python benchmarks/bench_metric_names.py
+"""
+import json
+import timeit
+
+from apptuit import timeseries
+
+SERIES_COUNT = 5000
+REPEAT = 5
+
+
+def json_encode_metric(metric_name, metric_tags):
+    return metric_name + json.dumps(metric_tags, sort_keys=True)
+
+
+def json_decode_metric(encoded_metric_name):
+    brace_index = encoded_metric_name.find('{')
+    return (encoded_metric_name[:brace_index].strip(),
+            json.loads(encoded_metric_name[brace_index:]))
+
+
+def report(name, func, args_list):
+    secs = min(timeit.repeat(lambda: [func(*args) for args in args_list],
+                             number=1, repeat=REPEAT))
+    print("%-45s %8.2f us/call" % (name, secs * 1e6 / len(args_list)))
+
+
+def main():
+    tags_list = [{"host": "node-%d" % (i % 100), "service": "order-service",
+                  "type": "idle", "worker_id": str(i)} for i in range(SERIES_COUNT)]
+    encode_args = [("node.cpu", tags) for tags in tags_list]
+    decode_args = [(json_encode_metric(*args),) for args in encode_args]
+    print("%d distinct series" % SERIES_COUNT)
+    report("json encode", json_encode_metric, encode_args)
+    timeseries.set_cache_sizes(encode_cache_size=0, decode_cache_size=0)
+    report("encode_metric, no cache", timeseries.encode_metric, encode_args)
+    timeseries.set_cache_sizes(encode_cache_size=SERIES_COUNT)
+    timeseries.encode_metric("warm", {})
+    report("encode_metric, cache of %d" % SERIES_COUNT, timeseries.encode_metric, encode_args)
+    report("json decode", json_decode_metric, decode_args)
+    timeseries.set_cache_sizes(decode_cache_size=0)
+    report("decode_metric, no cache", timeseries.decode_metric, decode_args)
+    timeseries.set_cache_sizes(decode_cache_size=timeseries.DEFAULT_DECODE_CACHE_SIZE)
+    report("decode_metric, default cache (thrashing)", timeseries.decode_metric, decode_args)
+    timeseries.set_cache_sizes(decode_cache_size=SERIES_COUNT)
+    report("decode_metric, cache of %d" % SERIES_COUNT, timeseries.decode_metric, decode_args)
+    print(timeseries.cache_info())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Cost of a collection of the process metrics, for the getrusage based metrics
+and the /proc based ones, with a growing number of threads, and of the cgroup v2
+metrics.
+Run from the repository root: PYTHONPATH=. python benchmarks/bench_process_metrics.py
+"""
+import os
+import shutil
+import tempfile
+import threading
+import timeit
+
+from pyformance import MetricsRegistry
+
+from apptuit.pyformance.cgroup_metrics import CgroupMetrics, find_cgroup_path
+from apptuit.pyformance.linux_process_metrics import LinuxProcessMetrics
+from apptuit.pyformance.process_metrics import ProcessMetrics
+
+COLLECTIONS = 2000
+REPEAT = 3
+THREAD_COUNTS = (1, 16, 128)
+CGROUP_FILES = {
+    "cpu.stat": "usage_usec 35000000\nuser_usec 25000000\nsystem_usec 10000000\n"
+                "nr_periods 2000\nnr_throttled 100\nthrottled_usec 5000000\n",
+    "memory.current": "536870912\n",
+    "memory.max": "1073741824\n",
+    "memory.events": "low 0\nhigh 2\nmax 3\noom 1\noom_kill 1\noom_group_kill 0\n",
+    "io.stat": "8:0 rbytes=4096 wbytes=2048 rios=4 wios=2 dbytes=0 dios=0\n",
+}
+
+
+def read_proc_files():
+    """
+    The files read by a LinuxProcessMetrics collection, opened on every collection
+    and without parsing them, for comparison
+    """
+    for name in ("stat", "status", "io"):
+        with open("/proc/self/" + name, "rb") as proc_file:
+            proc_file.read()
+    os.listdir("/proc/self/fd")
+    for task_id in os.listdir("/proc/self/task"):
+        with open("/proc/self/task/%s/stat" % task_id, "rb") as proc_file:
+            proc_file.read()
+
+
+def report(name, collect):
+    secs = min(timeit.repeat(collect, number=COLLECTIONS, repeat=REPEAT))
+    print("%-40s %8.1f us/collection" % (name, secs * 1e6 / COLLECTIONS))
+
+
+def bench_cgroup_metrics():
+    """
+    The cgroup metrics of the process, or of a copy of the cgroup files in a
+    temporary directory when the process is not in a cgroup v2 hierarchy
+    """
+    if CgroupMetrics.is_supported():
+        cgroup_metrics = CgroupMetrics(MetricsRegistry())
+        report("CgroupMetrics of %s" % find_cgroup_path(), cgroup_metrics.collect_cgroup_metrics)
+        cgroup_metrics.close()
+        return
+    path = tempfile.mkdtemp()
+    try:
+        for name, content in CGROUP_FILES.items():
+            with open(os.path.join(path, name), "w") as cgroup_file:
+                cgroup_file.write(content)
+        cgroup_metrics = CgroupMetrics(MetricsRegistry(), cgroup_path=path)
+        report("CgroupMetrics of a temporary directory", cgroup_metrics.collect_cgroup_metrics)
+        cgroup_metrics.close()
+    finally:
+        shutil.rmtree(path)
+
+
+def main():
+    bench_cgroup_metrics()
+    if not LinuxProcessMetrics.is_supported():
+        print("/proc is not available")
+        return
+    stop = threading.Event()
+    threads = []
+    for thread_count in THREAD_COUNTS:
+        while len(threads) < thread_count - 1:
+            thread = threading.Thread(target=stop.wait)
+            thread.start()
+            threads.append(thread)
+        print("%d threads" % thread_count)
+        process_metrics = ProcessMetrics(MetricsRegistry())
+        linux_process_metrics = LinuxProcessMetrics(MetricsRegistry())
+        report("  getrusage ProcessMetrics", process_metrics.collect_process_metrics)
+        report("  /proc reads, files opened every time", read_proc_files)
+        report("  LinuxProcessMetrics", linux_process_metrics.collect_process_metrics)
+        linux_process_metrics.close()
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == '__main__':
+    main()
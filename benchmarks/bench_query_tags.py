@@ -0,0 +1,64 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Memory used by the tags of a high cardinality query result, with and without
+sharing of the tag dictionaries in _parse_response.
+Run from the repository root: PYTHONPATH=. python benchmarks/bench_query_tags.py
+"""
+import json
+import tracemalloc
+
+from apptuit import apptuit_client
+
+SERIES_COUNT = 20000
+POINTS_PER_SERIES = 10
+
+
+def make_response(series_count):
+    results = []
+    for i in range(series_count):
+        tags = {"host": "host-%d" % (i % 50), "dc": "dc-%d" % (i % 3),
+                "service": "order-service", "env": "production", "type": "idle"}
+        dps = [[1500000000 + 60 * j, float(j)] for j in range(POINTS_PER_SERIES)]
+        results.append({"metric": "node.cpu", "tags": tags, "dps": dps})
+    return json.dumps({"outputs": [{"id": "cpu", "result": results}]})
+
+
+def measure(resp):
+    tracemalloc.start()
+    result = apptuit_client._parse_response(resp, 0)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current
+
+
+def main():
+    resp = make_response(SERIES_COUNT)
+    _, shared = measure(resp)
+    share_tags = apptuit_client._share_tags
+    apptuit_client._share_tags = lambda tags: tags
+    try:
+        _, unshared = measure(resp)
+    finally:
+        apptuit_client._share_tags = share_tags
+    print("series: %d, points per series: %d" % (SERIES_COUNT, POINTS_PER_SERIES))
+    print("parsed result without shared tags: %.1f MiB" % (unshared / 1024.0 ** 2))
+    print("parsed result with shared tags:    %.1f MiB" % (shared / 1024.0 ** 2))
+
+
+if __name__ == '__main__':
+    main()
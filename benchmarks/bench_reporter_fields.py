@@ -0,0 +1,60 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Benchmark of ApptuitReporter._collect_data_points on a registry of timers, with
+the default fields and with a reduced selection of fields.
+Run from the repository root: PYTHONPATH=. python benchmarks/bench_reporter_fields.py
+"""
+import random
+import timeit
+
+from pyformance import MetricsRegistry
+
+from apptuit.pyformance import ApptuitReporter
+
+TIMER_COUNT = 2000
+REPEAT = 5
+
+
+def report(name, reporter, registry):
+    dps = reporter._collect_data_points(registry)
+    secs = min(timeit.repeat(lambda: reporter._collect_data_points(registry),
+                             number=1, repeat=REPEAT))
+    print("%-35s %8.2f ms/collection %8d points" % (name, secs * 1e3, len(dps)))
+
+
+def main():
+    registry = MetricsRegistry()
+    for i in range(TIMER_COUNT):
+        timer = registry.timer('request.latency {"endpoint": "e%d"}' % i)
+        for _ in range(100):
+            timer._update(random.random())
+    print("%d timers" % TIMER_COUNT)
+    reporter = ApptuitReporter(registry=registry, token="token", disable_host_tag=True)
+    secs = min(timeit.repeat(registry.dump_metrics, number=1, repeat=REPEAT))
+    print("%-35s %8.2f ms" % ("registry.dump_metrics", secs * 1e3))
+    report("default fields", reporter, registry)
+    reporter = ApptuitReporter(registry=registry, token="token", disable_host_tag=True,
+                               fields={"timer": ["count", "99_percentile"]})
+    report("count, 99_percentile", reporter, registry)
+    reporter = ApptuitReporter(registry=registry, token="token", disable_host_tag=True,
+                               fields={"timer": ["count", "sum", "max"]})
+    report("count, sum, max (no snapshot)", reporter, registry)
+
+
+if __name__ == '__main__':
+    main()
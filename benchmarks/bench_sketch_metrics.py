@@ -0,0 +1,84 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Accuracy and throughput benchmark of the sketch histograms against the pyformance
+histograms, on a long tailed (lognormal) distribution of latencies.
+Run from the repository root: PYTHONPATH=. python benchmarks/bench_sketch_metrics.py
+"""
+import random
+import sys
+import timeit
+
+from pyformance.meters import Histogram
+
+from apptuit.pyformance.sketch_metrics import SketchHistogram
+
+VALUES_COUNT = 200000
+PERCENTILES = (0.5, 0.75, 0.95, 0.99, 0.999)
+REPEAT = 3
+
+
+def exact_percentile(sorted_values, percentile):
+    return sorted_values[int(round(percentile * (len(sorted_values) - 1)))]
+
+
+def report_accuracy(name, histogram, sorted_values):
+    snapshot = histogram.get_snapshot()
+    errors = []
+    for percentile in PERCENTILES:
+        exact = exact_percentile(sorted_values, percentile)
+        errors.append("p%s %5.2f%%" % (str(percentile * 100).rstrip("0").rstrip("."),
+                                        abs(snapshot.get_percentile(percentile) - exact)
+                                        / exact * 100))
+    print("%-28s relative errors: %s" % (name, ", ".join(errors)))
+
+
+def report_throughput(name, create_histogram, values):
+    def run():
+        histogram = create_histogram()
+        for value in values:
+            histogram.add(value)
+    secs = min(timeit.repeat(run, number=1, repeat=REPEAT))
+    print("%-28s %8.1f ns/add" % (name, secs * 1e9 / len(values)))
+
+
+def main():
+    random.seed(42)
+    values = [random.lognormvariate(-3, 1.5) for _ in range(VALUES_COUNT)]
+    sorted_values = sorted(values)
+    histograms = [("pyformance Histogram", Histogram),
+                  ("SketchHistogram 1%", SketchHistogram),
+                  ("SketchHistogram 0.1%",
+                   lambda: SketchHistogram(relative_accuracy=0.001, max_bins=8192))]
+    print("%d lognormal values" % VALUES_COUNT)
+    for name, create_histogram in histograms:
+        histogram = create_histogram()
+        for value in values:
+            histogram.add(value)
+        report_accuracy(name, histogram, sorted_values)
+    for name, create_histogram in histograms:
+        report_throughput(name, create_histogram, values)
+    histogram = SketchHistogram()
+    for value in values:
+        histogram.add(value)
+    print("SketchHistogram 1%% buckets: %d, reservoir of a pyformance Histogram: %d values"
+          % (len(histogram.sample.sketch.positive.bins), Histogram().sample.size))
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
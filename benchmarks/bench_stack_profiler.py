@@ -0,0 +1,73 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Cost of a sample of the stack profiler with a growing number of threads, and
+overhead of the profiler sampling every 10 ms on a CPU bound workload.
+Run from the repository root: PYTHONPATH=. python benchmarks/bench_stack_profiler.py
+"""
+import threading
+import timeit
+
+from pyformance import MetricsRegistry
+
+from apptuit.pyformance.stack_profiler import StackProfiler
+
+REPEAT = 5
+
+
+def workload():
+    total = 0
+    for i in range(1000000):
+        total += i % 7
+    return total
+
+
+def bench_sample(thread_count):
+    stopped = threading.Event()
+    threads = [threading.Thread(target=stopped.wait) for _ in range(thread_count - 1)]
+    for thread in threads:
+        thread.start()
+    profiler = StackProfiler(MetricsRegistry())
+    number = 1000
+    secs = min(timeit.repeat(profiler.sample, number=number, repeat=REPEAT)) / number
+    stopped.set()
+    for thread in threads:
+        thread.join()
+    print("sample with %3d threads: %8.1f us" % (thread_count, secs * 1e6))
+
+
+def bench_overhead():
+    baseline = min(timeit.repeat(workload, number=1, repeat=REPEAT))
+    profiler = StackProfiler(MetricsRegistry(), sampling_interval=0.01)
+    profiler.start()
+    profiled = min(timeit.repeat(workload, number=1, repeat=REPEAT))
+    profiler.stop()
+    collect = timeit.timeit(profiler.collect_profile_metrics, number=1)
+    print("workload without profiler: %8.1f ms" % (baseline * 1e3))
+    print("workload with profiler:    %8.1f ms (%+.1f%%)"
+          % (profiled * 1e3, (profiled / baseline - 1) * 100))
+    print("collect_profile_metrics:   %8.1f us" % (collect * 1e6))
+
+
+def main():
+    for thread_count in (1, 16, 128):
+        bench_sample(thread_count)
+    bench_overhead()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Contention benchmark of the pyformance counters and meters against the striped
+ones, updated concurrently from several threads.
+Run from the repository root: PYTHONPATH=. python benchmarks/bench_striped_metrics.py
+"""
+import threading
+import time
+
+from pyformance.meters import Counter, Meter
+
+from apptuit.pyformance.striped_metrics import StripedCounter, StripedMeter
+
+UPDATES = 400000
+THREAD_COUNTS = (1, 8, 64)
+
+
+def run(update, thread_count):
+    updates_per_thread = UPDATES // thread_count
+    start_barrier = threading.Barrier(thread_count + 1)
+
+    def worker():
+        start_barrier.wait()
+        for _ in range(updates_per_thread):
+            update()
+    threads = [threading.Thread(target=worker) for _ in range(thread_count)]
+    for thread in threads:
+        thread.start()
+    start = time.time()
+    start_barrier.wait()
+    for thread in threads:
+        thread.join()
+    return time.time() - start
+
+
+def report(name, metric, update, read):
+    for thread_count in THREAD_COUNTS:
+        secs = run(update, thread_count)
+        print("%-16s %3d threads %8.1f ns/update  total %d"
+              % (name, thread_count, secs * 1e9 / UPDATES, read()))
+        metric.clear()
+
+
+def main():
+    counter = Counter()
+    report("Counter", counter, counter.inc, counter.get_count)
+    counter = StripedCounter()
+    report("StripedCounter", counter, counter.inc, counter.get_count)
+    meter = Meter()
+    report("Meter", meter, meter.mark, meter.get_count)
+    meter = StripedMeter()
+    report("StripedMeter", meter, meter.mark, meter.get_count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Helpers shared by the tests of the collectors reading /proc and cgroup files
+"""
+import json
+
+
+def write_file(path, content):
+    with open(path, "w") as metrics_file:
+        metrics_file.write(content)
+
+
+def get_values(registry, tag_keys=("type",)):
+    """
+    The values of the metrics having one of the tag keys, by metric name and
+    value of the first of those tags
+    """
+    values = {}
+    for key, value in registry.dump_metrics().items():
+        metric, _, tags = key.partition("{")
+        tags = json.loads("{" + tags) if tags else {}
+        for tag_key in tag_keys:
+            if tag_key in tags:
+                values[metric + "." + tags[tag_key]] = value.get("value", value.get("count"))
+                break
+    return values
@@ -0,0 +1,216 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Tests for the cgroup v2 metrics
+"""
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_almost_equal, assert_equals, assert_true, assert_false, \
+    assert_is_none, assert_raises
+from pyformance import MetricsRegistry
+
+from apptuit.pyformance import ApptuitReporter
+from apptuit.pyformance.cgroup_metrics import CgroupMetrics, find_cgroup_path
+from apptuit.pyformance.shared_registry import SharedMetricsRegistry
+from .helpers import get_values, write_file
+
+try:
+    from unittest.mock import Mock, patch
+except ImportError:
+    from mock import Mock, patch
+
+CPU_STAT = "usage_usec 3500000\nuser_usec %d\nsystem_usec 1000000\nnr_periods 200\n" \
+           "nr_throttled %d\nthrottled_usec %d\nnr_bursts 0\nburst_usec 0\n"
+MEMORY_EVENTS = "low 0\nhigh 2\nmax %d\noom 1\noom_kill 1\noom_group_kill 0\n"
+IO_STAT = "8:0 rbytes=%d wbytes=2048 rios=4 wios=2 dbytes=0 dios=0\n" \
+          "253:0 rbytes=1024 wbytes=0 rios=1 wios=0 dbytes=0 dios=0\n"
+MOUNTINFO = "22 1 0:21 / /proc rw,nosuid,nodev,noexec,relatime shared:12 - proc proc rw\n" \
+            "30 25 0:26 / %s rw,nosuid,nodev,noexec,relatime shared:4 - cgroup2 cgroup2 " \
+            "rw,nsdelegate\n"
+
+
+def _create_cgroup_dir(path, user_usec, nr_throttled, throttled_usec, max_events, rbytes,
+                       memory_max="1073741824"):
+    write_file(os.path.join(path, "cpu.stat"),
+               CPU_STAT % (user_usec, nr_throttled, throttled_usec))
+    write_file(os.path.join(path, "memory.current"), "536870912\n")
+    write_file(os.path.join(path, "memory.max"), memory_max + "\n")
+    write_file(os.path.join(path, "memory.events"), MEMORY_EVENTS % max_events)
+    write_file(os.path.join(path, "io.stat"), IO_STAT % rbytes)
+
+
+def test_collect_from_cgroup_files():
+    """
+    Test the metrics collected from the files of a cgroup directory
+    """
+    path = tempfile.mkdtemp()
+    try:
+        _create_cgroup_dir(path, 2500000, 10, 500000, 3, 4096)
+        registry = MetricsRegistry()
+        collector = CgroupMetrics(registry, cgroup_path=path)
+        collector.collect_cgroup_metrics()
+        values = get_values(registry)
+        assert_equals(values["python.cgroup.cpu.seconds.user"], 2.5)
+        assert_equals(values["python.cgroup.cpu.seconds.system"], 1)
+        assert_equals(values["python.cgroup.cpu.throttled.seconds.total"], 0.5)
+        assert_equals(values["python.cgroup.cpu.periods.total"], 200)
+        assert_equals(values["python.cgroup.cpu.periods.throttled"], 10)
+        assert_equals(values["python.cgroup.memory.bytes.current"], 536870912)
+        assert_equals(values["python.cgroup.memory.bytes.limit"], 1073741824)
+        assert_equals(values["python.cgroup.memory.events.high"], 2)
+        assert_equals(values["python.cgroup.memory.events.max"], 3)
+        assert_equals(values["python.cgroup.memory.events.oom_kill"], 1)
+        assert_equals(values["python.cgroup.io.bytes.read"], 5120)
+        assert_equals(values["python.cgroup.io.bytes.write"], 2048)
+        assert_equals(values["python.cgroup.io.operations.read"], 5)
+        assert_equals(values["python.cgroup.io.operations.write"], 2)
+        assert_equals(len(values), 16)
+        assert_false([key for key in registry.dump_metrics() if "worker_id" in key])
+
+        # the files are read again, the counters are incremented by the differences
+        _create_cgroup_dir(path, 3000000, 15, 800000, 5, 8192)
+        collector.collect_cgroup_metrics()
+        values = get_values(registry)
+        assert_equals(values["python.cgroup.cpu.seconds.user"], 3)
+        assert_almost_equal(values["python.cgroup.cpu.throttled.seconds.total"], 0.8)
+        assert_equals(values["python.cgroup.cpu.periods.throttled"], 15)
+        assert_equals(values["python.cgroup.memory.events.max"], 5)
+        assert_equals(values["python.cgroup.io.bytes.read"], 9216)
+
+        # a device which disappears does not decrease the I/O counters
+        write_file(os.path.join(path, "io.stat"), IO_STAT.splitlines(True)[1])
+        collector.collect_cgroup_metrics()
+        values = get_values(registry)
+        assert_equals(values["python.cgroup.io.bytes.read"], 9216)
+        assert_equals(values["python.cgroup.io.operations.read"], 5)
+        write_file(os.path.join(path, "io.stat"),
+                   "253:0 rbytes=2048 wbytes=0 rios=3 wios=0 dbytes=0 dios=0\n")
+        collector.collect_cgroup_metrics()
+        values = get_values(registry)
+        assert_equals(values["python.cgroup.io.bytes.read"], 10240)
+        assert_equals(values["python.cgroup.io.operations.read"], 7)
+        collector.close()
+    finally:
+        shutil.rmtree(path)
+
+
+def test_missing_cgroup_files():
+    """
+    Test that the metrics of the files missing from a cgroup directory, and the memory
+    limit when the memory is not limited, are skipped
+    """
+    path = tempfile.mkdtemp()
+    try:
+        write_file(os.path.join(path, "cpu.stat"), CPU_STAT % (2500000, 0, 0))
+        write_file(os.path.join(path, "memory.max"), "max\n")
+        registry = MetricsRegistry()
+        collector = CgroupMetrics(registry, cgroup_path=path)
+        collector.collect_cgroup_metrics()
+        values = get_values(registry)
+        assert_equals(values["python.cgroup.cpu.seconds.user"], 2.5)
+        assert_false([name for name in values if not name.startswith("python.cgroup.cpu")])
+        collector.close()
+    finally:
+        shutil.rmtree(path)
+
+
+def test_find_cgroup_path():
+    """
+    Test that the cgroup directory is found from the cgroup and mountinfo files
+    of a /proc directory
+    """
+    path = tempfile.mkdtemp()
+    try:
+        proc_path = os.path.join(path, "proc")
+        mount_point = os.path.join(path, "cgroup")
+        cgroup_path = os.path.join(mount_point, "system.slice", "app.service")
+        os.makedirs(proc_path)
+        os.makedirs(cgroup_path)
+        write_file(os.path.join(proc_path, "mountinfo"), MOUNTINFO % mount_point)
+        write_file(os.path.join(proc_path, "cgroup"), "0::/system.slice/app.service\n")
+        assert_equals(find_cgroup_path(proc_path), cgroup_path)
+        assert_false(CgroupMetrics.is_supported(proc_path))
+        _create_cgroup_dir(cgroup_path, 0, 0, 0, 0, 0)
+        assert_true(CgroupMetrics.is_supported(proc_path))
+
+        # the cgroup of the host, with the cgroup of the container mounted
+        write_file(os.path.join(proc_path, "cgroup"), "0::/kubepods/pod1/container1\n")
+        assert_equals(find_cgroup_path(proc_path), mount_point)
+
+        # the root cgroup, with a cgroup namespace
+        write_file(os.path.join(proc_path, "cgroup"), "0::/\n")
+        assert_equals(find_cgroup_path(proc_path), mount_point)
+
+        # hybrid mode, the controllers are in the cgroup v1 hierarchies
+        write_file(os.path.join(proc_path, "cgroup"), "4:memory:/docker/container1\n0::/\n")
+        assert_is_none(find_cgroup_path(proc_path))
+
+        # cgroup v1 only
+        write_file(os.path.join(proc_path, "cgroup"), "4:memory:/docker/container1\n")
+        assert_is_none(find_cgroup_path(proc_path))
+        assert_false(CgroupMetrics.is_supported(proc_path))
+        assert_is_none(find_cgroup_path(os.path.join(path, "missing")))
+    finally:
+        shutil.rmtree(path)
+    if find_cgroup_path() is None:
+        with assert_raises(RuntimeError):
+            CgroupMetrics(MetricsRegistry())
+
+
+def test_reporter_cgroup_metrics():
+    """
+    Test that the cgroup metrics are only collected when they are enabled, and
+    only by the elected reporter of a SharedMetricsRegistry
+    """
+    path = tempfile.mkdtemp()
+    try:
+        cgroup_path = os.path.join(path, "cgroup")
+        registry_path = os.path.join(path, "registry")
+        os.makedirs(cgroup_path)
+        os.makedirs(registry_path)
+        _create_cgroup_dir(cgroup_path, 2500000, 10, 500000, 3, 4096)
+        with patch("apptuit.pyformance.cgroup_metrics.find_cgroup_path",
+                   return_value=cgroup_path):
+            assert_is_none(ApptuitReporter(token="asdashdsauh_8aeraerf").cgroup_metrics)
+            reporter = ApptuitReporter(registry=SharedMetricsRegistry(registry_path),
+                                       token="asdashdsauh_8aeraerf", disable_host_tag=True,
+                                       collect_cgroup_metrics=True)
+            other_reporter = ApptuitReporter(registry=SharedMetricsRegistry(registry_path),
+                                             token="asdashdsauh_8aeraerf",
+                                             disable_host_tag=True,
+                                             collect_cgroup_metrics=True)
+        for cgroup_reporter in (reporter, other_reporter):
+            cgroup_reporter.client.send = Mock()
+        reporter.report_now()
+        other_reporter.report_now()
+        assert_equals(other_reporter.client.send.call_count, 0)
+        assert_false(other_reporter.cgroup_metrics.previous_values)
+        dps = reporter.client.send.call_args_list[0][0][0]
+        cgroup_dps = [dp for dp in dps if dp.metric.startswith("python.cgroup.")]
+        assert_equals(len(cgroup_dps), 16)
+        # every series has a type tag, without worker_id, even without reporter tags
+        assert_equals(set(tuple(dp.tags) for dp in cgroup_dps), set([("type",)]))
+        values = dict((dp.metric + "." + dp.tags["type"], dp.value) for dp in cgroup_dps)
+        assert_equals(values["python.cgroup.cpu.throttled.seconds.count.total"], 0.5)
+        for cgroup_reporter in (reporter, other_reporter):
+            cgroup_reporter.stop()
+            assert_false([fd for fd in cgroup_reporter.cgroup_metrics._fds.values()
+                          if fd is not None])
+    finally:
+        shutil.rmtree(path)
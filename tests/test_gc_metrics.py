@@ -0,0 +1,111 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Tests for the garbage collector pause metrics
+"""
+import gc
+
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_equals, assert_true, assert_false, assert_in
+from pyformance import MetricsRegistry
+
+from apptuit.pyformance import ApptuitReporter
+from apptuit.pyformance.gc_metrics import GCMetrics
+
+
+def _skip_if_unsupported():
+    if not GCMetrics.is_supported():
+        raise SkipTest("gc.callbacks is not available")
+
+
+def _create_cycles(count):
+    for _ in range(count):
+        cycle = []
+        cycle.append(cycle)
+
+
+def test_gc_metrics():
+    """
+    Test that the collections, their pauses and the collected objects are
+    added to the registry, per generation
+    """
+    _skip_if_unsupported()
+    ticks = iter(range(1000))
+    registry = MetricsRegistry()
+    gc_metrics = GCMetrics(registry, clock=lambda: next(ticks) * 0.5)
+    try:
+        gc.collect()
+        _create_cycles(10)
+        gc.collect(2)
+        gc.collect(0)
+        gc_metrics.collect_gc_metrics()
+        pauses = registry.histogram(gc_metrics.pause_metric_names[2])
+        assert_true(pauses.get_count() >= 2)
+        assert_equals(pauses.get_max(), 0.5)
+        collections = registry.counter(gc_metrics.collection_metric_names[2])
+        assert_equals(collections.get_count(), pauses.get_count())
+        assert_true(registry.counter(gc_metrics.collection_metric_names[0]).get_count() >= 1)
+        collected = registry.counter(gc_metrics.object_metric_names[2][0])
+        assert_true(collected.get_count() >= 10)
+        collections_count = collections.get_count()
+        gc_metrics.collect_gc_metrics()
+        assert_equals(collections.get_count(), collections_count)
+    finally:
+        gc_metrics.close()
+    assert_false(gc_metrics._callback in gc.callbacks)
+    gc.collect(2)
+    gc_metrics.collect_gc_metrics()
+    assert_equals(registry.counter(gc_metrics.collection_metric_names[2]).get_count(),
+                  collections_count)
+
+
+def test_max_pending_pauses():
+    """
+    Test that the oldest pauses are dropped beyond max_pending_pauses, while
+    all the collections are counted
+    """
+    _skip_if_unsupported()
+    registry = MetricsRegistry()
+    gc_metrics = GCMetrics(registry, max_pending_pauses=2)
+    try:
+        for _ in range(5):
+            gc.collect(1)
+        gc_metrics.collect_gc_metrics()
+    finally:
+        gc_metrics.close()
+    assert_equals(registry.histogram(gc_metrics.pause_metric_names[1]).get_count(), 2)
+    assert_true(registry.counter(gc_metrics.collection_metric_names[1]).get_count() >= 5)
+
+
+def test_reporter_gc_metrics():
+    """
+    Test that the reporter collects the garbage collector metrics when enabled
+    """
+    _skip_if_unsupported()
+    registry = MetricsRegistry()
+    reporter = ApptuitReporter(registry=registry, token="asdashdsauh_8aeraerf",
+                               tags={"host": "localhost"}, collect_gc_metrics=True)
+    try:
+        gc.collect()
+        dps = reporter._collect_report()
+    finally:
+        reporter.stop()
+    assert_false(reporter.gc_metrics._callback in gc.callbacks)
+    metrics = set(dp.metric for dp in dps)
+    assert_in("python.gc.pause.seconds.max", metrics)
+    assert_in("python.gc.collections.count", metrics)
+    assert_false(ApptuitReporter(token="asdashdsauh_8aeraerf").gc_metrics)
@@ -0,0 +1,120 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Tests for the scheduling lag monitor
+"""
+import threading
+import time
+
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_equals, assert_true, assert_raises, assert_is_none
+from pyformance import MetricsRegistry
+
+from apptuit.pyformance import ApptuitReporter, LagMonitor
+from apptuit.pyformance import lag_monitor
+
+try:
+    from unittest.mock import Mock
+except ImportError:
+    from mock import Mock
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def test_thread_lag():
+    """
+    Test that the lag of the sampling thread is sampled until the monitor is stopped
+    """
+    registry = MetricsRegistry()
+    monitor = LagMonitor(registry, sampling_interval=0.01)
+    monitor.start()
+    histogram = registry.histogram(monitor.thread_lag_metric_name)
+    _wait_for(lambda: histogram.get_count() >= 3)
+    monitor.stop()
+    assert_is_none(monitor._thread)
+    count = histogram.get_count()
+    assert_true(count >= 3)
+    assert_true(histogram.get_min() >= 0)
+    time.sleep(0.05)
+    assert_equals(histogram.get_count(), count)
+    with assert_raises(ValueError):
+        LagMonitor(registry, sampling_interval=0)
+
+    # stop does not wait for the end of the sampling interval
+    monitor = LagMonitor(registry, sampling_interval=60)
+    monitor.start()
+    start = time.time()
+    monitor.stop()
+    assert_true(time.time() - start < 5)
+
+
+def test_event_loop_lag():
+    """
+    Test that the lag, the tasks and the slow callbacks of an event loop are sampled
+    """
+    if lag_monitor.asyncio is None:
+        raise SkipTest("asyncio is not available")
+    asyncio = lag_monitor.asyncio
+    loop = asyncio.new_event_loop()
+    loop_thread = threading.Thread(target=loop.run_forever)
+    loop_thread.start()
+    registry = MetricsRegistry()
+    monitor = LagMonitor(registry, sampling_interval=0.01, loop=loop,
+                         slow_callback_duration=0.1)
+    try:
+        monitor.start()
+        lag = registry.histogram(monitor.loop_lag_metric_name)
+        _wait_for(lambda: lag.get_count() >= 2)
+        slow_callbacks = registry.counter(monitor.slow_callback_metric_name)
+        assert_equals(slow_callbacks.get_count(), 0)
+        loop.call_soon_threadsafe(time.sleep, 0.3)
+        _wait_for(lambda: slow_callbacks.get_count() >= 1)
+        assert_equals(slow_callbacks.get_count(), 1)
+        assert_true(lag.get_max() >= 0.1)
+        assert_equals(registry.gauge(monitor.task_metric_name).get_value(), 0)
+    finally:
+        monitor.stop()
+        loop.call_soon_threadsafe(loop.stop)
+        loop_thread.join()
+        loop.close()
+    monitor._probe_loop()
+    assert_true(not monitor._probe_pending)
+
+
+def test_reporter_lag_monitor():
+    """
+    Test that the reporter starts and stops its lag monitor
+    """
+    registry = MetricsRegistry()
+    reporter = ApptuitReporter(registry=registry, token="asdashdsauh_8aeraerf",
+                               reporting_interval=60, lag_sampling_interval=0.01)
+    reporter.client.send = Mock()
+    reporter.start()
+    try:
+        histogram = registry.histogram(reporter.lag_monitor.thread_lag_metric_name)
+        _wait_for(lambda: histogram.get_count() >= 1)
+        assert_true(histogram.get_count() >= 1)
+    finally:
+        reporter.stop()
+    assert_is_none(reporter.lag_monitor._thread)
+    assert_is_none(ApptuitReporter(token="asdashdsauh_8aeraerf").lag_monitor)
+    with assert_raises(ValueError):
+        ApptuitReporter(token="asdashdsauh_8aeraerf", event_loop=object())
@@ -0,0 +1,240 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Tests for the /proc based process metrics
+"""
+import os
+import shutil
+import tempfile
+import threading
+
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_equals, assert_true, assert_false
+from pyformance import MetricsRegistry
+
+from apptuit.pyformance.linux_process_metrics import LinuxProcessMetrics
+from .helpers import get_values, write_file
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+STAT = "%d (python (worker) 1) %s 1 1 1 0 -1 4194560 2000 0 0 0 150 30 0 0 20 0 %d 0 " \
+       "1000 %d %d 18446744073709551615 1 1 0 0 0 0 0 16781312 2 0 0 0 17 3 0 0 0 0 0\n"
+STATUS = "Name:\tpython\nState:\tS (sleeping)\nVmPeak:\t  300000 kB\nVmSize:\t  250000 kB\n" \
+         "VmRSS:\t   40000 kB\nVmSwap:\t     128 kB\nThreads:\t3\n"
+IO = "rchar: 5000\nwchar: 3000\nsyscr: 10\nsyscw: 5\nread_bytes: %d\nwrite_bytes: %d\n" \
+     "cancelled_write_bytes: 0\n"
+
+
+def _create_proc_dir(path, thread_states, read_bytes, write_bytes):
+    write_file(os.path.join(path, "stat"), STAT % (1, "S", len(thread_states), 256000000, 10000))
+    write_file(os.path.join(path, "status"), STATUS)
+    write_file(os.path.join(path, "io"), IO % (read_bytes, write_bytes))
+    os.mkdir(os.path.join(path, "fd"))
+    for fd in range(5):
+        write_file(os.path.join(path, "fd", str(fd)), "")
+    for task_id, state in enumerate(thread_states):
+        os.makedirs(os.path.join(path, "task", str(task_id)))
+        write_file(os.path.join(path, "task", str(task_id), "stat"),
+                   STAT % (task_id, state, 1, 0, 0))
+
+
+def test_collect_from_proc_files():
+    """
+    Test the metrics collected from the files of a /proc directory
+    """
+    path = tempfile.mkdtemp()
+    try:
+        _create_proc_dir(path, "RSSDZ", 4096, 8192)
+        registry = MetricsRegistry()
+        collector = LinuxProcessMetrics(registry, proc_path=path)
+        collector.collect_process_metrics()
+        values = get_values(registry, ("type", "state"))
+        assert_equals(values["python.process.memory.bytes.virtual"], 256000000)
+        assert_equals(values["python.process.memory.bytes.resident"],
+                      10000 * collector.page_size)
+        assert_equals(values["python.process.memory.bytes.swap"], 128 * 1024)
+        assert_equals(values["python.process.io.bytes.read"], 4096)
+        assert_equals(values["python.process.io.bytes.write"], 8192)
+        assert_equals(registry.gauge(collector.fd_metric_name).get_value(), 2)
+        assert_equals(values["python.process.threads.running"], 1)
+        assert_equals(values["python.process.threads.sleeping"], 2)
+        assert_equals(values["python.process.threads.disk_sleep"], 1)
+        assert_equals(values["python.process.threads.zombie"], 1)
+        assert_equals(values["python.process.threads.stopped"], 0)
+
+        shutil.rmtree(os.path.join(path, "task", "4"))
+        write_file(os.path.join(path, "io"), IO % (5000, 8192))
+        collector.collect_process_metrics()
+        values = get_values(registry, ("type", "state"))
+        assert_equals(values["python.process.io.bytes.read"], 5000)
+        assert_equals(values["python.process.io.bytes.write"], 8192)
+        assert_equals(values["python.process.threads.zombie"], 0)
+        assert_equals(len(collector._task_fds), 4)
+        collector.close()
+        assert_equals(collector._task_fds, {})
+
+        # only max_task_fds stat files of the threads are kept open
+        registry = MetricsRegistry()
+        collector = LinuxProcessMetrics(registry, proc_path=path, max_task_fds=2)
+        for _ in range(2):
+            collector.collect_process_metrics()
+            values = get_values(registry, ("type", "state"))
+            assert_equals(values["python.process.threads.sleeping"], 2)
+            assert_equals(values["python.process.threads.disk_sleep"], 1)
+            assert_equals(len(collector._task_fds), 2)
+        collector.close()
+    finally:
+        shutil.rmtree(path)
+
+
+def test_collect_after_fork():
+    """
+    Test that after a fork the metrics are tagged with the pid of the child, and
+    its counters do not start from the values of the parent
+    """
+    path = tempfile.mkdtemp()
+    try:
+        _create_proc_dir(path, "RS", 4096, 8192)
+        registry = MetricsRegistry()
+        collector = LinuxProcessMetrics(registry, proc_path=path)
+        collector.collect_process_metrics()
+        parent_io_metric_name = collector.io_metric_names["read"]
+        child_pid = os.getpid() + 1
+        write_file(os.path.join(path, "io"), IO % (1024, 0))
+        with patch.object(os, "getpid", return_value=child_pid):
+            collector.collect_process_metrics()
+        assert_equals(collector.pid, child_pid)
+        assert_true(str(child_pid) in collector.io_metric_names["read"])
+        assert_equals(registry.counter(parent_io_metric_name).get_count(), 4096)
+        assert_equals(registry.counter(collector.io_metric_names["read"]).get_count(), 1024)
+        assert_equals(registry.counter(collector.io_metric_names["write"]).get_count(), 0)
+        assert_true(all(str(child_pid) in metric_name for metric_names
+                        in collector.thread_cpu_metric_names.values()
+                        for metric_name in metric_names))
+        collector.close()
+    finally:
+        shutil.rmtree(path)
+
+
+def test_missing_proc_files():
+    """
+    Test that the metrics of the files which cannot be read are not collected
+    """
+    path = tempfile.mkdtemp()
+    try:
+        assert_false(LinuxProcessMetrics.is_supported(path))
+        write_file(os.path.join(path, "stat"), STAT % (1, "R", 1, 1000, 10))
+        assert_true(LinuxProcessMetrics.is_supported(path))
+        registry = MetricsRegistry()
+        collector = LinuxProcessMetrics(registry, proc_path=path)
+        collector.collect_process_metrics()
+        assert_equals(sorted(get_values(registry, ("type", "state"))),
+                      ["python.process.memory.bytes.resident",
+                       "python.process.memory.bytes.virtual"])
+        collector.close()
+    finally:
+        shutil.rmtree(path)
+
+
+def test_collect_from_proc_self():
+    """
+    Test the metrics collected from the /proc directory of the current process
+    """
+    if not LinuxProcessMetrics.is_supported():
+        raise SkipTest("/proc is not available")
+    registry = MetricsRegistry()
+    collector = LinuxProcessMetrics(registry)
+    stop = threading.Event()
+    thread = threading.Thread(target=stop.wait)
+    thread.start()
+    try:
+        collector.collect_process_metrics()
+    finally:
+        stop.set()
+        thread.join()
+    values = get_values(registry, ("type", "state"))
+    assert_true(values["python.process.memory.bytes.resident"] > 0)
+    assert_true(values["python.process.memory.bytes.virtual"] >=
+                values["python.process.memory.bytes.resident"])
+    assert_true(sum(count for key, count in values.items()
+                    if key.startswith("python.process.threads")) >= 2)
+    fd_count = registry.gauge(collector.fd_metric_name).get_value()
+    read_fd, write_fd = os.pipe()
+    collector.collect_process_metrics()
+    assert_equals(registry.gauge(collector.fd_metric_name).get_value(), fd_count + 2)
+    os.close(read_fd)
+    os.close(write_fd)
+    collector.close()
+
+
+def test_thread_cpu():
+    """
+    Test that the CPU time of the threads is reported per thread name, with
+    the numbers removed from the names and a limit on the number of names
+    """
+    path = tempfile.mkdtemp()
+    try:
+        _create_proc_dir(path, "SSSS", 0, 0)
+        for task_id, name in enumerate(["MainThread", "worker-1", "worker_2", "reporter"]):
+            write_file(os.path.join(path, "task", str(task_id), "stat"),
+                       STAT.replace("python (worker) 1", name) % (task_id, "S", 1, 0, 0))
+        registry = MetricsRegistry()
+        collector = LinuxProcessMetrics(registry, proc_path=path, max_thread_names=2)
+        collector.collect_process_metrics()
+        assert_equals(sorted(collector.thread_cpu_metric_names),
+                      ["MainThread", "other", "worker"])
+        user_metric_name, system_metric_name = collector.thread_cpu_metric_names["worker"]
+        ticks = collector.clock_ticks
+        assert_equals(registry.counter(user_metric_name).get_count(), 2 * 150 / ticks)
+        assert_equals(registry.counter(system_metric_name).get_count(), 2 * 30 / ticks)
+        user_metric_name = collector.thread_cpu_metric_names["other"][0]
+        assert_equals(registry.counter(user_metric_name).get_count(), 150 / ticks)
+        write_file(os.path.join(path, "task", "1", "stat"),
+                   STAT.replace("python (worker) 1", "worker-1").replace(" 150 30 ", " 250 30 ")
+                   % (1, "S", 1, 0, 0))
+        collector.collect_process_metrics()
+        user_metric_name = collector.thread_cpu_metric_names["worker"][0]
+        assert_equals(registry.counter(user_metric_name).get_count(), 400 / ticks)
+        collector.close()
+    finally:
+        shutil.rmtree(path)
+
+
+def test_thread_cpu_from_proc_self():
+    """
+    Test that the CPU time of the python threads is reported under their names
+    """
+    if not LinuxProcessMetrics.is_supported():
+        raise SkipTest("/proc is not available")
+    if not hasattr(threading.Thread, "native_id"):
+        raise SkipTest("the native ids of the threads are not available")
+    registry = MetricsRegistry()
+    collector = LinuxProcessMetrics(registry)
+    stop = threading.Event()
+    thread = threading.Thread(target=stop.wait, name="apptuit-test-42")
+    thread.start()
+    try:
+        collector.collect_process_metrics()
+    finally:
+        stop.set()
+        thread.join()
+    assert_true("apptuit-test" in collector.thread_cpu_metric_names)
+    assert_true("MainThread" in collector.thread_cpu_metric_names)
+    collector.close()
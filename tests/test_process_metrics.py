@@ -0,0 +1,130 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Tests for the process metrics
+"""
+import gc
+import resource
+
+from nose.tools import assert_equals, assert_true, assert_false, assert_is_none, assert_raises
+from pyformance import MetricsRegistry
+
+from apptuit.pyformance import ApptuitReporter
+from apptuit.pyformance.linux_process_metrics import LinuxProcessMetrics
+from apptuit.pyformance.process_metrics import ProcessMetrics, RESOURCE_STRUCT_RUSAGE
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+
+def _rusage(**values):
+    usage = dict((name, 0) for name in RESOURCE_STRUCT_RUSAGE)
+    usage.update(values)
+    return type("rusage", (object,), usage)
+
+
+def _has_open_fds_metric(registry):
+    return any(key.startswith("python.process.open.fds") for key in registry.dump_metrics())
+
+
+def test_resource_counters():
+    """
+    Test that the resource counters are incremented by the differences between
+    the values of two collections, so that they hold the values of getrusage
+    """
+    registry = MetricsRegistry()
+    process_metrics = ProcessMetrics(registry)
+    names = process_metrics.resource_metric_names
+    with patch.object(resource, "getrusage",
+                      return_value=_rusage(ru_utime=1.5, ru_maxrss=100, ru_minflt=10,
+                                           ru_majflt=2)):
+        process_metrics.collect_process_metrics()
+    with patch.object(resource, "getrusage",
+                      return_value=_rusage(ru_utime=2.5, ru_maxrss=150, ru_minflt=30,
+                                           ru_majflt=3)):
+        process_metrics.collect_process_metrics()
+        process_metrics.collect_process_metrics()
+    values = dict((name, registry.counter(name).get_count()) for name in names)
+    assert_equals(values['python.cpu.time.used.seconds{"type": "user", "worker_id": %d}'
+                         % process_metrics.pid], 2.5)
+    assert_equals(values['python.memory.usage.bytes{"type": "main", "worker_id": %d}'
+                         % process_metrics.pid], 150 * 1024)
+    assert_equals(values['python.page.faults{"type": "minor", "worker_id": %d}'
+                         % process_metrics.pid], 30)
+    assert_equals(values['python.page.faults{"type": "major", "worker_id": %d}'
+                         % process_metrics.pid], 3)
+
+
+def test_gc_and_thread_metrics():
+    """
+    Test that the gc counters hold the values of the collection counts and
+    thresholds, and that the thread gauges count the threads
+    """
+    registry = MetricsRegistry()
+    process_metrics = ProcessMetrics(registry)
+    for _ in range(3):
+        process_metrics.collect_process_metrics()
+    thresholds = [registry.counter(name).get_count()
+                  for name in process_metrics.gc_metric_names[3:]]
+    assert_equals(thresholds, list(gc.get_threshold()))
+    gauges = [registry.gauge(name).get_value() for name in process_metrics.thread_metrics_names]
+    assert_true(gauges[1] >= 1)
+
+
+def test_metrics_after_registry_clear():
+    """
+    Test that the metrics are registered again after the registry is cleared
+    """
+    registry = MetricsRegistry()
+    process_metrics = ProcessMetrics(registry)
+    process_metrics.collect_process_metrics()
+    registry.clear()
+    process_metrics.collect_process_metrics()
+    for name in process_metrics.resource_metric_names + process_metrics.gc_metric_names:
+        assert_true(name in registry._counters)
+    for name in process_metrics.thread_metrics_names:
+        assert_true(name in registry._gauges)
+
+
+def test_linux_process_metrics_opt_in():
+    """
+    Test that the metrics read from /proc are only collected when they are enabled
+    """
+    registry = MetricsRegistry()
+    process_metrics = ProcessMetrics(registry)
+    assert_is_none(process_metrics.linux_process_metrics)
+    process_metrics.collect_process_metrics()
+    assert_false(_has_open_fds_metric(registry))
+    reporter = ApptuitReporter(token="asdashdsauh_8aeraerf", collect_process_metrics=True)
+    assert_is_none(reporter.process_metrics.linux_process_metrics)
+    with assert_raises(ValueError):
+        ApptuitReporter(token="asdashdsauh_8aeraerf", collect_linux_process_metrics=True)
+    if not LinuxProcessMetrics.is_supported():
+        return
+    registry = MetricsRegistry()
+    process_metrics = ProcessMetrics(registry, collect_linux_metrics=True)
+    process_metrics.collect_process_metrics()
+    assert_true(_has_open_fds_metric(registry))
+    process_metrics.linux_process_metrics.close()
+    reporter = ApptuitReporter(token="asdashdsauh_8aeraerf", collect_process_metrics=True,
+                               collect_linux_process_metrics=True)
+    linux_process_metrics = reporter.process_metrics.linux_process_metrics
+    assert_true(isinstance(linux_process_metrics, LinuxProcessMetrics))
+    reporter.stop()
+    assert_is_none(linux_process_metrics._stat_fd)
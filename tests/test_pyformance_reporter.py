@@ -22,16 +22,19 @@
 import os
 import random
 import socket
+import threading
 import time
 
-from nose.tools import assert_raises, assert_in, assert_equals, assert_greater_equal, \
-    assert_is_none
+from nose.tools import assert_raises, assert_in, assert_equals, assert_greater_equal, assert_true, \
+    assert_false, assert_is_none
 from pyformance import MetricsRegistry
 from requests.exceptions import HTTPError
 
 from apptuit import ApptuitSendException, APPTUIT_PY_TOKEN, APPTUIT_PY_TAGS
 from apptuit.pyformance.apptuit_reporter import ApptuitReporter, BATCH_SIZE, \
-    NUMBER_OF_TOTAL_POINTS, NUMBER_OF_SUCCESSFUL_POINTS, NUMBER_OF_FAILED_POINTS, DISABLE_HOST_TAG
+    NUMBER_OF_TOTAL_POINTS, NUMBER_OF_SUCCESSFUL_POINTS, NUMBER_OF_FAILED_POINTS, DISABLE_HOST_TAG, \
+    NUMBER_OF_SUPPRESSED_POINTS, NUMBER_OF_DROPPED_REPORTS, NUMBER_OF_SERIES, NUMBER_OF_OVERFLOW_POINTS, \
+    CURRENT_BATCH_SIZE, DEFAULT_FIELDS, MIN_BATCH_SIZE, _BatchSizer
 from apptuit.utils import sanitize_name_prometheus, sanitize_name_apptuit
 
 try:
@@ -40,6 +43,13 @@ except ImportError:
     from mock import Mock, patch
 
 
+def _data_points(dps):
+    """
+    The points of a batch which are not points of the meta metrics of the reporter
+    """
+    return [dp for dp in dps if not dp.metric.startswith("apptuit.reporter.")]
+
+
 @patch('apptuit.apptuit_client.requests.post')
 def test_batch_send(mock_post):
     """
@@ -473,11 +483,11 @@ def test_meta_metrics_of_reporter(mock_post):
     reporter.report_now()
     dps = reporter._collect_data_points(reporter._meta_metrics_registry)
     dps = sorted(dps, key=lambda x: x.metric)
-    assert_equals(len(dps), 18)
-    assert_equals(dps[0].metric, "apptuit.reporter.send.failed.count")
-    assert_equals(dps[1].metric, "apptuit.reporter.send.successful.count")
-    assert_equals(dps[11].metric, "apptuit.reporter.send.time.count")
-    assert_equals(dps[17].metric, "apptuit.reporter.send.total.count")
+    assert_equals(len(dps), 19)
+    assert_equals(dps[1].metric, "apptuit.reporter.send.failed.count")
+    assert_equals(dps[2].metric, "apptuit.reporter.send.successful.count")
+    assert_equals(dps[12].metric, "apptuit.reporter.send.time.count")
+    assert_equals(dps[18].metric, "apptuit.reporter.send.total.count")
 
 
 @patch('apptuit.apptuit_client.requests.post')
@@ -520,6 +530,11 @@ def test_process_metrics_of_reporter_is_active(mock_post):
         assert_in(i, registry._gauges)
     for i in reporter.process_metrics.gc_metric_names:
         assert_in(i, registry._counters)
+    linux_process_metrics = reporter.process_metrics.linux_process_metrics
+    if linux_process_metrics:
+        for i in linux_process_metrics.memory_metric_names.values():
+            assert_in(i, registry._gauges)
+        assert_in(linux_process_metrics.fd_metric_name, registry._gauges)
 
 
 @patch('apptuit.apptuit_client.requests.post')
@@ -557,12 +572,12 @@ def test_prometheus_sanitizer_of_reporter(mock_post):
     reporter.report_now()
     dps = reporter._collect_data_points(reporter._meta_metrics_registry)
     payload = reporter.client._create_payload_from_datapoints(dps)
-    assert_equals(len(payload), 18)
+    assert_equals(len(payload), 19)
     payload = sorted(payload, key=lambda x: x['metric'])
-    assert_equals(payload[0]['metric'], "apptuit_reporter_send_failed_count")
-    assert_equals(payload[1]['metric'], "apptuit_reporter_send_successful_count")
-    assert_equals(payload[11]['metric'], "apptuit_reporter_send_time_count")
-    assert_equals(payload[17]['metric'], "apptuit_reporter_send_total_count")
+    assert_equals(payload[1]['metric'], "apptuit_reporter_send_failed_count")
+    assert_equals(payload[2]['metric'], "apptuit_reporter_send_successful_count")
+    assert_equals(payload[12]['metric'], "apptuit_reporter_send_time_count")
+    assert_equals(payload[18]['metric'], "apptuit_reporter_send_total_count")
 
 
 @patch('apptuit.apptuit_client.requests.post')
@@ -598,11 +613,11 @@ def test_prometheus_sanitizer_of_reporter_disabled(mock_post):
     dps = reporter._collect_data_points(reporter._meta_metrics_registry)
     payload = reporter.client._create_payload_from_datapoints(dps)
     payload = sorted(payload, key=lambda x: x['metric'])
-    assert_equals(len(dps), 18)
-    assert_equals(payload[0]['metric'], "apptuit.reporter.send.failed.count")
-    assert_equals(payload[1]['metric'], "apptuit.reporter.send.successful.count")
-    assert_equals(payload[11]['metric'], "apptuit.reporter.send.time.count")
-    assert_equals(payload[17]['metric'], "apptuit.reporter.send.total.count")
+    assert_equals(len(dps), 19)
+    assert_equals(payload[1]['metric'], "apptuit.reporter.send.failed.count")
+    assert_equals(payload[2]['metric'], "apptuit.reporter.send.successful.count")
+    assert_equals(payload[12]['metric'], "apptuit.reporter.send.time.count")
+    assert_equals(payload[18]['metric'], "apptuit.reporter.send.total.count")
 
 
 @patch('apptuit.apptuit_client.requests.post')
@@ -640,12 +655,12 @@ def test_apptuit_sanitizer_of_reporter(mock_post):
     reporter.report_now()
     dps = reporter._collect_data_points(reporter._meta_metrics_registry)
     payload = reporter.client._create_payload_from_datapoints(dps)
-    assert_equals(len(payload), 18)
+    assert_equals(len(payload), 19)
     payload = sorted(payload, key=lambda x: x['metric'])
-    assert_equals(payload[0]['metric'], "apptuit.reporter.send.failed.count")
-    assert_equals(payload[1]['metric'], "apptuit.reporter.send.successful.count")
-    assert_equals(payload[11]['metric'], "apptuit.reporter.send.time.count")
-    assert_equals(payload[17]['metric'], "apptuit.reporter.send.total.count")
+    assert_equals(payload[1]['metric'], "apptuit.reporter.send.failed.count")
+    assert_equals(payload[2]['metric'], "apptuit.reporter.send.successful.count")
+    assert_equals(payload[12]['metric'], "apptuit.reporter.send.time.count")
+    assert_equals(payload[18]['metric'], "apptuit.reporter.send.total.count")
 
 
 def test_sanitizer_type():
@@ -662,3 +677,480 @@ def test_sanitizer_type():
     assert_equals(reporter.client.sanitizer, None)
     with assert_raises(ValueError):
         ApptuitReporter(sanitize_mode="unknown", token="test")
+
+
+def test_collect_data_points_cached_names():
+    """
+    Test that the series names of the registry keys are reused across collections
+    and rebuilt when the keys, prefix or tags change
+    """
+    registry = MetricsRegistry()
+    reporter = ApptuitReporter(sanitize_mode=None, registry=registry,
+                               api_endpoint="http://localhost",
+                               reporting_interval=1,
+                               token="asdashdsauh_8aeraerf",
+                               prefix="apr.",
+                               tags={"host": "localhost"})
+    counter1 = registry.counter('counter1 {"tk1":"tv1"}')
+    counter1.inc(2)
+    first = reporter._collect_data_points(registry)
+    counter1.inc(3)
+    second = reporter._collect_data_points(registry)
+    assert_equals(second[0].value, 5)
+    assert_true(first[0].timeseries_name is second[0].timeseries_name)
+    registry.counter('counter2').inc()
+    dps = sorted(reporter._collect_data_points(registry), key=lambda x: x.metric)
+    assert_equals([dp.metric for dp in dps], ["apr.counter1.count", "apr.counter2.count"])
+    assert_equals(dps[1].tags, {"host": "localhost"})
+    registry.clear()
+    registry.counter('counter3').inc()
+    dps = reporter._collect_data_points(registry)
+    assert_equals(len(reporter._series_plans[registry]), 1)
+    reporter.prefix = "new."
+    reporter.tags["region"] = "us-east-1"
+    dps = reporter._collect_data_points(registry)
+    assert_equals(dps[0].metric, "new.counter3.count")
+    assert_equals(dps[0].tags, {"host": "localhost", "region": "us-east-1"})
+
+
+@patch('apptuit.apptuit_client.requests.post')
+def test_report_changes_only(mock_post):
+    """
+    Test that only the changed series are sent between heartbeats and that
+    the unchanged points are counted as suppressed
+    """
+    mock_post.return_value.status_code = 204
+    registry = MetricsRegistry()
+    reporter = ApptuitReporter(sanitize_mode=None, registry=registry,
+                               api_endpoint="http://localhost",
+                               reporting_interval=1,
+                               token="asdashdsauh_8aeraerf",
+                               report_changes_only=True,
+                               heartbeat_interval=3)
+    sent = []
+    reporter.client.send = Mock(side_effect=lambda dps, **kwargs: sent.append(list(dps)))
+    counter1 = registry.counter("counter1")
+    counter2 = registry.counter("counter2")
+    counter1.inc()
+    counter2.inc()
+    reporter.report_now()
+    assert_equals(len(_data_points(sent[0])), 2)
+    counter1.inc()
+    reporter.report_now()
+    assert_equals([dp.metric for dp in _data_points(sent[1])], ["counter1.count"])
+    assert_equals(sent[1][0].value, 2)
+    reporter.report_now()
+    assert_equals(len(sent), 3)
+    assert_equals(_data_points(sent[2]), [])
+    assert_equals(reporter._meta_metrics_registry.counter(NUMBER_OF_SUPPRESSED_POINTS)
+                  .get_count(), 3)
+    reporter.report_now()
+    assert_equals(len(_data_points(sent[3])), 2)
+
+
+@patch('apptuit.apptuit_client.requests.post')
+def test_report_changes_only_failed_send(mock_post):
+    """
+    Test that the points of a failed send are sent again even if they did not change
+    """
+    registry = MetricsRegistry()
+    reporter = ApptuitReporter(sanitize_mode=None, registry=registry,
+                               api_endpoint="http://localhost",
+                               reporting_interval=1,
+                               token="asdashdsauh_8aeraerf",
+                               error_handler=None,
+                               report_changes_only=True)
+    registry.counter("counter1").inc()
+    mock_post.side_effect = ApptuitSendException("failed", 400, success=0, failed=1, errors=[])
+    with assert_raises(ApptuitSendException):
+        reporter.report_now()
+    mock_post.side_effect = None
+    mock_post.return_value.status_code = 204
+    reporter.client.send = Mock()
+    reporter.report_now()
+    assert_equals(len(_data_points(reporter.client.send.call_args_list[0][0][0])), 1)
+    with assert_raises(ValueError):
+        ApptuitReporter(token="asdashdsauh_8aeraerf", report_changes_only=True,
+                        heartbeat_interval=0)
+
+
+def test_collect_default_fields():
+    """
+    Test that the default fields are the same as the ones of registry.dump_metrics
+    """
+    registry = MetricsRegistry()
+    reporter = ApptuitReporter(sanitize_mode=None, registry=registry,
+                               token="asdashdsauh_8aeraerf", disable_host_tag=True)
+    registry.counter("counter1").inc()
+    registry.gauge("gauge1").set_value(3)
+    registry.meter("meter1").mark()
+    registry.histogram("histogram1").add(2)
+    registry.timer("timer1")._update(0.5)
+    expected = {}
+    for key, values in registry.dump_metrics().items():
+        for value_key, value in values.items():
+            expected[key + "." + value_key] = value
+    dps = reporter._collect_data_points(registry)
+    assert_equals(sorted(dp.metric for dp in dps), sorted(expected))
+    for point in dps:
+        if not point.metric.endswith("mean_rate"):
+            assert_equals(point.value, expected[point.metric])
+
+
+def test_collect_selected_fields():
+    """
+    Test that only the selected fields are reported, by metric type and name pattern
+    """
+    registry = MetricsRegistry()
+    reporter = ApptuitReporter(sanitize_mode=None, registry=registry,
+                               token="asdashdsauh_8aeraerf", disable_host_tag=True,
+                               fields={"timer": ["count", "sum"],
+                                       "histogram": ["sum", "50_percentile"]},
+                               metric_fields=[("db.*", ["count", "99_percentile", "value"])])
+    registry.timer("api.latency")._update(0.5)
+    registry.timer("db.latency")._update(0.25)
+    registry.counter("db.queries").inc()
+    registry.histogram("size").add(4)
+    registry.meter("requests").mark()
+    with patch.object(registry.timer("api.latency"), "get_snapshot") as get_snapshot:
+        dps = reporter._collect_data_points(registry)
+        assert_equals(get_snapshot.call_count, 0)
+    values = {dp.metric: dp.value for dp in dps}
+    assert_equals(sorted(values),
+                  ["api.latency.count", "api.latency.sum",
+                   "db.latency.99_percentile", "db.latency.count",
+                   "db.queries.count",
+                   "requests.15m_rate", "requests.1m_rate", "requests.5m_rate",
+                   "requests.count", "requests.mean_rate",
+                   "size.50_percentile", "size.sum"])
+    assert_equals(values["api.latency.sum"], 0.5)
+    assert_equals(values["db.latency.99_percentile"], 0.25)
+    assert_equals(values["size.50_percentile"], 4)
+
+
+def test_invalid_fields():
+    """
+    Test that unknown metric types and fields are rejected
+    """
+    for kwargs in ({"fields": {"summary": ["count"]}},
+                   {"fields": {"counter": ["sum"]}},
+                   {"metric_fields": [("db.*", ["p99"])]}):
+        with assert_raises(ValueError):
+            ApptuitReporter(token="asdashdsauh_8aeraerf", **kwargs)
+
+
+def test_aligned_reports():
+    """
+    Test that the aligned reports are scheduled on the interval boundaries, delayed
+    by the offset of the host, and timestamped with the boundaries
+    """
+    reporter = ApptuitReporter(token="asdashdsauh_8aeraerf", reporting_interval=10,
+                               tags={"host": "web-1"}, align_reports=True, max_jitter=5)
+    assert_equals(reporter.report_offset,
+                  ApptuitReporter(token="asdashdsauh_8aeraerf", reporting_interval=10,
+                                  tags={"host": "web-1"}, max_jitter=5).report_offset)
+    assert_true(0 <= reporter.report_offset < 5)
+    reporter.report_offset = 2
+    now = [1003.5]
+    reporter.clock = Mock()
+    reporter.clock.time.side_effect = lambda: now[0]
+    assert_equals(reporter._get_next_aligned_report(), (1010, 8.5))
+    now[0] = 1011.5
+    assert_equals(reporter._get_next_aligned_report(), (1010, 0.5))
+    now[0] = 1011.5
+    assert_equals(reporter._get_next_aligned_report(1010), (1020, 10.5))
+    reported = []
+
+    def wait(seconds):
+        now[0] += seconds
+        return len(reported) == 2
+    reporter._stopped.wait = wait
+    reporter.report_now = lambda registry, timestamp: reported.append((timestamp, now[0]))
+    reporter._loop()
+    assert_equals(reported, [(1010, 1012), (1020, 1022)])
+    with assert_raises(ValueError):
+        ApptuitReporter(token="asdashdsauh_8aeraerf", reporting_interval=10, max_jitter=10)
+
+
+def test_next_deadline():
+    """
+    Test that the schedule does not drift when a report overruns the interval
+    """
+    reporter = ApptuitReporter(token="asdashdsauh_8aeraerf", reporting_interval=10)
+    assert_equals(reporter._get_next_deadline(100, 101), 110)
+    assert_equals(reporter._get_next_deadline(100, 112), 110)
+    assert_equals(reporter._get_next_deadline(100, 135), 130)
+
+
+def test_send_queue():
+    """
+    Test that the reports are collected on schedule while the sender thread is
+    blocked, that the oldest reports are dropped when the queue is full, and that
+    the queued reports are sent when the reporter is stopped
+    """
+    registry = MetricsRegistry()
+    reporter = ApptuitReporter(registry=registry, token="asdashdsauh_8aeraerf",
+                               reporting_interval=0.1, send_queue_size=1)
+    registry.counter("counter1").inc()
+    send_started = threading.Event()
+    unblock_send = threading.Event()
+    sent = []
+
+    def send(dps, **kwargs):
+        send_started.set()
+        unblock_send.wait()
+        sent.append(dps)
+    reporter.client.send = send
+    reporter.start()
+    assert_true(send_started.wait(5))
+    time.sleep(0.5)
+    dropped = reporter._meta_metrics_registry.counter(NUMBER_OF_DROPPED_REPORTS).get_count()
+    assert_greater_equal(dropped, 2)
+    # stop waits for the reports still queued to be sent
+    sender_thread = reporter._sender_thread
+    stop_thread = threading.Thread(target=reporter.stop)
+    stop_thread.start()
+    reporter._loop_thread.join(5)
+    unblock_send.set()
+    stop_thread.join(5)
+    assert_false(stop_thread.is_alive())
+    assert_false(sender_thread.is_alive())
+    assert_true(reporter._send_queue.empty())
+    timestamps = [dps[0].timestamp for dps in sent if dps[0].metric == "counter1.count"]
+    assert_equals(len(timestamps), 2)
+    assert_true(timestamps[0] <= timestamps[1])
+
+
+def test_enqueue_report():
+    """
+    Test that the oldest report is dropped when the send queue is full
+    """
+    reporter = ApptuitReporter(token="asdashdsauh_8aeraerf", send_queue_size=2)
+    for report in ("first", "second", "third"):
+        reporter._enqueue_report(report)
+    assert_equals(reporter._send_queue.get_nowait(), "second")
+    assert_equals(reporter._send_queue.get_nowait(), "third")
+    assert_equals(reporter._meta_metrics_registry.counter(NUMBER_OF_DROPPED_REPORTS)
+                  .get_count(), 1)
+
+
+def test_max_series():
+    """
+    Test that the series over max_series are dropped or folded into an overflow series,
+    and that the series removed from the registry make room for new ones
+    """
+    registry = MetricsRegistry()
+    reporter = ApptuitReporter(registry=registry, token="asdashdsauh_8aeraerf",
+                               tags={"host": "localhost"}, max_series=2)
+    for i in range(4):
+        registry.counter('requests {"user": "user%d"}' % i).inc()
+    dps = reporter._collect_data_points(registry)
+    assert_equals(len(dps), 2)
+    meta_registry = reporter._meta_metrics_registry
+    assert_equals(meta_registry.gauge(NUMBER_OF_SERIES).get_value(), 2)
+    assert_equals(meta_registry.counter(NUMBER_OF_OVERFLOW_POINTS).get_count(), 2)
+    registry._counters.pop('requests {"user": "%s"}' % dps[0].tags["user"])
+    dps = reporter._collect_data_points(registry)
+    assert_equals(len(dps), 2)
+    assert_equals(meta_registry.counter(NUMBER_OF_OVERFLOW_POINTS).get_count(), 3)
+    # a key replaced by another one between two reports releases its series
+    registry._counters.pop('requests {"user": "%s"}' % dps[0].tags["user"])
+    registry.counter('requests {"user": "user4"}').inc()
+    dps = reporter._collect_data_points(registry)
+    assert_equals(len(dps), 2)
+    assert_equals(meta_registry.gauge(NUMBER_OF_SERIES).get_value(), 2)
+
+    reporter = ApptuitReporter(registry=registry, token="asdashdsauh_8aeraerf",
+                               tags={"host": "localhost"}, max_series=1,
+                               series_overflow="fold")
+    dps = reporter._collect_data_points(registry)
+    assert_equals(len(dps), 2)
+    assert_equals(dps[1].tags, {"host": "localhost", "cardinality_overflow": "true"})
+    assert_equals(dps[1].metric, "requests.count")
+    assert_equals(dps[1].value, 2)
+    assert_equals(len(reporter._collect_data_points(reporter._meta_metrics_registry)), 2)
+
+    # every field of a meter over the limit is folded
+    registry.meter("events").mark(3)
+    dps = reporter._collect_data_points(registry)
+    folded = dict((dp.metric, dp.value) for dp in dps
+                  if dp.tags.get("cardinality_overflow") == "true")
+    assert_equals(folded["events.count"], 3)
+    assert_true("events.1m_rate" in folded)
+    assert_equals(len(folded), 1 + len(DEFAULT_FIELDS["meter"]))
+
+    # the fields of a metric are admitted or folded together, and only the fields
+    # which can be combined are folded
+    registry = MetricsRegistry()
+    reporter = ApptuitReporter(registry=registry, token="asdashdsauh_8aeraerf",
+                               tags={"host": "localhost"}, max_series=2,
+                               series_overflow="fold")
+    for i in range(5):
+        registry.timer('latency {"user": "user%d"}' % i)._update(100 + i)
+        registry.gauge('size {"user": "user%d"}' % i).set_value(50)
+    dps = reporter._collect_data_points(registry)
+    # the timers do not fit under the limit, two of the gauges do
+    assert_equals([dp.metric for dp in dps if "cardinality_overflow" not in dp.tags],
+                  ["size.value", "size.value"])
+    folded = dict((dp.metric, dp.value) for dp in dps if "cardinality_overflow" in dp.tags)
+    assert_equals(sorted(folded), ["latency.15m_rate", "latency.1m_rate", "latency.5m_rate",
+                                   "latency.count", "latency.max", "latency.mean_rate",
+                                   "latency.min", "latency.sum"])
+    assert_equals(folded["latency.count"], 5)
+    assert_equals(folded["latency.sum"], 510)
+    assert_equals(folded["latency.max"], 104)
+    assert_equals(folded["latency.min"], 100)
+    meta_registry = reporter._meta_metrics_registry
+    assert_equals(meta_registry.gauge(NUMBER_OF_SERIES).get_value(), 2)
+    assert_equals(meta_registry.counter(NUMBER_OF_OVERFLOW_POINTS).get_count(),
+                  5 * len(DEFAULT_FIELDS["timer"]) + 3)
+    # one timer fits in the series left by the gauges, with all its fields
+    reporter.max_series = len(DEFAULT_FIELDS["timer"]) + 2
+    dps = reporter._collect_data_points(registry)
+    own_series = [dp for dp in dps if "cardinality_overflow" not in dp.tags]
+    assert_equals(len(own_series), len(DEFAULT_FIELDS["timer"]) + 2)
+    assert_equals(len(set(dp.tags["user"] for dp in own_series
+                          if dp.metric.startswith("latency."))), 1)
+
+
+@patch('apptuit.apptuit_client.requests.post')
+def test_evict_removed_series(mock_post):
+    """
+    Test that the series of the metrics removed from the registry are removed from the
+    series table, the payload cache and the reported values when the next report is sent
+    """
+    registry = MetricsRegistry()
+    reporter = ApptuitReporter(registry=registry, token="asdashdsauh_8aeraerf",
+                               tags={"host": "localhost"}, report_changes_only=True,
+                               send_queue_size=2)
+    mock_post.return_value.status_code = 204
+    series_table = reporter.client._series_table
+    for i in range(3):
+        registry.counter('requests {"user": "user%d"}' % i).inc()
+    first_report = reporter._collect_report()
+    reporter._send_report(first_report)
+    names = [dp.timeseries_name for dp in first_report]
+    assert_true(all(name in series_table for name in names))
+    assert_equals(len(reporter.client._series_payloads), len(series_table))
+    for i in range(3):
+        registry._counters.pop('requests {"user": "user%d"}' % i)
+    registry.counter('requests {"user": "user3"}').inc()
+    second_report = reporter._collect_report()
+    assert_equals(sorted(second_report.evicted_series, key=str), sorted(names, key=str))
+    # the reports queued before the second one are sent before the series are removed
+    reporter._send_report(first_report)
+    assert_true(all(name in series_table for name in names))
+    reporter._send_report(second_report)
+    assert_false(any(name in series_table for name in names))
+    assert_true(second_report[0].timeseries_name in series_table)
+    assert_equals(len(reporter.client._series_payloads), len(series_table))
+    assert_false(any(name in reporter._reported_values for name in names))
+
+    registry._counters.pop('requests {"user": "user3"}')
+    registry.counter('requests {"user": "user4"}').inc()
+    third_report = reporter._collect_report()
+    registry.counter('requests {"user": "user4"}').inc()
+    fourth_report = reporter._collect_report()
+    for report in (third_report, third_report, fourth_report):
+        reporter._enqueue_report(report)
+    # the series of the dropped report are removed with the next one
+    assert_equals(len(fourth_report.evicted_series), 1)
+
+
+def test_batch_sizer():
+    """
+    Test that the batch size adapts to the payload bytes and latency of the batches
+    """
+    sizer = _BatchSizer(target_bytes=1000000, target_latency=5)
+    assert_equals(sizer.size, BATCH_SIZE)
+    sizer.update(BATCH_SIZE, 2000000, 1)
+    assert_equals(sizer.size, BATCH_SIZE // 2)
+    sizer.update(BATCH_SIZE // 2, 500000, 10)
+    assert_equals(sizer.size, BATCH_SIZE // 4)
+    sizer.update(10, 100, 0.1)
+    assert_equals(sizer.size, BATCH_SIZE // 4)
+    sizer.update(BATCH_SIZE // 4, 100000, 1)
+    assert_equals(sizer.size, BATCH_SIZE // 2)
+    sizer.update(10, 100, 60)
+    assert_equals(sizer.size, MIN_BATCH_SIZE)
+    assert_false(sizer.back_off(413))
+    sizer.size = 1000
+    assert_false(sizer.back_off(400))
+    assert_false(sizer.back_off(None))
+    assert_true(sizer.back_off(503))
+    assert_equals(sizer.size, 500)
+    sizer = _BatchSizer(target_bytes=None, target_latency=None)
+    sizer.update(BATCH_SIZE, 10 ** 9, 1000)
+    assert_equals(sizer.size, BATCH_SIZE)
+
+
+def test_batch_size_back_off():
+    """
+    Test that a batch rejected as too large is sent again in smaller batches,
+    and that the batch size is reported as a meta metric
+    """
+    registry = MetricsRegistry()
+    reporter = ApptuitReporter(registry=registry, token="asdashdsauh_8aeraerf",
+                               tags={"host": "localhost"})
+    for i in range(300):
+        registry.counter("counter%d" % i).inc()
+    sent = []
+
+    def send(dps, **_):
+        if len(_data_points(dps)) > MIN_BATCH_SIZE:
+            raise ApptuitSendException("Too big payload", 413, 0, len(dps))
+        sent.append(dps)
+    reporter.client.send = send
+    reporter._batch_sizer.size = 400
+    reporter.report_now()
+    assert_equals([len(_data_points(dps)) for dps in sent], [100, 100, 100])
+    meta_registry = reporter._meta_metrics_registry
+    assert_equals(meta_registry.counter(NUMBER_OF_FAILED_POINTS).get_count(), 0)
+    assert_equals(meta_registry.counter(NUMBER_OF_TOTAL_POINTS).get_count(), 300)
+    reporter.report_now()
+    batch_size = [dp.value for dp in sent[-1] if dp.metric == CURRENT_BATCH_SIZE + ".value"]
+    assert_equals(batch_size, [MIN_BATCH_SIZE])
+    with assert_raises(ValueError):
+        ApptuitReporter(token="asdashdsauh_8aeraerf", target_batch_bytes=0)
+    with assert_raises(ValueError):
+        ApptuitReporter(token="asdashdsauh_8aeraerf", target_batch_latency=-1)
+
+
+def test_meta_points_in_last_batch():
+    """
+    Test that the meta points are sent with the last batch of data points,
+    and that the failures of that batch are counted on the data points only
+    """
+    registry = MetricsRegistry()
+    reporter = ApptuitReporter(registry=registry, token="asdashdsauh_8aeraerf",
+                               tags={"host": "localhost"}, error_handler=None)
+    for i in range(150):
+        registry.counter("counter%d" % i).inc()
+    reporter._batch_sizer.size = reporter._batch_sizer.max_size = 100
+    reporter.client.send = Mock()
+    reporter.report_now()
+    batches = [call[0][0] for call in reporter.client.send.call_args_list]
+    assert_equals([len(_data_points(dps)) for dps in batches], [100, 50])
+    assert_equals(len(batches[0]), 100)
+    assert_true(len(batches[1]) > 50)
+    reporter.client.send = Mock(side_effect=ApptuitSendException(
+        "failed", 400, success=0, failed=70, errors=[]))
+    with assert_raises(ApptuitSendException):
+        reporter.report_now()
+    meta_registry = reporter._meta_metrics_registry
+    assert_equals(meta_registry.counter(NUMBER_OF_FAILED_POINTS).get_count(), 70 + 50)
+    assert_equals(meta_registry.counter(NUMBER_OF_SUCCESSFUL_POINTS).get_count(), 150 + 30)
+
+
+def test_meta_points_without_data_points():
+    """
+    Test that the meta points are sent alone when the registry has no metrics
+    """
+    reporter = ApptuitReporter(registry=MetricsRegistry(), token="asdashdsauh_8aeraerf",
+                               tags={"host": "localhost"})
+    reporter.client.send = Mock()
+    reporter.report_now()
+    assert_equals(reporter.client.send.call_count, 1)
+    batch = reporter.client.send.call_args[0][0]
+    assert_true(batch)
+    assert_true(all(dp.metric.startswith("apptuit.reporter.") for dp in batch))
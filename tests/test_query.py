@@ -1,3 +1,5 @@
+# coding=utf-8
+
 #
 # Copyright 2018 Agilx, Inc.
 #
@@ -18,7 +20,13 @@
 Tests for the query API
 """
 
+import json
+import os
+import shutil
 import sys
+import tempfile
+import threading
+import time
 
 from requests import Response
 
@@ -27,10 +35,17 @@ try:
 except ImportError:
     from mock import Mock, patch
 
+try:
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from urllib.parse import parse_qs, urlparse
+
 from nose.tools import assert_is_not_none, assert_is_none, assert_equals, assert_true, assert_raises
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import requests
-from apptuit import Apptuit, ApptuitException, apptuit_client
+from apptuit import Apptuit, ApptuitException, SeriesTable, apptuit_client
 
 
 def get_mock_response():
@@ -487,3 +502,383 @@ def test_missing_pandas(mock_get):
         resp = do_query(mock_get)
         with assert_raises(ImportError):
             resp[0].to_df()
+
+
+@patch('apptuit.apptuit_client.requests.get')
+def test_to_arrow(mock_get):
+    """
+    Test that the arrow table holds the same points as the dataframe, in long format
+    """
+    resp = do_query(mock_get)
+    df = resp[0].to_df()
+    table = resp[0].to_arrow()
+    assert_equals(table.column_names, ["timestamp", "value", "metric", "host"])
+    assert_equals(table.num_rows, len(df))
+    assert_equals(table.column("value").to_pylist(), df.iloc[:, 0].tolist())
+    assert_true(pa.types.is_dictionary(table.schema.field("metric").type))
+    assert_true(pa.types.is_dictionary(table.schema.field("host").type))
+    assert_equals(set(table.column("metric").to_pylist()), {"nyc.taxi.rides"})
+    assert_equals(set(table.column("host").to_pylist()), {"localhost"})
+
+
+def test_query_result_to_arrow_tags():
+    """
+    Test that series with different tag keys and outputs are combined into one table
+    """
+    result = apptuit_client.QueryResult(1)
+    cpu = apptuit_client.Output()
+    cpu.series.append(apptuit_client.TimeSeries("cpu", {"host": "a"}, [1, 2], [1.0, 2.0]))
+    cpu.series.append(apptuit_client.TimeSeries("cpu", {"host": "b", "dc": "x"}, [1], [3.0]))
+    cpu.series.append(apptuit_client.TimeSeries("cpu", {"host": "c"}))
+    load = apptuit_client.Output()
+    load.series.append(apptuit_client.TimeSeries("load", {"host": "a"}, [5], [0.5]))
+    result["cpu"] = cpu
+    result["load"] = load
+    table = result.to_arrow()
+    assert_equals(table.column_names, ["timestamp", "value", "metric", "output", "dc", "host"])
+    assert_equals(table.column("value").to_pylist(), [1.0, 2.0, 3.0, 0.5])
+    assert_equals(table.column("output").to_pylist(), ["cpu", "cpu", "cpu", "load"])
+    assert_equals(table.column("host").to_pylist(), ["a", "a", "b", "a"])
+    assert_equals(table.column("dc").to_pylist(), [None, None, "x", None])
+
+
+@patch('apptuit.apptuit_client.requests.get')
+def test_to_parquet(mock_get):
+    """
+    Test that the query result can be written to and read back from a Parquet file
+    """
+    resp = do_query(mock_get)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, "result.parquet")
+        resp.to_parquet(path)
+        table = pq.read_table(path, memory_map=True)
+        assert_equals(table.to_pydict(), resp.to_arrow().to_pydict())
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+@patch('apptuit.apptuit_client.requests.get')
+def test_missing_pyarrow(mock_get):
+    resp = do_query(mock_get)
+    with patch.dict(sys.modules, {'pyarrow': None, 'pyarrow.parquet': None}):
+        with assert_raises(ImportError):
+            resp[0].to_arrow()
+        with assert_raises(ImportError):
+            resp.to_parquet("result.parquet")
+
+
+def test_shared_tags():
+    """
+    Test that series with identical tags share a single immutable tags dictionary
+    """
+    resp = json.dumps({"outputs": [{"id": "cpu", "result": [
+        {"metric": "cpu", "tags": {"host": "a", "type": "idle"}, "dps": [[10, 1.0]]},
+        {"metric": "cpu", "tags": {"type": "idle", "host": "a"}, "dps": [[10, 2.0]]},
+        {"metric": "cpu", "tags": {"host": "b", "type": "idle"}, "dps": [[10, 3.0]]}]}]})
+    result = apptuit_client._parse_response(resp, 0)
+    first, second, third = result[0].series
+    assert_true(first.tags is second.tags)
+    assert_true(first.tags is not third.tags)
+    assert_equals(third.tags, {"host": "b", "type": "idle"})
+    assert_equals(str(first.name), 'cpu{"host": "a", "type": "idle"}')
+    with assert_raises(TypeError):
+        first.tags["host"] = "c"
+    with assert_raises(TypeError):
+        first.tags.update({"host": "c"})
+    tags = first.tags.copy()
+    tags["host"] = "c"
+    assert_equals(second.tags, {"host": "a", "type": "idle"})
+
+
+def _chunked(content, size):
+    content = content.encode("utf-8")
+    return [content[i:i + size] for i in range(0, len(content), size)]
+
+
+@patch('apptuit.apptuit_client.requests.get')
+def test_iter_query(mock_get):
+    """
+    Test that iterating over the query yields the same series as query()
+    """
+    expected = do_query(mock_get)[0].series
+    mock_get.return_value.iter_content.return_value = _chunked(get_mock_response(), 7)
+    client = Apptuit(sanitize_mode=None, token='sdksdk203afdsfj_sadasd3939')
+    series = list(client.iter_query("fetch('nyc.taxi.rides')", 1406831400, 1407609000))
+    assert_equals(len(series), len(expected))
+    output_id, first = series[0]
+    assert_equals(output_id, "nyc.taxi.rides")
+    assert_equals(first.metric, expected[0].metric)
+    assert_equals(first.tags, expected[0].tags)
+    assert_equals(first.timestamps, expected[0].timestamps)
+    assert_equals(first.values, expected[0].values)
+    _, kwargs = mock_get.call_args
+    assert_true(kwargs["stream"])
+    assert_true(mock_get.return_value.close.called)
+
+
+@patch('apptuit.apptuit_client.requests.get')
+def test_iter_query_multiple_outputs(mock_get):
+    """
+    Test iterating over multiple outputs, including the id appearing after the results,
+    empty results and multi-byte characters split across chunks
+    """
+    resp = json.dumps({
+        "hints": [], "outputs": [
+            {"id": u"cpu", "result": [
+                {"metric": "cpu", "tags": {"host": u"a-本語"}, "dps": [[10, 1.0], [20, 2.5]]},
+                {"metric": "cpu", "tags": {"host": "b"}, "dps": [[10, 3]]}]},
+            {"result": [], "id": "empty"},
+            {"result": [{"metric": "load", "tags": {"host": "a"}, "dps": [[30, 4.0]]}],
+             "id": "load"}],
+        "query_stats": {"numSeries": 3}}, ensure_ascii=False)
+    mock_get.return_value.status_code = 200
+    client = Apptuit(sanitize_mode=None, token='sdksdk203afdsfj_sadasd3939')
+    for size in (1, 3, 1024):
+        mock_get.return_value.iter_content.return_value = _chunked(resp, size)
+        series = list(client.iter_query("query", 0, 25))
+        assert_equals([(output_id, s.metric, s.tags, s.timestamps, s.values)
+                       for output_id, s in series],
+                      [("cpu", "cpu", {"host": u"a-本語"}, [10, 20], [1.0, 2.5]),
+                       ("cpu", "cpu", {"host": "b"}, [10], [3]),
+                       ("load", "load", {"host": "a"}, [], [])])
+
+
+@patch('apptuit.apptuit_client.requests.get')
+def test_iter_query_invalid_response(mock_get):
+    """
+    Test that a truncated response raises an error
+    """
+    mock_get.return_value.status_code = 200
+    mock_get.return_value.iter_content.return_value = _chunked(get_mock_response()[:500], 64)
+    client = Apptuit(sanitize_mode=None, token='sdksdk203afdsfj_sadasd3939')
+    with assert_raises(ValueError):
+        list(client.iter_query("fetch('nyc.taxi.rides')", 1406831400, 1407609000))
+    assert_true(mock_get.return_value.close.called)
+
+
+@patch('apptuit.apptuit_client.requests.get')
+def test_iter_query_retries(mock_get):
+    """
+    Test that the request is retried before the response is read
+    """
+    mock_get.side_effect = requests.exceptions.ConnectionError
+    client = Apptuit(sanitize_mode=None, token='sdksdk203afdsfj_sadasd3939')
+    with patch('apptuit.apptuit_client.time.sleep'):
+        with assert_raises(requests.exceptions.ConnectionError):
+            list(client.iter_query("fetch('nyc.taxi.rides')", 1406831400, retry_count=2))
+    assert_equals(mock_get.call_count, 3)
+
+
+def _mock_window_response(url, **kwargs):
+    """
+    Build a query response for the start and end of the requested url, series `a` has a
+    point every 10 seconds and series `b` only after 100
+    """
+    params = parse_qs(urlparse(url).query)
+    start, end = int(params["start"][0]), int(params["end"][0])
+    results = []
+    for host, first in (("a", 0), ("b", 100)):
+        dps = [[ts, float(ts)] for ts in range(0, 200, 10) if ts >= max(start, first) and ts <= end]
+        if dps:
+            results.append({"metric": "cpu", "tags": {"host": host}, "dps": dps})
+    response = Mock()
+    response.content = json.dumps({"outputs": [{"id": "cpu", "result": results}]})
+    return response
+
+
+@patch('apptuit.apptuit_client.requests.get')
+def test_query_frames(mock_get):
+    """
+    Test that the time range is queried window by window with consistent columns
+    """
+    mock_get.side_effect = _mock_window_response
+    client = Apptuit(sanitize_mode=None, token='sdksdk203afdsfj_sadasd3939')
+    frames = list(client.query_frames("fetch('cpu')", 0, 199, chunk="1m"))
+    assert_equals(mock_get.call_count, 4)
+    assert_equals([len(df) for df in frames], [6, 6, 6, 2])
+    col_a = 'cpu{host:a}'
+    col_b = 'cpu{host:b}'
+    assert_equals(list(frames[0].columns), [col_a])
+    assert_equals(list(frames[1].columns), [col_a, col_b])
+    assert_equals(list(frames[3].columns), [col_a, col_b])
+    assert_equals(frames[1][col_b].isnull().sum(), 4)
+    combined = pd.concat(frames)
+    assert_equals(len(combined), 20)
+    assert_true(combined.index.is_unique)
+    assert_equals(combined[col_a].sum(), sum(range(0, 200, 10)))
+
+
+@patch('apptuit.apptuit_client.requests.get')
+def test_query_frames_empty_window(mock_get):
+    """
+    Test that a window without data yields an empty frame with the known columns
+    """
+    mock_get.side_effect = _mock_window_response
+    client = Apptuit(sanitize_mode=None, token='sdksdk203afdsfj_sadasd3939')
+    frames = list(client.query_frames("fetch('cpu')", 150, 1000, chunk=300))
+    assert_equals(len(frames), 3)
+    assert_equals(len(frames[0]), 5)
+    assert_equals(len(frames[1]), 0)
+    assert_equals(list(frames[2].columns), list(frames[0].columns))
+    with assert_raises(ValueError):
+        next(client.query_frames("fetch('cpu')", 0, 100, chunk="6x"))
+
+
+def _mock_two_outputs_response(url, **kwargs):
+    """
+    Build a query response with the outputs `a` and `b`, output `a` has no data after 90
+    """
+    params = parse_qs(urlparse(url).query)
+    start, end = int(params["start"][0]), int(params["end"][0])
+    outputs = []
+    for output_id, last in (("a", 90), ("b", 200)):
+        dps = [[ts, float(ts)] for ts in range(0, 200, 10) if start <= ts <= min(end, last)]
+        results = [{"metric": "m" + output_id, "tags": {"k": output_id}, "dps": dps}] \
+            if dps else []
+        outputs.append({"id": output_id, "result": results})
+    response = Mock()
+    response.content = json.dumps({"outputs": outputs})
+    return response
+
+
+@patch('apptuit.apptuit_client.requests.get')
+def test_query_frames_empty_output(mock_get):
+    """
+    Test that an output index refers to the same output in the windows where an earlier
+    output has no data
+    """
+    mock_get.side_effect = _mock_two_outputs_response
+    client = Apptuit(sanitize_mode=None, token='sdksdk203afdsfj_sadasd3939')
+    frames = list(client.query_frames("a = fetch('ma');\nb = fetch('mb');\noutput(a, b);",
+                                      0, 199, chunk=100, output=0))
+    assert_equals(len(frames), 2)
+    assert_equals(list(frames[0].columns), ['ma{k:a}'])
+    assert_equals(len(frames[0]), 10)
+    assert_equals(list(frames[1].columns), ['ma{k:a}'])
+    assert_equals(len(frames[1]), 0)
+    frames = list(client.query_frames("a = fetch('ma');\nb = fetch('mb');\noutput(a, b);",
+                                      0, 199, chunk=100, output=1))
+    assert_equals([len(df) for df in frames], [10, 10])
+    frames = list(client.query_frames("a = fetch('ma');\nb = fetch('mb');\noutput(a, b);",
+                                      0, 199, chunk=100, output=5))
+    assert_equals([len(df) for df in frames], [0, 0])
+
+
+@patch('apptuit.apptuit_client.requests.get')
+def test_query_frames_columns(mock_get):
+    """
+    Test that every frame has exactly the given columns
+    """
+    mock_get.side_effect = _mock_window_response
+    client = Apptuit(sanitize_mode=None, token='sdksdk203afdsfj_sadasd3939')
+    columns = ['cpu{host:b}', 'cpu{host:c}']
+    frames = list(client.query_frames("fetch('cpu')", 0, 199, chunk="1m", columns=columns))
+    assert_equals([list(df.columns) for df in frames], [columns] * 4)
+    assert_equals(frames[0][columns[0]].isnull().sum(), 6)
+    assert_equals(frames[3][columns[0]].sum(), 180 + 190)
+    assert_true(frames[3][columns[1]].isnull().all())
+
+
+def _run_concurrent_queries(client, threads_count):
+    results = []
+    errors = []
+
+    def run_query():
+        try:
+            results.append(client.query("fetch('nyc.taxi.rides')", 1406831400, 1407609000))
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=run_query) for _ in range(threads_count)]
+    for thread in threads:
+        thread.start()
+    return threads, results, errors
+
+
+@patch('apptuit.apptuit_client.requests.get')
+def test_coalesced_queries(mock_get):
+    """
+    Test that identical concurrent queries share a single request and result
+    """
+    release = threading.Event()
+
+    def slow_get(*args, **kwargs):
+        release.wait(5)
+        response = Mock()
+        response.content = get_mock_response()
+        return response
+
+    mock_get.side_effect = slow_get
+    client = Apptuit(sanitize_mode=None, token='sdksdk203afdsfj_sadasd3939',
+                     coalesce_queries=True)
+    threads, results, errors = _run_concurrent_queries(client, 8)
+    while client.coalesced_queries < 7:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert_equals(errors, [])
+    assert_equals(mock_get.call_count, 1)
+    assert_equals(client.coalesced_queries, 7)
+    assert_equals(len(results), 8)
+    assert_true(all(result is results[0] for result in results))
+    client.query("fetch('nyc.taxi.rides')", 1406831400, 1407609000)
+    assert_equals(mock_get.call_count, 2)
+    assert_equals(client._in_flight_queries, {})
+
+
+@patch('apptuit.apptuit_client.requests.get')
+def test_coalesced_query_error(mock_get):
+    """
+    Test that an error of the shared request is raised to all the callers
+    """
+    release = threading.Event()
+
+    def failing_get(*args, **kwargs):
+        release.wait(5)
+        raise requests.exceptions.ConnectionError()
+
+    mock_get.side_effect = failing_get
+    client = Apptuit(sanitize_mode=None, token='sdksdk203afdsfj_sadasd3939',
+                     coalesce_queries=True)
+    threads, results, errors = _run_concurrent_queries(client, 4)
+    while client.coalesced_queries < 3:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert_equals(results, [])
+    assert_equals(len(errors), 4)
+    assert_true(all(isinstance(err, requests.exceptions.ConnectionError) for err in errors))
+    assert_equals(mock_get.call_count, 1)
+
+
+@patch('apptuit.apptuit_client.requests.get')
+def test_queries_not_coalesced_by_default(mock_get):
+    """
+    Test that without coalesce_queries every query makes its own request
+    """
+    mock_get.return_value.content = get_mock_response()
+    client = Apptuit(sanitize_mode=None, token='sdksdk203afdsfj_sadasd3939')
+    threads, results, _ = _run_concurrent_queries(client, 4)
+    for thread in threads:
+        thread.join()
+    assert_equals(mock_get.call_count, 4)
+    assert_equals(client.coalesced_queries, 0)
+    assert_equals(len(set(id(result) for result in results)), 4)
+
+
+@patch('apptuit.apptuit_client.requests.get')
+def test_query_series_table(mock_get):
+    """
+    Test that the names of queried series are interned in the series table of the client
+    """
+    mock_get.return_value.content = get_mock_response()
+    table = SeriesTable()
+    client = Apptuit(sanitize_mode=None, token='sdksdk203afdsfj_sadasd3939', series_table=table)
+    first = client.query("fetch('nyc.taxi.rides')", 1406831400, 1407609000)
+    second = client.query("fetch('nyc.taxi.rides')", 1406831400, 1407609000)
+    assert_equals(len(table), 1)
+    assert_true(first[0].series[0].name is second[0].series[0].name)
+    assert_true(table.name(0) is first[0].series[0].name)
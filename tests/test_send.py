@@ -26,9 +26,9 @@ try:
 except ImportError:
     from mock import Mock, patch
 
-from nose.tools import assert_raises, assert_is_not_none, assert_equals
+from nose.tools import assert_raises, assert_is_not_none, assert_equals, assert_true
 from apptuit import Apptuit, DataPoint, TimeSeries, ApptuitException, APPTUIT_PY_TOKEN, \
-    APPTUIT_PY_TAGS, ApptuitSendException, apptuit_client
+    APPTUIT_PY_TAGS, ApptuitSendException, SeriesTable, apptuit_client
 
 
 def __get_apptuit_client():
@@ -79,6 +79,7 @@ def test_send_positive(mock_post):
         dps.append(DataPoint(metric=metric_name, tags=tags, timestamp=ts, value=random.random()))
         if len(dps) == 100:
             client.send(dps)
+            assert_equals(client.last_payload_size, len(mock_post.call_args[1]["data"]))
             dps = []
             points_sent += 100
         if points_sent > 500:
@@ -568,3 +569,88 @@ def test_tags_limit_indirect(mock_post):
         series2.add_point(timestamp, 3.14)
         with assert_raises(ValueError):
             client.send_timeseries([series1, series2])
+
+
+def test_datapoint_from_name():
+    """
+    Test creating datapoints of an existing TimeSeriesName
+    """
+    name = apptuit_client.TimeSeriesName("node.cpu", {"host": "localhost"})
+    point = DataPoint.from_name(name, 1500000000, "3.5")
+    assert_equals(point.metric, "node.cpu")
+    assert_equals(point.tags, {"host": "localhost"})
+    assert_equals(point.value, 3.5)
+    assert_true(point.timeseries_name is name)
+    with assert_raises(ValueError):
+        DataPoint.from_name(name, 1500000000, None)
+
+
+def test_payload_with_series_table():
+    """
+    Test that with a series table the payload is the same and each series is
+    sanitized only once
+    """
+    table = SeriesTable()
+    client = Apptuit(token="asdashdsauh_8aeraerf", api_endpoint="http://localhost",
+                     global_tags={"region": "us-east-1"}, series_table=table)
+    plain_client = Apptuit(token="asdashdsauh_8aeraerf", api_endpoint="http://localhost",
+                           global_tags={"region": "us-east-1"})
+    dps = [DataPoint("node.cpu-time", {"host": "host%d" % (i % 3)}, 1500000000 + i, i)
+           for i in range(10)]
+    payload = client._create_payload_from_datapoints(dps)
+    assert_equals(payload, plain_client._create_payload_from_datapoints(dps))
+    assert_equals(payload[0]["metric"], "node_cpu_time")
+    assert_equals(payload[0]["tags"], {"host": "host0", "region": "us-east-1"})
+    assert_equals(len(table), 3)
+    with patch.object(client, "sanitizer") as mock_sanitizer:
+        client._create_payload_from_datapoints(dps)
+        assert_equals(mock_sanitizer.call_count, 0)
+    with assert_raises(ValueError):
+        too_many_tags = dict(("tagk%d" % i, "tagv") for i in range(30))
+        client._create_payload_from_datapoints([DataPoint("node.cpu", too_many_tags, 1, 1)])
+
+
+@patch('apptuit.apptuit_client.requests.post')
+def test_send_max_series(mock_post):
+    """
+    Test that the points of the series over max_series are dropped or folded
+    """
+    mock_post.return_value.status_code = 204
+    dps = [DataPoint("requests", {"user": "user%d" % (i % 4)}, 1500000000 + i // 4, 1)
+           for i in range(8)]
+    client = Apptuit(token="asdashdsauh_8aeraerf", api_endpoint="http://localhost",
+                     global_tags={"host": "localhost"}, max_series=2)
+    with patch.object(client, "_create_payload_from_datapoints",
+                      wraps=client._create_payload_from_datapoints) as create_payload:
+        client.send(dps)
+        sent = create_payload.call_args[0][0]
+    assert_equals([dp.tags["user"] for dp in sent], ["user0", "user1"] * 2)
+    assert_equals(client.series_count, 2)
+    assert_equals(client.overflow_points, 4)
+    client = Apptuit(token="asdashdsauh_8aeraerf", api_endpoint="http://localhost",
+                     global_tags={"host": "localhost"}, max_series=2, series_overflow="fold")
+    payload = client._create_payload_from_datapoints(client._limit_datapoints(dps))
+    overflow = sorted((row["timestamp"], row["value"]) for row in payload
+                      if "cardinality_overflow" in row["tags"])
+    assert_equals(overflow, [(1500000000, 2), (1500000001, 2)])
+    with assert_raises(ValueError):
+        Apptuit(token="asdashdsauh_8aeraerf", series_overflow="sample")
+
+
+def test_send_timeseries_max_series():
+    """
+    Test that the timeseries over max_series are dropped or folded
+    """
+    series_list = [TimeSeries("requests", {"user": "user%d" % i}, [1500000000, 1500000001],
+                              [1.0, 2.0]) for i in range(3)]
+    client = Apptuit(token="asdashdsauh_8aeraerf", api_endpoint="http://localhost",
+                     max_series=1)
+    assert_equals(client._limit_timeseries(series_list), series_list[:1])
+    assert_equals(client.overflow_points, 4)
+    client = Apptuit(token="asdashdsauh_8aeraerf", api_endpoint="http://localhost",
+                     max_series=1, series_overflow="fold")
+    limited = client._limit_timeseries(series_list)
+    assert_equals(len(limited), 2)
+    assert_equals(limited[1].tags, {"cardinality_overflow": "true"})
+    assert_equals(limited[1].timestamps, [1500000000, 1500000001])
+    assert_equals(limited[1].values, [2.0, 4.0])
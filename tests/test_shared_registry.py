@@ -0,0 +1,289 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Tests for the shared memory registry
+"""
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equals, assert_true, assert_false, assert_raises, \
+    assert_almost_equal
+
+from apptuit.pyformance import ApptuitReporter, SharedMetricsRegistry
+from apptuit.pyformance.shared_registry import BucketSnapshot
+
+try:
+    from unittest.mock import Mock
+except ImportError:
+    from mock import Mock
+
+
+def _run_in_child(func):
+    """
+    Run a function in a forked process and wait for it to exit
+    """
+    pid = os.fork()
+    if pid == 0:
+        try:
+            func()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+
+def test_aggregate_across_processes():
+    """
+    Test that the metrics updated in forked processes are aggregated with
+    the metrics of the parent process
+    """
+    path = tempfile.mkdtemp()
+    try:
+        registry = SharedMetricsRegistry(path, buckets=(1, 10, 100))
+        registry.counter("requests").inc(2)
+        registry.meter("events").mark()
+        registry.histogram("size").add(5)
+        registry.timer("latency")._update(0.5)
+
+        def child():
+            registry.counter("requests").inc(3)
+            registry.counter("errors").inc()
+            registry.meter("events").mark(2)
+            registry.histogram("size").add(50)
+            registry.timer("latency")._update(1.5)
+        _run_in_child(child)
+
+        assert_equals(registry.counter("requests").get_count(), 2)
+        aggregated = registry.aggregate()
+        assert_equals(aggregated._counters["requests"].get_count(), 5)
+        assert_equals(aggregated._counters["errors"].get_count(), 1)
+        assert_equals(aggregated._counters["events"].get_count(), 3)
+        histogram = aggregated._histograms["size"]
+        assert_equals(histogram.get_count(), 2)
+        assert_equals(histogram.get_sum(), 55)
+        assert_equals(histogram.get_min(), 5)
+        assert_equals(histogram.get_max(), 50)
+        assert_equals(histogram.get_mean(), 27.5)
+        assert_almost_equal(histogram.get_stddev(), 31.81980515)
+        timer = aggregated._histograms["latency"]
+        assert_equals(timer.get_count(), 2)
+        assert_equals(timer.get_sum(), 2)
+        assert_true(registry.aggregate() is aggregated)
+    finally:
+        shutil.rmtree(path)
+
+
+def test_registries_of_one_process():
+    """
+    Test that the registries of a directory in the same process share its metric file,
+    rather than overwriting the entries of each other
+    """
+    path = tempfile.mkdtemp()
+    try:
+        registry = SharedMetricsRegistry(path)
+        other_registry = SharedMetricsRegistry(path)
+        registry.counter("x").inc(1)
+        other_registry.counter("y").inc(7)
+        registry.counter("z").inc(3)
+        assert_equals(other_registry.counter("y").get_count(), 7)
+        assert_equals(registry.counter("z").get_count(), 3)
+        assert_equals(os.listdir(path), ["%d.db" % os.getpid()])
+        aggregated = registry.aggregate()
+        assert_equals(dict((key, counter.get_count())
+                           for key, counter in aggregated._counters.items()),
+                      {"x": 1, "y": 7, "z": 3})
+    finally:
+        shutil.rmtree(path)
+
+
+def test_merge_exited_processes():
+    """
+    Test that the elected reporter merges the counters and histograms of the processes
+    which exited and removes their files
+    """
+    path = tempfile.mkdtemp()
+    try:
+        registry = SharedMetricsRegistry(path, buckets=(1, 10, 100))
+        registry.counter("requests").inc(2)
+
+        def child(requests, size):
+            def update():
+                registry.counter("requests").inc(requests)
+                registry.meter("events").mark()
+                registry.histogram("size").add(size)
+                registry.gauge("queue").set_value(1)
+            return update
+        _run_in_child(child(3, 5))
+        assert_equals(len(os.listdir(path)), 2)
+        other_registry = SharedMetricsRegistry(path)
+        assert_equals(other_registry.aggregate()._counters["requests"].get_count(), 5)
+        assert_equals(len(os.listdir(path)), 2)
+
+        assert_true(registry.elect_reporter())
+        for _ in range(2):
+            aggregated = registry.aggregate()
+            assert_equals(aggregated._counters["requests"].get_count(), 5)
+            assert_equals(sorted(os.listdir(path)),
+                          sorted(["%d.db" % os.getpid(), "merged.db", "reporter.lock"]))
+        _run_in_child(child(4, 50))
+        aggregated = registry.aggregate()
+        assert_equals(aggregated._counters["requests"].get_count(), 9)
+        assert_equals(aggregated._counters["events"].get_count(), 2)
+        histogram = aggregated._histograms["size"]
+        assert_equals(histogram.get_count(), 2)
+        assert_equals(histogram.get_sum(), 55)
+        assert_equals(histogram.get_max(), 50)
+        assert_false("queue" in aggregated._gauges)
+        assert_equals(len(os.listdir(path)), 3)
+        aggregated = registry.aggregate()
+        assert_equals(aggregated._counters["requests"].get_count(), 9)
+        assert_equals(aggregated._histograms["size"].get_count(), 2)
+    finally:
+        shutil.rmtree(path)
+
+
+def test_gauge_modes():
+    """
+    Test the aggregation of gauges, which ignores the processes which exited
+    """
+    path = tempfile.mkdtemp()
+    try:
+        for mode, expected in (("last", 2), ("sum", 5), ("min", 2), ("max", 3)):
+            for file_name in os.listdir(path):
+                os.remove(os.path.join(path, file_name))
+            registry = SharedMetricsRegistry(path, gauge_mode=mode)
+            registry.gauge("queue").set_value(3)
+            registry.gauge("queue").set_value(3)
+            with open(os.path.join(path, "%d.db" % os.getppid()), "wb") as other:
+                registry._file.mmap.seek(0)
+                other.write(registry._file.mmap.read())
+            registry._file = None
+            registry.gauge("queue")._file = None
+            registry.gauge("queue").set_value(2)
+            assert_equals(registry.aggregate()._gauges["queue"].get_value(), expected)
+        _run_in_child(lambda: registry.gauge("exited").set_value(1))
+        assert_false("exited" in registry.aggregate()._gauges)
+        with assert_raises(TypeError):
+            registry.gauge("callback", lambda: 1)
+    finally:
+        shutil.rmtree(path)
+
+
+def test_bucket_snapshot():
+    """
+    Test the percentiles interpolated from the bucket counts
+    """
+    snapshot = BucketSnapshot((1, 10, 100), (0, 10, 0, 0), 2, 10)
+    assert_equals(snapshot.get_size(), 10)
+    assert_equals(snapshot.get_median(), 6)
+    assert_equals(snapshot.get_percentile(1), 10)
+    snapshot = BucketSnapshot((1, 10, 100), (1, 0, 2, 1), 0.5, 500)
+    assert_equals(snapshot.get_percentile(0.25), 1)
+    assert_equals(snapshot.get_75th_percentile(), 100)
+    assert_equals(snapshot.get_percentile(1), 500)
+    assert_equals(BucketSnapshot((1,), (0, 0), 0, 0).get_median(), 0)
+    with assert_raises(ValueError):
+        snapshot.get_percentile(2)
+
+
+def test_file_growth():
+    """
+    Test that the file of a process grows to hold many metrics, and that the
+    metrics are loaded back when the file is reopened
+    """
+    path = tempfile.mkdtemp()
+    try:
+        registry = SharedMetricsRegistry(path)
+        for i in range(5000):
+            registry.histogram("histogram%d" % i).add(i)
+        registry = SharedMetricsRegistry(path)
+        registry.histogram("histogram4999").add(1)
+        assert_equals(registry.histogram("histogram4999").get_count(), 2)
+        aggregated = registry.aggregate()
+        assert_equals(len(aggregated._histograms), 5000)
+    finally:
+        shutil.rmtree(path)
+
+
+def test_elect_reporter():
+    """
+    Test that a single process is elected to report
+    """
+    path = tempfile.mkdtemp()
+    try:
+        registry = SharedMetricsRegistry(path)
+        other_registry = SharedMetricsRegistry(path)
+        assert_true(registry.elect_reporter())
+        assert_true(registry.elect_reporter())
+        assert_false(other_registry.elect_reporter())
+        read_fd, write_fd = os.pipe()
+
+        def child():
+            os.write(write_fd, b"1" if registry.elect_reporter() else b"0")
+        _run_in_child(child)
+        assert_equals(os.read(read_fd, 1), b"0")
+        os.close(read_fd)
+        os.close(write_fd)
+    finally:
+        shutil.rmtree(path)
+
+
+def test_reporter_with_shared_registry():
+    """
+    Test that only the elected reporter sends the aggregated metrics
+    """
+    path = tempfile.mkdtemp()
+    try:
+        registry = SharedMetricsRegistry(path)
+        registry.counter("requests").inc()
+        _run_in_child(lambda: registry.counter("requests").inc(2))
+        other_reporter = ApptuitReporter(registry=SharedMetricsRegistry(path),
+                                         token="asdashdsauh_8aeraerf",
+                                         disable_host_tag=True)
+        other_reporter.client.send = Mock()
+        reporter = ApptuitReporter(registry=registry, token="asdashdsauh_8aeraerf",
+                                   disable_host_tag=True)
+        reporter.client.send = Mock()
+        reporter.report_now()
+        other_reporter.report_now()
+        assert_equals(other_reporter.client.send.call_count, 0)
+        dps = reporter.client.send.call_args_list[0][0][0]
+        assert_equals([(dp.metric, dp.value) for dp in dps
+                   if not dp.metric.startswith("apptuit.reporter.")], [("requests.count", 3)])
+    finally:
+        shutil.rmtree(path)
+
+
+def test_invalid_arguments():
+    """
+    Test the validation of the arguments of the registry
+    """
+    path = tempfile.mkdtemp()
+    try:
+        with assert_raises(ValueError):
+            SharedMetricsRegistry(path, gauge_mode="avg")
+        with assert_raises(ValueError):
+            SharedMetricsRegistry(path, buckets=(10, 1))
+        environ_path = os.environ.pop("APPTUIT_SHARED_METRICS_DIR", None)
+        try:
+            with assert_raises(ValueError):
+                SharedMetricsRegistry()
+        finally:
+            if environ_path is not None:
+                os.environ["APPTUIT_SHARED_METRICS_DIR"] = environ_path
+    finally:
+        shutil.rmtree(path)
@@ -0,0 +1,138 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Tests for the sketch histograms and timers
+"""
+import random
+
+from nose.tools import assert_equals, assert_true, assert_raises
+
+from apptuit.pyformance import ApptuitReporter, SketchMetricsRegistry
+from apptuit.pyformance.sketch_metrics import DDSketch, SketchHistogram, SketchTimer
+
+
+class _Clock(object):
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+def test_sketch_relative_accuracy():
+    """
+    Test that the quantiles of the sketch are within the relative accuracy
+    """
+    rand = random.Random(7)
+    values = [rand.lognormvariate(0, 2) for _ in range(10000)]
+    sketch = DDSketch(relative_accuracy=0.02)
+    for value in values:
+        sketch.add(value)
+    values.sort()
+    assert_equals(sketch.count, 10000)
+    for quantile in (0, 0.25, 0.5, 0.9, 0.99, 0.999, 1):
+        exact = values[int(quantile * (len(values) - 1))]
+        assert_true(abs(sketch.get_quantile(quantile) - exact) <= 0.02 * exact)
+    assert_equals(DDSketch().get_quantile(0.5), 0)
+    with assert_raises(ValueError):
+        sketch.get_quantile(1.5)
+
+
+def test_sketch_negative_values_and_merge():
+    """
+    Test the negative values and zeros, and the merge of sketches
+    """
+    sketch = DDSketch()
+    other = DDSketch()
+    for value in (-100, -1, 0):
+        sketch.add(value)
+    for value in (0, 1, 100):
+        other.add(value)
+    sketch.merge(other)
+    assert_equals(sketch.count, 6)
+    assert_true(abs(sketch.get_quantile(0) + 100) <= 1)
+    assert_true(abs(sketch.get_quantile(0.2) + 1) <= 0.01)
+    assert_equals(sketch.get_quantile(0.5), 0)
+    assert_true(abs(sketch.get_quantile(1) - 100) <= 1)
+    with assert_raises(ValueError):
+        sketch.merge(DDSketch(relative_accuracy=0.05))
+
+
+def test_sketch_max_bins():
+    """
+    Test that the lowest buckets are collapsed when there are too many buckets
+    """
+    sketch = DDSketch(relative_accuracy=0.01, max_bins=10)
+    for exponent in range(100):
+        sketch.add(1.1 ** exponent)
+    assert_equals(len(sketch.positive.bins), 10)
+    assert_equals(sketch.count, 100)
+    assert_true(abs(sketch.get_quantile(1) - 1.1 ** 99) <= 0.01 * 1.1 ** 99)
+    sketch.add(1)
+    assert_equals(len(sketch.positive.bins), 10)
+
+
+def test_histogram_window():
+    """
+    Test that the percentiles of a windowed histogram are the ones of the
+    last completed window, while the count is the one of all the values
+    """
+    clock = _Clock(1005)
+    histogram = SketchHistogram(window=10, clock=clock)
+    for value in range(1, 101):
+        histogram.add(value)
+    assert_equals(histogram.get_snapshot().get_size(), 0)
+    clock.now = 1010
+    histogram.add(1000)
+    snapshot = histogram.get_snapshot()
+    assert_equals(snapshot.get_size(), 100)
+    assert_true(abs(snapshot.get_median() - 50) <= 0.5)
+    assert_equals(histogram.get_count(), 101)
+    assert_equals(histogram.get_max(), 1000)
+    clock.now = 1020
+    assert_equals(histogram.get_snapshot().get_size(), 1)
+    clock.now = 1040
+    assert_equals(histogram.get_snapshot().get_size(), 0)
+    with assert_raises(ValueError):
+        SketchHistogram(window=0)
+    with assert_raises(ValueError):
+        SketchHistogram(relative_accuracy=1)
+
+
+def test_registry_with_reporter():
+    """
+    Test that the registry creates sketch histograms and timers, and that
+    the reporter reports their percentiles
+    """
+    registry = SketchMetricsRegistry(relative_accuracy=0.01)
+    reporter = ApptuitReporter(registry=registry, token="asdashdsauh_8aeraerf",
+                               disable_host_tag=True)
+    assert_true(isinstance(registry.histogram("size"), SketchHistogram))
+    assert_true(isinstance(registry.timer("latency"), SketchTimer))
+    for value in range(1, 1001):
+        registry.histogram("size").add(value)
+        registry.timer("latency")._update(value / 1000.0)
+    with registry.timer("latency").time():
+        pass
+    values = dict((dp.metric, dp.value) for dp in reporter._collect_data_points(registry))
+    assert_equals(values["size.count"], 1000)
+    assert_true(abs(values["size.99_percentile"] - 990) <= 9.9)
+    assert_true(abs(values["size.75_percentile"] - 750) <= 7.5)
+    assert_equals(values["latency.count"], 1001)
+    assert_true(abs(values["latency.999_percentile"] - 0.999) <= 0.01)
+    with assert_raises(ValueError):
+        SketchMetricsRegistry(max_bins=0)
@@ -0,0 +1,122 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Tests for the sampling stack profiler
+"""
+import threading
+import time
+
+from nose.tools import assert_equals, assert_true, assert_raises, assert_is_none
+from pyformance import MetricsRegistry
+
+from apptuit.apptuit_client import TimeSeriesName
+from apptuit.pyformance import ApptuitReporter, StackProfiler
+
+try:
+    from unittest.mock import Mock
+except ImportError:
+    from mock import Mock
+
+
+def _busy_function(started, stopped):
+    started.set()
+    # only builtins are called in the loop, so the sampled frame is always this one
+    while not stopped:
+        sum(range(100))
+
+
+def _get_counts(registry):
+    counts = {}
+    for key, counter in registry._counters.items():
+        _, tags = TimeSeriesName.decode_metric(key)
+        counts[(tags["function"], tags.get("line"))] = counter.get_count()
+    return counts
+
+
+def test_sample():
+    """
+    Test that the samples of the function executed by a thread are counted
+    """
+    registry = MetricsRegistry()
+    profiler = StackProfiler(registry, top_functions=1000)
+    started = threading.Event()
+    stopped = []
+    thread = threading.Thread(target=_busy_function, args=(started, stopped))
+    thread.start()
+    try:
+        started.wait()
+        # let the thread return from started.set()
+        time.sleep(0.01)
+        for _ in range(20):
+            profiler.sample(threading.current_thread().ident)
+    finally:
+        stopped.append(True)
+        thread.join()
+    profiler.collect_profile_metrics()
+    counts = _get_counts(registry)
+    assert_equals(counts[("tests.test_stack_profiler._busy_function", None)], 20)
+    assert_true(("tests.test_stack_profiler.test_sample", None) not in counts)
+    profiler.collect_profile_metrics()
+    assert_equals(_get_counts(registry), counts)
+    with assert_raises(ValueError):
+        StackProfiler(registry, sampling_interval=0)
+    with assert_raises(ValueError):
+        StackProfiler(registry, top_functions=0)
+
+
+def test_top_functions():
+    """
+    Test that the samples of the functions outside of the top functions, or first
+    sampled after max_functions is reached, are reported under the function other
+    """
+    registry = MetricsRegistry()
+    profiler = StackProfiler(registry, top_functions=2, max_functions=3, by_line=True)
+    for line in range(4):
+        profiler._samples[("module", "function", line)] = 10 - line
+    profiler.collect_profile_metrics()
+    assert_equals(_get_counts(registry), {("module.function", "0"): 10,
+                                          ("module.function", "1"): 9,
+                                          ("other", "other"): 15})
+    profiler._samples[("module", "function", 1)] = 1
+    profiler._samples[("module", "function", 2)] = 3
+    profiler._samples[("module", "function", 5)] = 4
+    profiler.collect_profile_metrics()
+    assert_equals(_get_counts(registry), {("module.function", "0"): 10,
+                                          ("module.function", "1"): 9,
+                                          ("module.function", "5"): 4,
+                                          ("other", "other"): 19})
+
+
+def test_reporter_stack_profiler():
+    """
+    Test that the reporter starts, collects and stops its stack profiler
+    """
+    registry = MetricsRegistry()
+    reporter = ApptuitReporter(registry=registry, token="asdashdsauh_8aeraerf",
+                               reporting_interval=60, profiler_sampling_interval=0.001)
+    reporter.client.send = Mock()
+    reporter.start()
+    try:
+        deadline = time.time() + 5
+        while not reporter.stack_profiler._samples and time.time() < deadline:
+            time.sleep(0.01)
+        dps = reporter._collect_report()
+    finally:
+        reporter.stop()
+    assert_is_none(reporter.stack_profiler._thread)
+    assert_true([dp for dp in dps if dp.metric == "python.profiler.samples.count"])
+    assert_is_none(ApptuitReporter(token="asdashdsauh_8aeraerf").stack_profiler)
@@ -0,0 +1,101 @@
+#
+# Copyright 2018 Agilx, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Tests for the striped counters and meters
+"""
+import threading
+
+from nose.tools import assert_equals, assert_true
+
+from apptuit.pyformance import ApptuitReporter
+from apptuit.pyformance.striped_metrics import StripedCounter, StripedMeter, \
+    StripedMetricsRegistry
+
+
+def _run_threads(func, thread_count=8):
+    threads = [threading.Thread(target=func) for _ in range(thread_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_striped_counter():
+    """
+    Test that the increments of all the threads are counted, including
+    the increments of the threads which exited
+    """
+    counter = StripedCounter()
+
+    def increment():
+        for _ in range(1000):
+            counter.inc()
+        counter.dec(10)
+    _run_threads(increment)
+    counter.inc(5)
+    assert_equals(counter.get_count(), 8 * 990 + 5)
+    assert_equals(len(counter._cells._cells), 1)
+    counter.clear()
+    assert_equals(counter.get_count(), 0)
+    _run_threads(counter.inc)
+    assert_equals(counter.get_count(), 8)
+
+
+def test_striped_meter():
+    """
+    Test that the marks of all the threads are merged into the count and rates
+    """
+    now = [1000.0]
+
+    class Clock(object):
+        @staticmethod
+        def time():
+            return now[0]
+    meter = StripedMeter(clock=Clock)
+
+    def mark():
+        for _ in range(100):
+            meter.mark(2)
+    _run_threads(mark)
+    assert_equals(meter.get_count(), 1600)
+    now[0] += 10
+    assert_equals(meter.get_mean_rate(), 160)
+    assert_equals(meter.get_one_minute_rate(), 160)
+    meter.mark(10)
+    now[0] += 10
+    assert_equals(meter.get_count(), 1610)
+    assert_true(meter.get_one_minute_rate() < 160)
+    meter.clear()
+    assert_equals(meter.get_count(), 0)
+    meter.mark()
+    assert_equals(meter.get_count(), 1)
+
+
+def test_striped_registry_with_reporter():
+    """
+    Test that the reporter reports the striped counters and meters
+    """
+    registry = StripedMetricsRegistry()
+    reporter = ApptuitReporter(registry=registry, token="asdashdsauh_8aeraerf",
+                               disable_host_tag=True)
+    assert_true(isinstance(registry.counter("requests"), StripedCounter))
+    assert_true(isinstance(registry.meter("events"), StripedMeter))
+    _run_threads(lambda: registry.counter("requests").inc())
+    _run_threads(lambda: registry.meter("events").mark())
+    values = dict((dp.metric, dp.value) for dp in reporter._collect_data_points(registry))
+    assert_equals(values["requests.count"], 8)
+    assert_equals(values["events.count"], 8)
@@ -14,11 +14,13 @@
 # limitations under the License.
 #
 
+import json
+import random
 import time
 
-from nose.tools import assert_raises, assert_equals
+from nose.tools import assert_raises, assert_equals, assert_true
 
-from apptuit import timeseries, TimeSeriesName, TimeSeries
+from apptuit import timeseries, TimeSeriesName, TimeSeries, SeriesTable
 
 
 def test_encode_tags():
@@ -50,6 +52,74 @@ def test_decode_tags():
                   timeseries.decode_metric('apr.counter.count{"tk1":"tv1","tk2":"tv2"}'))
 
 
+def test_encode_matches_json():
+    """
+        Test that the encoding is exactly the same as encoding the tags with json.dumps
+        and that decoding gets the tags back
+    """
+    alphabet = u'abcXYZ019 _-./:{}[],"\\\'\n\t\x00\x7f\xe9\u65e5\u672c'
+    random.seed(7)
+    samples = [{}, {"tk1": 1, "tk2": True, "tk3": None, "tk4": 2.5, "tk5": [1, "a"]},
+               {"tk1": {"b": 1, "a": 2}}, {1: "a", 2: "b"}]
+    for _ in range(500):
+        tags = {}
+        for _ in range(random.randint(1, 6)):
+            tag_key = u"".join(random.choice(alphabet) for _ in range(random.randint(1, 8)))
+            tag_value = u"".join(random.choice(alphabet) for _ in range(random.randint(0, 8)))
+            tags[tag_key] = tag_value
+        samples.append(tags)
+    for tags in samples:
+        encoded = timeseries.encode_metric("metric", tags)
+        assert_equals(encoded, "metric" + json.dumps(tags, sort_keys=True))
+        if all(isinstance(tag_key, str) for tag_key in tags):
+            assert_equals(timeseries.decode_metric(encoded), ("metric", tags))
+
+
+def test_encode_cache_value_types():
+    """
+        Test that tag values which are equal but of different types are encoded differently
+    """
+    assert_equals(timeseries.encode_metric("m", {"tk": 1}), 'm{"tk": 1}')
+    assert_equals(timeseries.encode_metric("m", {"tk": True}), 'm{"tk": true}')
+    assert_equals(timeseries.encode_metric("m", {"tk": 1.0}), 'm{"tk": 1.0}')
+    assert_equals(timeseries.encode_metric("m", {"tk": "1"}), 'm{"tk": "1"}')
+
+
+def test_metric_cache_sizes():
+    """
+        Test that the cache sizes can be changed and their statistics are exposed
+    """
+    try:
+        timeseries.set_cache_sizes(encode_cache_size=2, decode_cache_size=3)
+        info = timeseries.cache_info()
+        assert_equals(info["encode"].maxsize, 2)
+        assert_equals(info["decode"].maxsize, 3)
+        assert_equals(info["decode"].currsize, 0)
+        for i in range(4):
+            encoded = TimeSeriesName.encode_metric("metric", {"tk": "tv%d" % i})
+            timeseries.decode_metric(encoded)
+            TimeSeriesName.decode_metric(encoded)
+        timeseries.encode_metric("metric", {"tk": "tv3"})
+        info = timeseries.cache_info()
+        assert_equals(info["encode"].hits, 1)
+        assert_equals(info["encode"].misses, 4)
+        assert_equals(info["encode"].currsize, 2)
+        assert_equals(info["decode"].hits, 4)
+        assert_equals(info["decode"].misses, 4)
+        assert_equals(info["decode"].currsize, 3)
+        timeseries.set_cache_sizes(decode_cache_size=0)
+        assert_equals(timeseries.cache_info()["encode"].maxsize, 2)
+        assert_equals(timeseries.cache_info()["decode"].maxsize, 0)
+        assert_equals(timeseries.decode_metric('m{"tk": "tv"}'), ("m", {"tk": "tv"}))
+        with assert_raises(ValueError):
+            timeseries.set_cache_sizes(encode_cache_size=-1)
+    finally:
+        timeseries.set_cache_sizes(timeseries.DEFAULT_ENCODE_CACHE_SIZE,
+                                   timeseries.DEFAULT_DECODE_CACHE_SIZE)
+    assert_equals(timeseries.cache_info()["decode"].maxsize,
+                  timeseries.DEFAULT_DECODE_CACHE_SIZE)
+
+
 def test_encode_tags2():
     """
         Test encoding tags with TimeSeries
@@ -106,3 +176,65 @@ def test_empty_metric_name_tag_key_raise_error():
         TimeSeriesName("metric1", {"": "tagv1", "tagk2": "tagv2"})
     with assert_raises(ValueError):
         TimeSeriesName("", {"tagk1": "tagv1", "tagk2": "tagv2"})
+
+
+def test_timeseriesname_hash_eq():
+    """
+    Test that names with the same metric and tags are equal and hash the same
+    """
+    name1 = TimeSeriesName("metric1", {"tagk1": "tagv1", "tagk2": "tagv2"})
+    name2 = TimeSeriesName("metric1", {"tagk2": "tagv2", "tagk1": "tagv1"})
+    name3 = TimeSeriesName("metric1", {"tagk1": "tagv1"})
+    name4 = TimeSeriesName("metric1", {"tagk1": 1})
+    name5 = TimeSeriesName("metric1", {"tagk1": "1"})
+    assert_equals(name1, name2)
+    assert_equals(hash(name1), hash(name2))
+    assert_true(name1 != name3)
+    assert_true(name4 != name5)
+    assert_true(name1 != str(name1))
+    assert_equals(name1.key, str(name1))
+    assert_equals(len({name1: 1, name2: 2, name3: 3}), 2)
+    assert_equals(str(TimeSeriesName("metric1", None)), "metric1null")
+
+
+def test_timeseriesname_immutable():
+    """
+    Test that the metric and tags of a name cannot be replaced nor modified
+    """
+    name = TimeSeriesName("metric1", {"tagk1": "tagv1"})
+    with assert_raises(AttributeError):
+        name.metric = "metric2"
+    with assert_raises(AttributeError):
+        name.tags = {}
+    # the tags are copied, modifying the dict does not change the hashed name
+    tags = {"tagk1": "tagv1"}
+    name = TimeSeriesName("metric1", tags)
+    table = SeriesTable()
+    name_id = table.series_id(name)
+    tags["tagk1"] = "tagv2"
+    assert_equals(name.tags, {"tagk1": "tagv1"})
+    assert_equals(name.key, TimeSeriesName("metric1", {"tagk1": "tagv1"}).key)
+    assert_equals(table.series_id(TimeSeriesName("metric1", {"tagk1": "tagv1"})), name_id)
+
+
+def test_series_table():
+    """
+    Test that the series table interns names and gives them stable ids
+    """
+    table = SeriesTable()
+    name1 = TimeSeriesName("metric1", {"tagk1": "tagv1"})
+    name2 = TimeSeriesName("metric2", {"tagk1": "tagv1"})
+    assert_equals(table.series_id(name1), 0)
+    assert_equals(table.series_id(name2), 1)
+    equal_name = TimeSeriesName("metric1", {"tagk1": "tagv1"})
+    assert_equals(table.series_id(equal_name), 0)
+    assert_true(table.intern(equal_name) is name1)
+    assert_true(table.name(1) is name2)
+    assert_true(equal_name in table)
+    assert_equals(len(table), 2)
+    assert_equals(table.remove(equal_name), 0)
+    assert_equals(table.remove(equal_name), None)
+    assert_true(name1 not in table)
+    assert_equals(len(table), 1)
+    # the ids of the removed names are not given to other names
+    assert_equals(table.series_id(name1), 2)
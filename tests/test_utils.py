@@ -23,7 +23,7 @@ from nose.tools import assert_true, assert_false, assert_raises, \
     assert_equals
 
 from apptuit.utils import strtobool, sanitize_name_apptuit, \
-    sanitize_name_prometheus, _contains_valid_chars
+    sanitize_name_prometheus, _contains_valid_chars, _parse_duration
 
 
 def test_strtobool():
@@ -94,3 +94,19 @@ def test_contains_valid_chars():
         result = _contains_valid_chars(test_string)
         assert_equals(result, expected_name, "Validation failed for,'" + test_string+"'")
 
+
+
+def test_parse_duration():
+    """
+    Test conversion of durations to seconds
+    """
+    assert_equals(_parse_duration(90), 90)
+    assert_equals(_parse_duration("90"), 90)
+    assert_equals(_parse_duration("90s"), 90)
+    assert_equals(_parse_duration("30m"), 1800)
+    assert_equals(_parse_duration("6h"), 21600)
+    assert_equals(_parse_duration("1d"), 86400)
+    assert_equals(_parse_duration("2w"), 1209600)
+    for invalid in ("", "6x", "h", "-1h", "0", 0, -5):
+        with assert_raises(ValueError):
+            _parse_duration(invalid)